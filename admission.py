@@ -0,0 +1,78 @@
+"""
+Допуск дорогих операций (скачивание фото + CLIP): не больше workers задач одновременно и очередь не длиннее
+max_backlog. Обработчик апдейта не ждёт саму работу — он ставит её в очередь, сразу отвечает пользователю
+(«в очереди: N») и завершается; работа выполняется фоновой задачей и сама доставляет результат.
+Очередь полна — submit() бросает Overloaded, и пользователю вежливо отказывают вместо растущей задержки.
+
+    queue = AdmissionQueue(workers=2, max_backlog=32)
+    try:
+        position = queue.submit(job)   # 0 — стартует сразу, N — N-я в очереди
+    except Overloaded:
+        ...
+"""
+import asyncio
+import time
+import traceback
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, Set, Tuple
+
+Job = Callable[[], Awaitable[None]]
+
+
+class Overloaded(RuntimeError):
+    """Очередь заполнена — новую работу не берём."""
+
+
+class AdmissionQueue:
+    def __init__(self, workers: int = 2, max_backlog: int = 32,
+                 on_wait: Optional[Callable[[float], None]] = None):
+        self.workers = max(1, workers)
+        self.max_backlog = max(0, max_backlog)
+        self.on_wait = on_wait  # сколько секунд задача простояла в очереди (для гистограммы)
+        self.rejected = 0
+        self._waiting: Deque[Tuple[Job, float]] = deque()
+        self._running = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def submit(self, job: Job) -> int:
+        if self._running < self.workers:
+            self._start(job, time.perf_counter())
+            return 0
+        if len(self._waiting) >= self.max_backlog:
+            self.rejected += 1
+            raise Overloaded(f"backlog {len(self._waiting)} >= {self.max_backlog}")
+        self._waiting.append((job, time.perf_counter()))
+        return len(self._waiting)
+
+    def _start(self, job: Job, queued_at: float):
+        self._running += 1
+        if self.on_wait is not None:
+            self.on_wait(time.perf_counter() - queued_at)
+        task = asyncio.create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: Job):
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._running -= 1
+            if self._waiting:
+                self._start(*self._waiting.popleft())
+
+    async def drain(self):
+        """Дождаться всех принятых задач (остановка бота, бенчмарки)."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
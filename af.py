@@ -1,24 +1,108 @@
 import os
 import io
+import re
+import math
+import random
 import asyncio
+import time
 import traceback
-from datetime import datetime, timezone
-from html import escape
-from typing import Optional, Dict, List, Any, Tuple
-import asyncpg
+from datetime import datetime, timedelta, timezone
+from html import escape, unescape
+from collections import OrderedDict
+from typing import Optional, Dict, List, Any, Tuple, Callable, Awaitable, Set
 import numpy as np
 import torch
 import clip
 from PIL import Image
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, BufferedInputFile
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from callbacks import CallbackRouter, CallbackDataError, TokenField
+import embeddings
+import model_store
+import colors
+import suggest
+import metrics
+import tracing
+import loopwatch
+import repository
+import photo_cache
+import admission
+import search_index
+import userlanes
+import compat
 import logging
 logger = logging.getLogger("close_view")
 # ---------------- Config ----------------
 TOKEN = os.getenv("tg_bot_token")
 DATABASE_URL = os.getenv("DATABASE_URL")
-
+# веса CLIP только из локального файла (см. model_store.py): путь (по умолчанию кэш clip), ожидаемый sha256
+# (по умолчанию <путь>.sha256 или сумма из URL модели OpenAI) и загрузка state_dict через mmap
+CLIP_MODEL_PATH = os.getenv("CLIP_MODEL_PATH") or None
+CLIP_MODEL_SHA256 = os.getenv("CLIP_MODEL_SHA256") or None
+CLIP_MODEL_MMAP = os.getenv("CLIP_MODEL_MMAP", "1") != "0"
+# пул соединений и таймауты (сек): DB_COMMAND_TIMEOUT — на любой запрос, DB_QUERY_TIMEOUTS — по имени запроса
+# из repository.STATEMENTS, например "search=3,capsule_items=2"; DB_ACQUIRE_TIMEOUT — ожидание соединения
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+DB_QUERY_TIMEOUTS = repository.parse_timeouts(os.getenv("DB_QUERY_TIMEOUTS", ""))
+# /metrics в формате Prometheus; пустой METRICS_PORT — не поднимать
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT", "9108")
+# трассировка апдейтов: порог «медленного» апдейта и выборочный cProfile (доля апдейтов, 0 — выключен)
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1500"))
+TRACE_PROFILE_RATE = float(os.getenv("TRACE_PROFILE_RATE", "0"))
+TRACE_PROFILE_DIR = os.getenv("TRACE_PROFILE_DIR") or None
+# сторож event loop: порог задержки, после которого логируется стек блокирующего кода;
+# LOOP_STRICT_MS — отладочный строгий режим: каждая блокировка дольше N мс логируется как нарушение,
+# benchmarks/ с этим env завершаются с кодом 2, если измеряемый код держал цикл дольше
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "200"))
+LOOP_STRICT_MS = float(os.getenv("LOOP_STRICT_MS")) if os.getenv("LOOP_STRICT_MS") else None
+# дисковый кэш скачанных фото вещей (см. photo_cache.py): каталог (пустой — не кэшировать) и предел размера;
+# ссылка из getFile действительна не меньше часа — столько и переиспользуем её без повторного вызова
+PHOTO_CACHE_DIR = os.getenv("PHOTO_CACHE_DIR", os.path.expanduser("~/.cache/wardrobe_bot/photos"))
+PHOTO_CACHE_MAX_MB = int(os.getenv("PHOTO_CACHE_MAX_MB", "512"))
+FILE_PATH_TTL = float(os.getenv("FILE_PATH_TTL", "3300"))
+# inline-режим (@bot запрос): результатов на страницу, сколько секунд Telegram может кэшировать ответ,
+# для скольких пользователей держать поисковый индекс в памяти
+INLINE_PAGE_SIZE = int(os.getenv("INLINE_PAGE_SIZE", "20"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "10"))
+SEARCH_INDEX_USERS = int(os.getenv("SEARCH_INDEX_USERS", "256"))
+# смысловой поиск: текст запроса кодируется CLIP и сравнивается с эмбеддингами вещей (дополняет поиск по словам);
+# сколько похожих вещей показывать, минимальный косинус текст—картинка и сколько эмбеддингов запросов помнить
+SEMANTIC_SEARCH = os.getenv("SEMANTIC_SEARCH", "1") != "0"
+SEMANTIC_TOP_K = int(os.getenv("SEMANTIC_TOP_K", "10"))
+SEMANTIC_MIN_SIM = float(os.getenv("SEMANTIC_MIN_SIM", "0.22"))
+QUERY_EMB_CACHE_SIZE = int(os.getenv("QUERY_EMB_CACHE_SIZE", "512"))
+# допуск анализа фото (см. admission.py): сколько фото анализировать одновременно и сколько держать в очереди,
+# прежде чем вежливо отказывать
+ADMISSION_WORKERS = int(os.getenv("ADMISSION_WORKERS", "2"))
+ADMISSION_MAX_BACKLOG = int(os.getenv("ADMISSION_MAX_BACKLOG", "32"))
+ADMISSION_DRAIN_TIMEOUT = float(os.getenv("ADMISSION_DRAIN_TIMEOUT", "30"))  # сколько при остановке ждать принятые фото, сек
+# граф совместимости (см. compat.py): сколько ближайших вещей каждой чужой группы помнить у вещи
+COMPAT_TOP_K = int(os.getenv("COMPAT_TOP_K", "10"))
+# определение цвета вещи: pixels — k-means по пикселям в Lab (colors.py), clip — zero-shot по промптам COLOR_LABELS
+COLOR_ENGINE = os.getenv("COLOR_ENGINE", "pixels")
+# персональные подсказки по похожим вещам пользователя (см. Label suggestions): косинус, с которого соседи
+# учитываются, и с которого ближайший сосед полностью заменяет zero-shot ответ; сколько индексов держать в памяти
+KNN_MIN_SIM = float(os.getenv("KNN_MIN_SIM", "0.80"))
+KNN_STRONG_SIM = float(os.getenv("KNN_STRONG_SIM", "0.92"))
+KNN_K = int(os.getenv("KNN_K", "5"))
+KNN_INDEX_USERS = int(os.getenv("KNN_INDEX_USERS", "256"))
+# формат хранения wardrobe.emb: f16 (по умолчанию), int8 или f32; старые строки читаются в любом случае (см. embeddings.py)
+EMB_CODEC = os.getenv("EMB_CODEC", "f16")
+# фоновое перевычисление эмбеддингов старых версий (см. Re-embedding worker)
+REEMBED_ENABLED = os.getenv("REEMBED_ENABLED", "1") != "0"
+REEMBED_BATCH = int(os.getenv("REEMBED_BATCH", "16"))
+REEMBED_PAUSE = float(os.getenv("REEMBED_PAUSE", "2.0"))  # пауза между пачками, сек
+REEMBED_MAX_WAIT = float(os.getenv("REEMBED_MAX_WAIT", "30"))  # дольше этого пачка не уступает очереди фото, сек
+REEMBED_RECHECK = float(os.getenv("REEMBED_RECHECK", "600"))  # пауза после прохода, который ничего не перевычислил, сек
+
+if COLOR_ENGINE not in ("pixels", "clip"):
+    raise RuntimeError("COLOR_ENGINE должен быть pixels или clip")
 if not TOKEN:
     raise RuntimeError("Установите tg_bot_token")
 if not DATABASE_URL:
@@ -28,10 +112,19 @@ if not DATABASE_URL:
 bot = Bot(token=TOKEN)
 dp = Dispatcher()
 
+# Callback-кнопки: таблица action -> обработчик (см. callbacks.py); cb_data собирает callback_data по схеме action
+callback_router = CallbackRouter()
+cb_data = callback_router.pack
+
 # ---------------- CLIP ----------------
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print("Loading CLIP on", device)
-model, preprocess = clip.load("ViT-B/32", device=device, jit=False)
+CLIP_MODEL_NAME = "ViT-B/32"
+# версия эмбеддингов: модель + препроцессинг. Меняется при любой их смене — тогда старые строки перевычисляются
+EMB_MODEL = f"clip-{CLIP_MODEL_NAME}/v1"
+# без сети: нет файла или не сошлась сумма — ModelStoreError сразу, а не скачивание посреди старта
+model, preprocess = model_store.load_clip(CLIP_MODEL_NAME, CLIP_MODEL_PATH, sha256=CLIP_MODEL_SHA256, device=device,
+                                          mmap=CLIP_MODEL_MMAP)
 
 # ---------------- Constants ----------------
 CLOTHING_CATEGORIES = [
@@ -69,6 +162,23 @@ COLOR_MAP = {"white":"белый","black":"чёрный","gray":"серый","re
              "maroon":"бордовый","olive":"оливковый"}
 
 PAGE_SIZE = 10
+CAPSULE_PAGE_SIZE = 10  # капсул на одной странице списка
+
+# Коллаж капсулы: размер клетки сетки (px), отступ и сколько уменьшенных картинок держим в памяти
+COLLAGE_TILE = 320
+COLLAGE_GAP = 8
+COLLAGE_BG = (255, 255, 255)
+COLLAGE_TILE_CACHE_SIZE = 256
+
+ITEM_CARD_CACHE_SIZE = 2048  # сколько отрисованных карточек вещей держим в памяти
+TAG_VOCAB_CACHE_SIZE = 1024  # для скольких пользователей держать словарь тегов с числом вещей
+TAG_MENU_SIZE = 30  # сколько самых частых тегов показывать кнопками в «По тегам»
+FILE_INFO_CACHE_SIZE = 8192  # сколько file_id -> (file_unique_id, путь из getFile) держим в памяти
+MESSAGE_COMPANIONS_SIZE = 1024  # для скольких меню помнить сообщения, которые удаляются вместе с ними
+
+# Импорт альбомом: ждём остальные фото группы, качаем параллельно не больше N файлов
+ALBUM_COLLECT_DELAY = 1.5
+ALBUM_DOWNLOAD_CONCURRENCY = 4
 # ---------------- Help text ----------------
 HELP_TEXT = (
     "<b>О боте и обработке фото</b>\n\n"
@@ -98,7 +208,10 @@ HELP_TEXT = (
     "• /help — это сообщение.\n"
     "• «Создать капсулу» — сгенерировать подборку из ваших вещей.\n"
     "• «Мой гардероб» — просмотреть категории, добавить вещь, перейти в поиск.\n"
-    "• В карточке вещи: добавить тег, добавить описание, удалить вещь, вернуться назад.\n\n"
+    "• «По тегам» в гардеробе — вещи с выбранным тегом.\n"
+    "• В списке вещей «Выбрать несколько» — отметить вещи и удалить их или добавить/снять тег сразу у всех.\n"
+    "• В карточке вещи: добавить тег, добавить описание, «С чем носить» — подходящие вещи других категорий, удалить вещь.\n"
+    "• В любом чате наберите @имя_бота и слово (например «платье красное») — бот покажет подходящие вещи.\n\n"
 
     "<b>Советы</b>\n"
     "• Если модель предлагает не тот цвет/категорию — выберите «ввести вручную» и исправьте.\n"
@@ -109,10 +222,122 @@ pending_add: Dict[int, Dict[str, Any]] = {}
 pending_action: Dict[int, Dict[str, Any]] = {}
 pending_capsule: Dict[int, Dict[str, Any]] = {}
 pending_photo_offer: Dict[int, Dict[str, Any]] = {}
+pending_album: Dict[int, Dict[str, Any]] = {}  # итог последнего импорта альбомом (для исправления категорий)
+album_buffers: Dict[Tuple[int, str], Dict[str, Any]] = {}  # (user_id, media_group_id) -> собираемые фото альбома
 last_menu_message: Dict[int, Dict[str, Any]] = {}  # хранит единственное текущее меню (chat_id, message_id, type)
+# (chat_id, message_id) меню -> сообщения над ним, которые уходят вместе с ним: фото капсулы, чей текст
+# не поместился в подпись, — меню с кнопками тогда текстовое сообщение под фото (LRU)
+message_companions: "OrderedDict[Tuple[int, int], List[int]]" = OrderedDict()
+collage_tile_cache: "OrderedDict[str, Image.Image]" = OrderedDict()  # file_id -> уменьшенная картинка вещи (LRU)
+item_card_cache: "OrderedDict[Tuple[int, int], Dict[str, Any]]" = OrderedDict()  # (user_id, item_id) -> карточка (LRU)
+file_info_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # file_id -> unique_id, file_path, expires (LRU)
+label_indexes: "OrderedDict[int, suggest.LabelIndex]" = OrderedDict()  # user_id -> индекс подсказок (LRU)
+query_emb_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()  # текст запроса -> эмбеддинг CLIP (LRU)
+tag_vocab_cache: "OrderedDict[int, List[Any]]" = OrderedDict()  # user_id -> теги с числом вещей (LRU)
+search_indexes: "OrderedDict[int, asyncio.Future]" = OrderedDict()  # user_id -> индекс inline-поиска (LRU)
+compat_pools: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()  # user_id -> вещи индекса подсказок по группам (LRU)
+wardrobe_selection: Dict[int, Dict[str, Any]] = {}  # режим выбора в списке гардероба: выбранные id, страница, группа
+last_analysis: Dict[int, Dict[str, Any]] = {}  # последний «Проанализировать фото» (для исправления через fb_no_input)
+
+# ---------------- DB ----------------
+# все запросы — именованные prepared statements из repository.STATEMENTS; метрики пула и запросов — там же
+repo: repository.Repository = None
+
+# ---------------- Metrics ----------------
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Время обработчика", ["handler"])
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+CLIP_SECONDS = metrics.histogram("bot_clip_seconds", "Время инференса CLIP", ["op"])
+CLIP_BATCH = metrics.histogram("bot_clip_batch_size", "Картинок в одном вызове CLIP", ["op"],
+                               buckets=(1, 2, 4, 8, 16, 32, 64))
+COLOR_SECONDS = metrics.histogram("bot_color_seconds", "Время определения цвета по пикселям",
+                                  buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+API_SECONDS = metrics.histogram("bot_telegram_api_seconds", "Время вызова Bot API", ["method"])
+API_ERRORS = metrics.counter("bot_telegram_api_errors_total", "Ошибки Bot API", ["method", "error"])
+LOOP_LAG_SECONDS = metrics.histogram("bot_event_loop_lag_seconds", "Задержка планирования event loop",
+                                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+LOOP_LAG_WINDOW = metrics.gauge("bot_event_loop_lag_window_seconds", "Перцентили задержки event loop за последнее окно", ["quantile"])
+LOOP_STALLS = metrics.gauge("bot_event_loop_stalls", "Блокировок event loop дольше порога с запуска")
+PHOTO_CACHE_REQUESTS = metrics.counter("bot_photo_cache_requests_total", "Обращения к дисковому кэшу фото", ["result"])
+PHOTO_CACHE_BYTES = metrics.gauge("bot_photo_cache_bytes", "Размер дискового кэша фото")
+PHOTO_CACHE_BYTES.set_function(lambda: photos.total_bytes if photos is not None else 0)
+ADMISSION_JOBS = metrics.gauge("bot_admission_jobs", "Задачи анализа фото: выполняются и ждут в очереди", ["state"])
+ADMISSION_JOBS.labels("running").set_function(lambda: photo_queue.running)
+ADMISSION_JOBS.labels("waiting").set_function(lambda: photo_queue.waiting)
+ADMISSION_WAIT_SECONDS = metrics.histogram("bot_admission_wait_seconds", "Ожидание задачи анализа фото в очереди",
+                                           buckets=(0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+ADMISSION_REJECTED = metrics.counter("bot_admission_rejected_total", "Фото, не принятые из-за полной очереди")
+USER_LANE_WAIT_SECONDS = metrics.histogram("bot_user_lane_wait_seconds", "Ожидание апдейта за предыдущими апдейтами того же пользователя",
+                                          buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+SEARCH_RESULTS = metrics.histogram("bot_search_results", "Вещей найдено одним поиском", ["kind"],
+                                   buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250))
+CALLBACKS_COALESCED = metrics.counter("bot_callbacks_coalesced_total", "Повторные нажатия, отброшенные до выполнения")
+STATE_ENTRIES = metrics.gauge("bot_state_entries", "Записей в in-memory состояниях", ["state"])
+for _name, _obj in (("pending_add", pending_add), ("pending_action", pending_action), ("pending_capsule", pending_capsule),
+                    ("pending_photo_offer", pending_photo_offer), ("pending_album", pending_album),
+                    ("album_buffers", album_buffers), ("last_menu_message", last_menu_message),
+                    ("message_companions", message_companions),
+                    ("wardrobe_selection", wardrobe_selection),
+                    ("collage_tile_cache", collage_tile_cache), ("item_card_cache", item_card_cache),
+                    ("file_info_cache", file_info_cache), ("tag_vocab_cache", tag_vocab_cache),
+                    ("label_indexes", label_indexes), ("search_indexes", search_indexes), ("query_emb_cache", query_emb_cache), ("last_analysis", last_analysis),
+                    ("compat_pools", compat_pools),
+                    ("callback_tokens", callback_router.tokens)):
+    STATE_ENTRIES.labels(_name).set_function(lambda o=_obj: len(o))
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            sec = time.perf_counter() - t0
+            API_SECONDS.labels(name).observe(sec)
+            tracing.add_child("api", name, sec)
+
+bot.session.middleware(ApiMetricsMiddleware())
+
+loop_watchdog = loopwatch.LoopWatchdog(threshold_ms=LOOP_LAG_THRESHOLD_MS, strict_ms=LOOP_STRICT_MS,
+                                       on_lag=LOOP_LAG_SECONDS.observe)
+for _q in ("0.5", "0.9", "0.99", "max"):
+    LOOP_LAG_WINDOW.labels(_q).set_function(lambda q=_q: loop_watchdog.percentiles()[q])
+LOOP_STALLS.set_function(lambda: loop_watchdog.stalls)
+
+# ---------------- Tracing ----------------
+# span на апдейт; дочерние отрезки добавляют repository (запросы и ожидание пула), ApiMetricsMiddleware и CLIP-хелперы
+dp.update.outer_middleware(tracing.TracingMiddleware(slow_ms=TRACE_SLOW_MS, profile_rate=TRACE_PROFILE_RATE,
+                                                     profile_dir=TRACE_PROFILE_DIR))
+
+# ---------------- Per-user lanes ----------------
+# сообщения и нажатия одного пользователя обрабатываются строго по очереди (см. userlanes.py);
+# повторное нажатие той же кнопки, пока первое не отработало, отбрасывается
+def observe_lane_wait(sec: float):
+    USER_LANE_WAIT_SECONDS.observe(sec)
+    tracing.add_child("lane", "wait", sec)
+
+user_lanes = userlanes.UserLanes(busy_text="⏳ Уже выполняется…", on_wait=observe_lane_wait,
+                                 on_coalesced=CALLBACKS_COALESCED.inc)
+dp.update.outer_middleware(user_lanes)
+STATE_ENTRIES.labels("user_lanes").set_function(lambda: len(user_lanes))
+
+@dp.message.middleware()
+async def message_handler_metrics(handler, event, data):
+    h = data.get("handler")
+    name = getattr(getattr(h, "callback", None), "__name__", "unknown")
+    tracing.set_name(name)
+    t0 = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.labels(name).inc()
+        raise
+    finally:
+        HANDLER_SECONDS.labels(name).observe(time.perf_counter() - t0)
 
-# ---------------- DB pool ----------------
-db_pool: asyncpg.pool.Pool = None
+dp.inline_query.middleware(message_handler_metrics)
 
 # ---------------- Keyboards ----------------
 def main_menu_kb():
@@ -126,7 +351,8 @@ def main_menu_kb():
 def wardrobe_menu_kb_dynamic():
     rows = []
     for gid, info in CATEGORY_GROUPS.items():
-        rows.append([InlineKeyboardButton(text=info["label"], callback_data=f"wardrobe_group:{gid}")])
+        rows.append([InlineKeyboardButton(text=info["label"], callback_data=cb_data("wardrobe_group", gid))])
+    rows.append([InlineKeyboardButton(text="🏷 По тегам", callback_data="menu_tags")])
     rows.append([InlineKeyboardButton(text="➕ Добавить вещь", callback_data="wardrobe_add_item"),
                  InlineKeyboardButton(text="🔎 Поиск", callback_data="wardrobe_search")])
     rows.append([InlineKeyboardButton(text="↩️ Назад в меню", callback_data="menu_back")])
@@ -175,9 +401,10 @@ def format_dt(dt):
         return str(dt)
 
 def to_vector_from_bytes(b: Optional[bytes]) -> Optional[np.ndarray]:
-    if b is None:
-        return None
-    return np.frombuffer(b, dtype=np.float32)
+    return embeddings.decode(b)
+
+def emb_to_bytes(vec: np.ndarray) -> bytes:
+    return embeddings.encode(vec, EMB_CODEC)
 
 def cosine_sim(a: Optional[np.ndarray], b: Optional[np.ndarray]) -> float:
     if a is None or b is None:
@@ -191,6 +418,17 @@ async def safe_delete_message(chat_id: int, message_id: int):
             await bot.delete_message(chat_id=chat_id, message_id=message_id)
     except Exception:
         pass
+    await drop_companions(chat_id, message_id)
+
+def add_companions(menu: types.Message, message_ids: List[int]):
+    message_companions[(menu.chat.id, menu.message_id)] = list(message_ids)
+    while len(message_companions) > MESSAGE_COMPANIONS_SIZE:
+        message_companions.popitem(last=False)
+
+async def drop_companions(chat_id: int, message_id: int):
+    """Меню удалили или заменили правкой на другое — сообщения при нём больше не нужны."""
+    for companion_id in message_companions.pop((chat_id, message_id), ()):
+        await safe_delete_message(chat_id, companion_id)
 
 # NEW HELPER: удаляем сохранённое меню, если оно отличается от текущего callback.message
 async def clear_last_menu_if_different(user_id: int, callback_message: Optional[types.Message] = None):
@@ -235,6 +473,7 @@ async def show_menu(user_id: int, callback_msg: Optional[types.Message], text: s
                 text, callback_msg.chat.id, callback_msg.message_id,
                 reply_markup=kb, parse_mode="HTML"
             )
+            await drop_companions(callback_msg.chat.id, callback_msg.message_id)
             last_menu_message[user_id] = {
                 "chat_id": sent.chat.id,
                 "message_id": sent.message_id,
@@ -280,6 +519,7 @@ async def replace_menu_message(user_id: int, callback_message: Optional[types.Me
     if callback_message:
         try:
             sent = await bot.edit_message_text(text, chat_id=callback_message.chat.id, message_id=callback_message.message_id, reply_markup=reply_markup, parse_mode=parse_mode)
+            await drop_companions(callback_message.chat.id, callback_message.message_id)
             last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": typ}
             return sent
         except Exception:
@@ -295,6 +535,7 @@ async def reply_or_edit(original_message: Optional[types.Message], chat_id: int,
     try:
         if original_message and getattr(original_message, "chat", None) and getattr(original_message, "message_id", None):
             await bot.edit_message_text(text=text, chat_id=original_message.chat.id, message_id=original_message.message_id, parse_mode=parse_mode, reply_markup=reply_markup)
+            await drop_companions(original_message.chat.id, original_message.message_id)
             return original_message
     except Exception:
         pass
@@ -358,63 +599,10 @@ async def send_main_menu(user_id: int, text: Optional[str] = None, photo_path: O
     except Exception as e:
         print("send_main_menu fallback failed:", e)
 
-# ---------------- Database helpers ----------------
-async def create_pool_with_retries(dsn: str, attempts: int = 5, delay: float = 2.0):
-    last_exc = None
-    for i in range(attempts):
-        try:
-            pool = await asyncpg.create_pool(dsn, min_size=1, max_size=5)
-            return pool
-        except Exception as e:
-            last_exc = e
-            print(f"[db] connect attempt {i+1}/{attempts} failed: {e}")
-            await asyncio.sleep(delay)
-    print(f"Не удалось подключиться к базе данных: {last_exc}")
-    raise last_exc
-
-async def init_db_and_migrate():
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS wardrobe (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            file_id TEXT NOT NULL,
-            emb BYTEA,
-            name TEXT,
-            color_en TEXT,
-            color_ru TEXT,
-            category_en TEXT,
-            category_ru TEXT,
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
-            description TEXT DEFAULT ''
-        );
-        """)
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS tags (
-            id SERIAL PRIMARY KEY,
-            item_id INTEGER NOT NULL REFERENCES wardrobe(id) ON DELETE CASCADE,
-            user_id BIGINT NOT NULL,
-            tag TEXT NOT NULL
-        );
-        """)
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_tags_item ON tags(item_id);")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_tags_tag_lower ON tags(LOWER(tag));")
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS capsules (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            name TEXT NOT NULL,
-            item_ids INTEGER[] NOT NULL,
-            thumbnail_file_id TEXT,
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
-            description TEXT DEFAULT ''
-        );
-        """)
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_capsules_user ON capsules(user_id);")
-
 # ---------------- CLIP helpers ----------------
 def clip_infer_logits(image_tensor):
-    with torch.no_grad():
+    CLIP_BATCH.labels("category_logits").observe(image_tensor.shape[0])
+    with torch.no_grad(), tracing.child("clip", "category_logits", CLIP_SECONDS.labels("category_logits").observe):
         text_cat = [f"a photo of a {c}" for c in CLOTHING_CATEGORIES]
         text_tokens = clip.tokenize(text_cat).to(device)
         image_features = model.encode_image(image_tensor)
@@ -426,7 +614,8 @@ def clip_infer_logits(image_tensor):
     return cat_logits.cpu()
 
 def clip_color_logits(image_tensor):
-    with torch.no_grad():
+    CLIP_BATCH.labels("color_logits").observe(image_tensor.shape[0])
+    with torch.no_grad(), tracing.child("clip", "color_logits", CLIP_SECONDS.labels("color_logits").observe):
         text_colors = [f"the color is {c}" for c in COLOR_LABELS]
         color_tokens = clip.tokenize(text_colors).to(device)
         image_features = model.encode_image(image_tensor)
@@ -437,101 +626,742 @@ def clip_color_logits(image_tensor):
         color_logits = (image_features @ color_features.t()).squeeze(0) * logit_scale
     return color_logits.cpu()
 
-# ---------------- Capsule generation (улучшенный) ----------------
-async def generate_capsule_items_for_user(user_id: int, candidates_per_group: int = 25) -> Tuple[List[Dict[str, Any]], float]:
-    groups = {
-        "tops": CATEGORY_GROUPS["tops"]["items"],
-        "bottoms": CATEGORY_GROUPS["bottoms"]["items"],
-        "dresses": CATEGORY_GROUPS["dresses"]["items"],
-        "outer": CATEGORY_GROUPS["outer"]["items"],
-        "shoes": CATEGORY_GROUPS["shoes"]["items"],
-        "accessories": CATEGORY_GROUPS["accessories"]["items"]
+def clip_encode_text(prompt: str) -> np.ndarray:
+    """Нормированный эмбеддинг одной текстовой подсказки, float32 (D,)."""
+    with torch.no_grad(), tracing.child("clip", "encode_text", CLIP_SECONDS.labels("encode_text").observe):
+        feats = model.encode_text(clip.tokenize([prompt], truncate=True).to(device))
+        feats = feats / feats.norm(dim=-1, keepdim=True)
+    return feats[0].cpu().numpy().astype(np.float32)
+
+def predict_colors(pil_image: Image.Image, k: int = 1, min_share: float = 0.0) -> List[Tuple[str, float]]:
+    """До k основных цветов вещи по пикселям (color_en, доля) по убыванию; min_share отсекает мелкие."""
+    with tracing.child("color", "dominant_colors", COLOR_SECONDS.observe):
+        found = colors.dominant_colors(pil_image, COLOR_LABELS, min_share=min_share)
+    return found[:k]
+
+def clip_embed_batch(images: List[Image.Image]) -> np.ndarray:
+    """Только нормированные эмбеддинги пачки картинок, float32 (N, D)."""
+    CLIP_BATCH.labels("embed_batch").observe(len(images))
+    with torch.no_grad(), tracing.child("clip", "embed_batch", CLIP_SECONDS.labels("embed_batch").observe):
+        batch = torch.stack([preprocess(im) for im in images]).to(device)
+        feats = model.encode_image(batch)
+        feats = feats / feats.norm(dim=-1, keepdim=True)
+    return feats.cpu().numpy().astype(np.float32)
+
+def clip_analyze_batch(images: List[Image.Image]) -> List[Dict[str, Any]]:
+    """
+    Один проход CLIP по пачке картинок: эмбеддинг, категория и цвет для каждой.
+    Текстовые промпты категорий (и цветов при COLOR_ENGINE=clip) кодируются один раз на всю пачку.
+    """
+    n_cat = len(CLOTHING_CATEGORIES)
+    color_prompts = [f"the color is {c}" for c in COLOR_LABELS] if COLOR_ENGINE == "clip" else []
+    CLIP_BATCH.labels("analyze_batch").observe(len(images))
+    with torch.no_grad(), tracing.child("clip", "analyze_batch", CLIP_SECONDS.labels("analyze_batch").observe):
+        batch = torch.stack([preprocess(im) for im in images]).to(device)
+        image_features = model.encode_image(batch)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        tokens = clip.tokenize([f"a photo of a {c}" for c in CLOTHING_CATEGORIES] + color_prompts).to(device)
+        text_features = model.encode_text(tokens)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        logit_scale = model.logit_scale.exp().to(device)
+        logits = (image_features @ text_features.t()) * logit_scale
+        cat_probs = torch.softmax(logits[:, :n_cat], dim=-1).cpu()
+        color_probs = torch.softmax(logits[:, n_cat:], dim=-1).cpu() if color_prompts else None
+        embs = image_features.cpu().numpy().astype(np.float32)
+
+    results = []
+    for i in range(len(images)):
+        ci = int(torch.argmax(cat_probs[i]).item()); cat_en = CLOTHING_CATEGORIES[ci]
+        if color_probs is not None:
+            colors_found = [(COLOR_LABELS[j], float(p)) for j, p in enumerate(color_probs[i].tolist())]
+            colors_found.sort(key=lambda c: c[1], reverse=True)
+        else:
+            colors_found = predict_colors(images[i], k=len(COLOR_LABELS))
+        color_en, color_conf = colors_found[0]
+        results.append({
+            "emb": embs[i], "emb_bytes": emb_to_bytes(embs[i]),
+            "category_en": cat_en, "category_ru": CATEGORY_MAP.get(cat_en, cat_en), "category_conf": float(cat_probs[i][ci].item()),
+            "color_en": color_en, "color_ru": COLOR_MAP.get(color_en, color_en), "color_conf": color_conf,
+            # полные распределения — для пересчёта по похожим вещам пользователя (apply_label_suggestions)
+            "category_probs": dict(zip(CLOTHING_CATEGORIES, cat_probs[i].tolist())), "colors": colors_found
+        })
+    return results
+
+# ---------------- Label suggestions ----------------
+# Подсказки учатся на том, что пользователь сохранил: вещи с эмбеддингом текущей модели и их название, категория
+# и цвет (в том числе исправленные вручную). Индекс строится при первой подсказке и дальше обновляется
+# при сохранении, исправлении и удалении вещей. Исправления из «Нет — я введу сам(а)» живут только в памяти.
+async def get_label_index(user_id: int) -> suggest.LabelIndex:
+    index = label_indexes.get(user_id)
+    if index is not None:
+        label_indexes.move_to_end(user_id)
+        return index
+    rows = await repo.fetch("label_index_rows", user_id, EMB_MODEL)
+    index = suggest.LabelIndex(capacity=max(64, len(rows)))
+    if rows:
+        mat = embeddings.decode_matrix([r['emb'] for r in rows])
+        for r, vec in zip(rows, mat):
+            index.add(r['id'], vec, name=r['name'], category_en=r['category_en'], color_en=r['color_en'])
+    label_indexes[user_id] = index
+    while len(label_indexes) > KNN_INDEX_USERS:
+        label_indexes.popitem(last=False)
+    return index
+
+async def reload_label_index(user_id: int) -> suggest.LabelIndex:
+    """Индекс заново из БД; исправления из «Нет — я введу сам(а)» переносятся из старого индекса."""
+    old = label_indexes.pop(user_id, None)
+    index = await get_label_index(user_id)
+    if old is not None:
+        keys, labels = old.items(lambda key: not isinstance(key, int))
+        for key, vec, lb in zip(keys, old.vectors(keys), labels):
+            index.add(key, vec, **lb)
+    return index
+
+def remember_labels(user_id: int, item_id: int, vec: Optional[np.ndarray], **labels: Optional[str]):
+    """Новая или исправленная вещь; если индекс ещё не загружен, она попадёт в него из БД."""
+    index = label_indexes.get(user_id)
+    if index is None:
+        return
+    if vec is not None:
+        index.add(item_id, vec, **labels)
+    else:
+        index.update(item_id, **labels)
+
+def forget_labels(user_id: int, item_ids: List[int]):
+    index = label_indexes.get(user_id)
+    if index is not None:
+        for item_id in item_ids:
+            index.remove(item_id)
+
+async def apply_label_suggestions(user_id: int, analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Пересчитывает категорию и цвет разбора clip_analyze_batch по похожим вещам пользователя и задаёт name:
+    название очень близкого соседа (если он был так назван) или категорию. analysis["knn"] — сколько полей
+    поменяли соседи.
+    """
+    analysis["name"] = analysis["category_ru"]; analysis["knn"] = 0
+    try:
+        index = await get_label_index(user_id)
+    except Exception as e:
+        print("label suggestions: index unavailable:", e)
+        return analysis
+    vec = analysis["emb"]
+    votes, best = index.vote(vec, "category_en", KNN_K, KNN_MIN_SIM)
+    if votes:
+        cat_en, conf = suggest.blend(analysis["category_probs"], votes, best, KNN_MIN_SIM, KNN_STRONG_SIM)[0]
+        analysis["knn"] += cat_en != analysis["category_en"]
+        analysis.update(category_en=cat_en, category_ru=CATEGORY_MAP.get(cat_en, cat_en), category_conf=conf, name=CATEGORY_MAP.get(cat_en, cat_en))
+    votes, best = index.vote(vec, "color_en", KNN_K, KNN_MIN_SIM)
+    if votes:
+        ranked = suggest.blend(dict(analysis["colors"]), votes, best, KNN_MIN_SIM, KNN_STRONG_SIM)
+        analysis["knn"] += ranked[0][0] != analysis["color_en"]
+        analysis.update(color_en=ranked[0][0], color_ru=COLOR_MAP.get(ranked[0][0], ranked[0][0]), color_conf=ranked[0][1], colors=ranked)
+    votes, _ = index.vote(vec, "name", KNN_K, KNN_STRONG_SIM)
+    if votes:
+        name, share = max(votes.items(), key=lambda kv: kv[1])
+        if share >= 0.5 and name != analysis["name"]:
+            analysis["name"] = name; analysis["knn"] += 1
+    return analysis
+
+def match_label_text(text: str) -> Dict[str, str]:
+    """Исправление из fb_no_input: цвет или категория, если текст с ними совпал, иначе — название вещи."""
+    t = text.strip().lower(); norm = normalize_russian(text)
+    for en, ru in COLOR_MAP.items():
+        if t in (en, ru) or norm == normalize_russian(ru):
+            return {"color_en": en}
+    for en, ru in CATEGORY_MAP.items():
+        if t in (en, ru) or norm == normalize_russian(ru):
+            return {"category_en": en, "name": ru}
+    return {"name": text.strip()}
+
+# ---------------- Photo download ----------------
+# фото вещей качаются заново для коллажей, перевычисления эмбеддингов и повторного анализа; на диске они лежат
+# по file_unique_id (photos — PhotoCache или None), а getFile для одного file_id зовётся не чаще раза в FILE_PATH_TTL
+photos: Optional[photo_cache.PhotoCache] = None
+
+def open_photo_cache():
+    global photos
+    if not PHOTO_CACHE_DIR:
+        return
+    try:
+        photos = photo_cache.PhotoCache(PHOTO_CACHE_DIR, PHOTO_CACHE_MAX_MB << 20)
+        print(f"Photo cache {PHOTO_CACHE_DIR}: {len(photos)} files, {photos.total_bytes >> 20} MB")
+    except OSError as e:
+        print("photo cache disabled:", e)
+
+def remember_file(file_id: Optional[str], unique_id: Optional[str]):
+    """file_unique_id, известный заранее (из сообщения или строки БД), — чтобы попасть в кэш без getFile."""
+    if not file_id or not unique_id:
+        return
+    info = file_info_cache.get(file_id)
+    if info is None:
+        file_info_cache[file_id] = {"unique_id": unique_id, "file_path": None, "expires": 0.0}
+        while len(file_info_cache) > FILE_INFO_CACHE_SIZE:
+            file_info_cache.popitem(last=False)
+    else:
+        info["unique_id"] = unique_id
+        file_info_cache.move_to_end(file_id)
+
+def remember_files(rows):
+    for r in rows:
+        remember_file(r.get('file_id'), r.get('file_unique_id'))
+
+def known_unique_id(file_id: Optional[str]) -> Optional[str]:
+    info = file_info_cache.get(file_id) if file_id else None
+    return info["unique_id"] if info else None
+
+async def resolve_file(file_id: str) -> Dict[str, Any]:
+    info = file_info_cache.get(file_id)
+    if info is not None and info["file_path"] and info["expires"] > time.monotonic():
+        file_info_cache.move_to_end(file_id)
+        return info
+    known = info is not None and info["unique_id"]
+    file = await bot.get_file(file_id)
+    remember_file(file_id, file.file_unique_id)
+    info = file_info_cache[file_id]
+    info["file_path"] = file.file_path; info["expires"] = time.monotonic() + FILE_PATH_TTL
+    if not known and file.file_unique_id:
+        try:
+            await repo.execute("items_set_unique_id", file_id, file.file_unique_id)
+        except Exception as e:
+            print("resolve_file: file_unique_id backfill failed:", e)
+    return info
+
+async def fetch_photo(file_id: str):
+    """Фото как файловый объект: mmap из дискового кэша или BytesIO только что скачанного (тогда он уже в кэше)."""
+    unique_id = known_unique_id(file_id)
+    if photos is not None and unique_id:
+        buf = photos.get(unique_id)
+        if buf is not None:
+            PHOTO_CACHE_REQUESTS.labels("hit").inc()
+            return buf
+    info = await resolve_file(file_id)
+    if photos is not None and info["unique_id"] != unique_id:
+        buf = photos.get(info["unique_id"])  # file_unique_id узнали только сейчас — файл мог уже быть на диске
+        if buf is not None:
+            PHOTO_CACHE_REQUESTS.labels("hit").inc()
+            return buf
+    PHOTO_CACHE_REQUESTS.labels("miss").inc()
+    # скачивание идёт мимо session-middleware, поэтому меряем отдельно
+    with tracing.child("api", "download_file", API_SECONDS.labels("download_file").observe):
+        bio = io.BytesIO(); await bot.download_file(info["file_path"], bio)
+    if photos is not None:
+        try:
+            with bio.getbuffer() as view:
+                await asyncio.to_thread(photos.put, info["unique_id"], view)
+        except OSError as e:
+            print("photo cache write failed:", e)
+    bio.seek(0)
+    return bio
+
+def decode_rgb(buf) -> Image.Image:
+    # PIL читает прямо из mmap/BytesIO, без промежуточной копии байтов
+    with buf, Image.open(buf) as img:
+        return img.convert("RGB")
+
+# ---------------- Photo admission ----------------
+# анализ фото (скачивание + CLIP) не выполняется в обработчике: апдейт ставит его в photo_queue, сразу отвечает
+# заглушкой с местом в очереди и завершается; фоновая задача потом заменяет заглушку результатом
+photo_queue = admission.AdmissionQueue(ADMISSION_WORKERS, ADMISSION_MAX_BACKLOG, on_wait=ADMISSION_WAIT_SECONDS.observe)
+
+OVERLOADED_TEXT = "Сейчас слишком много фото в обработке. Пришлите это фото чуть позже, пожалуйста 🙏"
+OVERLOADED_ALBUM_TEXT = "Сейчас слишком много фото в обработке. Пришлите этот альбом чуть позже, пожалуйста 🙏"
+
+def queued_text(position: int) -> str:
+    if position == 0:
+        return "⏳ Анализирую фото…"
+    return f"⏳ Фото в очереди на анализ, место: {position}. Результат появится в этом сообщении."
+
+async def admit_photo_job(user_id: int, work: Callable[[Optional[types.Message]], Awaitable[None]],
+                          placeholder: Optional[types.Message] = None) -> bool:
+    """
+    Ставит work в photo_queue и показывает заглушку: новым сообщением или правкой placeholder.
+    work получает сообщение-заглушку (или None, если отправить не удалось). False — очередь полна, ничего не начато.
+    """
+    ready = asyncio.get_running_loop().create_future()
+
+    async def job():
+        tracing.current_span.set(None)  # апдейт, поставивший задачу, к этому времени уже завершён
+        await work(await ready)
+
+    try:
+        position = photo_queue.submit(job)
+    except admission.Overloaded:
+        ADMISSION_REJECTED.inc()
+        return False
+    sent = None
+    try:
+        sent = await reply_or_edit(placeholder, user_id, queued_text(position), reply_markup=None)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        ready.set_result(sent)
+    return True
+
+async def analyze_photo(user_id: int, file_id: str) -> Dict[str, Any]:
+    """Эмбеддинг, категория и цвет одним проходом CLIP, затем поправка по похожим вещам пользователя."""
+    pil_image = await asyncio.to_thread(decode_rgb, await fetch_photo(file_id))
+    analyses = await asyncio.to_thread(clip_analyze_batch, [pil_image])
+    return await apply_label_suggestions(user_id, analyses[0])
+
+async def suggest_for_add(user_id: int, file_id: str, placeholder: Optional[types.Message], intro: str = ""):
+    """Фоновая часть добавления вещи: предложение названия и цвета на месте заглушки."""
+    state = pending_add.get(user_id)
+    try:
+        a = await analyze_photo(user_id, file_id)
+    except Exception:
+        traceback.print_exc()
+        a = None
+    if state is None or pending_add.get(user_id) is not state:
+        # пока фото ждало очереди, добавление отменили или начали заново — ни результат, ни ошибка уже не нужны
+        if placeholder:
+            await safe_delete_message(placeholder.chat.id, placeholder.message_id)
+        return
+    if a is None:
+        state["stage"] = "wait_photo"
+        await reply_or_edit(placeholder, user_id, "Не удалось открыть изображение. Пришлите другое фото.")
+        return
+
+    state.update({
+        "stage": "ready_to_confirm",
+        "file_id": file_id,
+        "emb_bytes": a["emb_bytes"],
+        "suggested_category_en": a["category_en"],
+        "suggested_category_ru": a["category_ru"],
+        "suggested_category_conf": a["category_conf"],
+        "suggested_color_en": a["color_en"],
+        "suggested_color_ru": a["color_ru"],
+        "suggested_color_conf": a["color_conf"],
+        "name": a["name"]
+    })
+    try:
+        sent = await reply_or_edit(
+            placeholder, user_id,
+            f"{intro}Предлагаю категорию/название: <b>{escape(state['name'])}</b> (уверенность {a['category_conf']:.0%}).\n"
+            f"Предлагаю цвет: <b>{escape(a['color_ru'])}</b> (уверенность {a['color_conf']:.0%}).\n\n"
+            "Сначала выбери название: принять или ввести вручную.",
+            reply_markup=kb_name_choice()
+        )
+        state["suggestion_message_id"] = sent.message_id; state["suggestion_chat_id"] = sent.chat.id
+    except Exception:
+        await send_main_menu(user_id, "Предложение готово. Используйте меню.")
+
+async def report_analysis(user_id: int, file_id: str, placeholder: Optional[types.Message]):
+    """Фоновая часть «Проанализировать фото»: категория и цвета на месте заглушки."""
+    try:
+        a = await analyze_photo(user_id, file_id)
+    except Exception:
+        traceback.print_exc()
+        await reply_or_edit(placeholder, user_id, "Не удалось проанализировать фото.")
+        return
+    # у пиксельного движка доля < 10% — это пуговицы и принт, а не цвет вещи
+    top_colors = [(c, p) for c, p in a["colors"][:3] if COLOR_ENGINE == "clip" or p >= 0.1]
+    last_analysis[user_id] = {"emb": a["emb"], "category_en": a["category_en"], "color_en": a["color_en"]}
+    colors_str = ", ".join([f"{COLOR_MAP.get(name, name)} ({p:.0%})" for name, p in top_colors])
+    await reply_or_edit(placeholder, user_id,
+                        f"Я думаю, это: <b>{escape(a['name'])}</b> (уверенность {a['category_conf']:.0%}).\nЦвета: {escape(colors_str)}.",
+                        reply_markup=feedback_kb())
+
+# ---------------- Capsule collage ----------------
+def make_collage_tile(buf, size: int = COLLAGE_TILE) -> Image.Image:
+    with buf, Image.open(buf) as img:
+        # для JPEG декодируем сразу в уменьшенном масштабе — полный размер для клетки не нужен
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+    img.thumbnail((size, size))
+    return img
+
+async def get_collage_tile(file_id: str) -> Image.Image:
+    tile = collage_tile_cache.get(file_id)
+    if tile is not None:
+        collage_tile_cache.move_to_end(file_id)
+        return tile
+    buf = await fetch_photo(file_id)
+    tile = await asyncio.to_thread(make_collage_tile, buf)
+    collage_tile_cache[file_id] = tile
+    while len(collage_tile_cache) > COLLAGE_TILE_CACHE_SIZE:
+        collage_tile_cache.popitem(last=False)
+    return tile
+
+def render_collage(tiles: List[Image.Image], tile_size: int = COLLAGE_TILE, gap: int = COLLAGE_GAP) -> bytes:
+    """Собирает клетки в почти квадратную сетку и возвращает JPEG."""
+    cols = max(1, math.ceil(math.sqrt(len(tiles))))
+    rows = math.ceil(len(tiles) / cols)
+    canvas = Image.new("RGB", (cols * tile_size + (cols + 1) * gap, rows * tile_size + (rows + 1) * gap), COLLAGE_BG)
+    for i, t in enumerate(tiles):
+        r, c = divmod(i, cols)
+        x = gap + c * (tile_size + gap) + (tile_size - t.width) // 2
+        y = gap + r * (tile_size + gap) + (tile_size - t.height) // 2
+        canvas.paste(t, (x, y))
+    out = io.BytesIO()
+    canvas.save(out, format="JPEG", quality=85, optimize=True)
+    return out.getvalue()
+
+async def build_capsule_collage(file_ids: List[str]) -> Optional[bytes]:
+    """
+    Коллаж из фото вещей капсулы. Картинки скачиваются параллельно (и берутся из collage_tile_cache, если уже были),
+    декодирование и отрисовка идут в отдельном потоке, чтобы не блокировать event loop.
+    Вещи, которые не удалось скачать, пропускаются; если не получилось ни одной — None.
+    """
+    if not file_ids:
+        return None
+    results = await asyncio.gather(*(get_collage_tile(f) for f in file_ids), return_exceptions=True)
+    tiles = [t for t in results if isinstance(t, Image.Image)]
+    if not tiles:
+        return None
+    return await asyncio.to_thread(render_collage, tiles)
+
+CAPTION_LIMIT = 1024  # символов видимого текста в подписи к фото (у сообщения — 4096)
+
+def split_caption(text: str, limit: int = CAPTION_LIMIT) -> Tuple[str, str]:
+    """
+    HTML-текст -> (подпись, остаток). Режется по строкам, чтобы не разорвать теги; длина считается
+    по видимому тексту, как у Telegram. Остаток пустой, если текст помещается в подпись целиком.
+    """
+    lines = text.split("\n")
+    visible = 0
+    for i, line in enumerate(lines):
+        visible += len(unescape(re.sub(r"<[^>]+>", "", line))) + (1 if i else 0)
+        if visible > limit:
+            if i == 0:
+                return "", text
+            return "\n".join(lines[:i]), "\n".join(lines[i:]).strip("\n")
+    return text, ""
+
+async def send_capsule_photo(user_id: int, file_ids: List[str], caption: str, kb,
+                             cached_file_id: Optional[str] = None) -> Tuple[Optional[types.Message], Optional[str]]:
+    """
+    Отправляет капсулу одним фото: уже загруженный коллаж (cached_file_id) или рисует и загружает новый.
+    Текст длиннее подписи уходит следом отдельным сообщением с кнопками — тогда возвращается оно, а фото
+    удаляется вместе с ним (message_companions).
+    Возвращает (сообщение, file_id коллажа) или (None, None), если фото отправить не удалось.
+    """
+    head, rest = split_caption(caption)
+    photo_kb = None if rest else kb
+    sent, file_id = None, None
+    if cached_file_id:
+        try:
+            sent = await bot.send_photo(user_id, photo=cached_file_id, caption=head or None, parse_mode="HTML", reply_markup=photo_kb)
+            file_id = cached_file_id
+        except Exception as e:
+            print("send_capsule_photo: cached thumbnail failed, re-rendering:", e)
+    if sent is None:
+        try:
+            collage = await build_capsule_collage(file_ids)
+            if not collage:
+                return None, None
+            sent = await bot.send_photo(user_id, photo=BufferedInputFile(collage, filename="capsule.jpg"),
+                                        caption=head or None, parse_mode="HTML", reply_markup=photo_kb)
+            file_id = sent.photo[-1].file_id
+        except Exception as e:
+            print("send_capsule_photo: collage failed:", e)
+            return None, None
+    if rest:
+        photo = sent
+        try:
+            sent = await bot.send_message(user_id, rest, parse_mode="HTML", reply_markup=kb)
+        except Exception:
+            await safe_delete_message(photo.chat.id, photo.message_id)
+            raise
+        add_companions(sent, [photo.message_id])
+    return sent, file_id
+
+# ---------------- Item card ----------------
+# Вещь и её теги одним запросом (repository: item_card) — теги собираются в массивы LATERAL-подзапросом
+
+def render_item_card(item_id: int, row) -> Dict[str, Any]:
+    name = row['name'] or '-'; color_ru = row['color_ru'] or '-'; category_ru = row['category_ru'] or '-'
+    description = row['description'] or ''
+    tags = list(zip(row['tag_ids'], row['tags']))
+    caption_lines = [
+        f"<b>{escape(name)}</b>",
+        f"Цвет: {escape(color_ru)}",
+        f"Категория: {escape(category_ru)}",
+        f"Добавлено: {escape(format_dt(row['created_at']))}"
+    ]
+    if description:
+        caption_lines.append(f"\nОписание: {escape(description)}")
+    if tags:
+        caption_lines.append(f"\nТеги: {escape(', '.join(t for _, t in tags))}")
+
+    # короткая подпись для просмотра вещи из сохранённой капсулы
+    caption_short = f"<b>{escape(name)}</b>\nЦвет: {escape(color_ru)}\nКатегория: {escape(category_ru)}"
+    if description:
+        caption_short += f"\nОписание: {escape(description)}"
+    if tags:
+        caption_short += f"\nТеги: {escape(', '.join(t for _, t in tags))}"
+
+    return {
+        "item_id": item_id,
+        "file_id": row['file_id'],
+        "name": row['name'],
+        "caption": "\n".join(caption_lines),
+        "caption_short": caption_short,
+        "tag_rows": [[InlineKeyboardButton(text=f"❌ {t}", callback_data=cb_data("delete_tag", tid))] for tid, t in tags],
+        "kb": {}
     }
 
-    async with db_pool.acquire() as conn:
-        async def fetch_candidates(categories):
-            if not categories:
-                return []
-            rows = await conn.fetch(
-                "SELECT id, file_id, name, color_ru, category_en, emb FROM wardrobe WHERE user_id=$1 AND category_en = ANY($2::text[]) AND emb IS NOT NULL LIMIT $3",
-                user_id, categories, candidates_per_group
-            )
-            items = []
-            for r in rows:
-                vec = to_vector_from_bytes(r['emb'])
-                if vec is None:
-                    continue
-                items.append({
-                    "id": r['id'],
-                    "file_id": r['file_id'],
-                    "name": r['name'] or "",
-                    "color_ru": r['color_ru'] or "",
-                    "category_en": r['category_en'] or "",
-                    "emb_vec": vec
-                })
-            return items
-
-        candidates = {k: await fetch_candidates(v) for k, v in groups.items()}
-
-    selected: List[Dict[str, Any]] = []
-
-    if candidates.get("dresses"):
-        selected.append(candidates["dresses"][0])
+def item_card_kb(card: Dict[str, Any], context: str, cap_id: Optional[int] = None) -> InlineKeyboardMarkup:
+    """
+    Клавиатура карточки для места, откуда её открыли:
+      list — из списка гардероба, capsule — из текущей капсулы, saved_capsule — из сохранённой капсулы,
+      edit — после правки тегов.
+    Готовые клавиатуры кешируются в самой карточке.
+    """
+    key = (context, cap_id)
+    kb = card["kb"].get(key)
+    if kb is not None:
+        return kb
+    item_id = card["item_id"]
+    actions = [
+        [InlineKeyboardButton(text="Добавить тег ➕", callback_data=cb_data("add_tag", item_id)),
+         InlineKeyboardButton(text="Добавить описание ✍️", callback_data=cb_data("add_desc", item_id))],
+        [InlineKeyboardButton(text="С чем носить 👗", callback_data=cb_data("item_matches", item_id)),
+         InlineKeyboardButton(text="Удалить вещь ❌", callback_data=cb_data("delete_item", item_id))]
+    ]
+    if context == "saved_capsule":
+        rows = [[InlineKeyboardButton(text="↩️ Назад в капсулу", callback_data=cb_data("view_capsule", cap_id))]]
+    elif context == "list":
+        rows = actions + [[InlineKeyboardButton(text="Назад к списку ↩️", callback_data="menu_wardrobe")]] + card["tag_rows"]
+    elif context == "capsule":
+        rows = actions + [[InlineKeyboardButton(text="↩️ Вернуться в капсулу", callback_data="back_to_capsule")]] \
+               + card["tag_rows"] + [[InlineKeyboardButton(text="Закрыть", callback_data="close_view")]]
     else:
-        tops = candidates.get("tops", [])
-        bottoms = candidates.get("bottoms", [])
-        best_pair = (None, None, -999.0)
-        for t in tops:
-            for b in bottoms:
-                s = cosine_sim(t['emb_vec'], b['emb_vec'])
-                if s > best_pair[2]:
-                    best_pair = (t, b, s)
-        if best_pair[0] and best_pair[1]:
-            selected.append(best_pair[0]); selected.append(best_pair[1])
-        else:
+        rows = actions + card["tag_rows"] + [[InlineKeyboardButton(text="Закрыть", callback_data="close_view")]]
+    kb = InlineKeyboardMarkup(inline_keyboard=rows)
+    card["kb"][key] = kb
+    return kb
+
+async def load_item_card(user_id: int, item_id: int, db: Optional[repository.Session] = None) -> Optional[Dict[str, Any]]:
+    """Карточка вещи пользователя (подписи + кнопки тегов) из item_card_cache или одним запросом из БД."""
+    key = (user_id, item_id)
+    card = item_card_cache.get(key)
+    if card is not None:
+        item_card_cache.move_to_end(key)
+        return card
+    row = await (db or repo).fetchrow("item_card", item_id, user_id)
+    if not row:
+        return None
+    card = render_item_card(item_id, row)
+    item_card_cache[key] = card
+    while len(item_card_cache) > ITEM_CARD_CACHE_SIZE:
+        item_card_cache.popitem(last=False)
+    return card
+
+def invalidate_item_card(user_id: int, item_id: int):
+    """Вызывать после любых записей, меняющих карточку: теги, описание, удаление вещи."""
+    search_indexes.pop(user_id, None)
+    tag_vocab_cache.pop(user_id, None)
+    item_card_cache.pop((user_id, item_id), None)
+
+# ---------------- Compatibility graph ----------------
+# Что с чем сочетается (compat.py): у каждой вещи в item_neighbors лежат top-K ближайших вещей каждой другой группы
+# категорий. Граф пользователя строится целиком один раз — при первой капсуле, после смены модели эмбеддингов или K —
+# и дальше правится по одной вещи: сохранение, смена категории, удаление. Векторы и категории берутся из индекса
+# подсказок (get_label_index) — он уже в памяти и следит за теми же изменениями.
+COMPAT_GROUPS = [g for g, info in CATEGORY_GROUPS.items() if info["items"]]
+GROUP_OF_CATEGORY = {cat: g for g in COMPAT_GROUPS for cat in CATEGORY_GROUPS[g]["items"]}
+
+def compat_items(user_id: int, index: suggest.LabelIndex) -> Dict[str, Any]:
+    """
+    Вещи индекса с известной группой: ids и groups (выровнены), pools — группа -> список id. Векторы берутся
+    из индекса по id. Пересчитывается, только если индекс изменился (LabelIndex.version).
+    """
+    cached = compat_pools.get(user_id)
+    if cached is not None and cached["index"] is index and cached["version"] == index.version:
+        compat_pools.move_to_end(user_id)
+        return cached
+    keys, labels = index.items(lambda key: isinstance(key, int))
+    pairs = [(key, GROUP_OF_CATEGORY[lb["category_en"]]) for key, lb in zip(keys, labels)
+             if lb.get("category_en") in GROUP_OF_CATEGORY]
+    ids = np.array([k for k, _ in pairs], dtype=np.int32)
+    groups = np.array([g for _, g in pairs], dtype=object)
+    pools = {g: [] for g in COMPAT_GROUPS}
+    for key, g in pairs:
+        pools[g].append(key)
+    cached = compat_pools[user_id] = {"index": index, "version": index.version, "ids": ids, "groups": groups, "pools": pools}
+    while len(compat_pools) > KNN_INDEX_USERS:
+        compat_pools.popitem(last=False)
+    return cached
+
+async def save_compat_rows(db, user_id: int, rows: List[Tuple[int, str, compat.Neighbours]]):
+    if rows:
+        await db.execute("compat_upsert", user_id, [int(r[0]) for r in rows], [r[1] for r in rows],
+                         [compat.encode(*r[2]) for r in rows])
+
+async def compat_graph_ready(user_id: int) -> bool:
+    # всегда по БД (запрос по первичному ключу): строку состояния удаляет и импорт wardrobe_transfer в другом процессе
+    return bool(await repo.fetchval("compat_state", user_id, EMB_MODEL, COMPAT_TOP_K))
+
+async def rebuild_compat_graph(user_id: int):
+    # вещи могли прийти в обход бота (импорт) — индекс перечитывается из БД
+    index = await reload_label_index(user_id)
+    items = compat_items(user_id, index)
+    ids, groups = items["ids"], items["groups"]
+    mat = index.vectors(ids.tolist())
+    rows = await asyncio.to_thread(
+        lambda: [(i, g, (nb_ids, nb_sims)) for i, g, nb_ids, nb_sims in compat.build(mat, ids, groups, COMPAT_TOP_K)])
+    async with repo.transaction() as db:
+        await db.execute("compat_clear", user_id)
+        await save_compat_rows(db, user_id, rows)
+        await db.execute("compat_mark_built", user_id, EMB_MODEL, COMPAT_TOP_K)
+
+async def ensure_compat_graph(user_id: int):
+    if not await compat_graph_ready(user_id):
+        await rebuild_compat_graph(user_id)
+
+async def compat_add_item(user_id: int, item_id: int):
+    """Новая вещь: её списки (одно умножение матрицы на вектор) и она сама в списках вещей других групп."""
+    if not await compat_graph_ready(user_id):
+        return  # графа ещё нет — вещь войдёт в него при полной сборке
+    index = await get_label_index(user_id)
+    items = compat_items(user_id, index)
+    ids, groups = items["ids"], items["groups"]
+    found = np.flatnonzero(ids == item_id)
+    if not len(found):
+        return  # нет эмбеддинга текущей модели или категория вне групп
+    own = groups[int(found[0])]
+    sims = index.similarity(index.vectors([item_id])[0], ids.tolist())
+    rows = [(item_id, g, nb) for g, nb in compat.neighbours_of(sims, ids, groups, own, COMPAT_TOP_K, exclude=item_id).items()]
+    lists = {r['item_id']: compat.decode(r['neighbors']) for r in await repo.fetch("compat_group_rows", user_id, [own])}
+    for j in np.flatnonzero(groups != own):
+        other = int(ids[j])
+        merged = compat.insert(*lists.get(other, compat.EMPTY), item_id, float(sims[j]), COMPAT_TOP_K)
+        if merged is not None:
+            rows.append((other, own, merged))
+    async with repo.transaction() as db:
+        await save_compat_rows(db, user_id, rows)
+
+async def compat_remove_items(user_id: int, item_ids: List[int], groups):
+    """
+    Вещи удалены или ушли из своей группы: списки, где они были, пересчитываются по индексу (вызывать после
+    forget_labels / remember_labels). Собственные строки удалённых вещей уходят из item_neighbors каскадом.
+    """
+    groups = sorted({g for g in groups if g in GROUP_OF_CATEGORY.values()})
+    if not item_ids or not groups or not await compat_graph_ready(user_id):
+        return
+    index = await get_label_index(user_id)
+    pools = compat_items(user_id, index)["pools"]
+    members = {g: np.array(pools[g], dtype=np.int32) for g in groups}
+    rows = []
+    for r in await repo.fetch("compat_group_rows", user_id, groups):
+        nb_ids, _ = compat.decode(r['neighbors'])
+        if r['item_id'] not in index or not compat.contains_any(nb_ids, item_ids):
+            continue
+        pool = members[r['grp']]
+        sims = index.similarity(index.vectors([r['item_id']])[0], pool.tolist())
+        rows.append((r['item_id'], r['grp'], compat.top_k(sims, pool, COMPAT_TOP_K)))
+    async with repo.transaction() as db:
+        await save_compat_rows(db, user_id, rows)
+
+async def compat_move_item(user_id: int, item_id: int, old_group: Optional[str]):
+    """Категория вещи сменила группу: убрать её из старой группы и вставить заново."""
+    if not await compat_graph_ready(user_id):
+        return
+    await repo.execute("compat_drop_items", user_id, [item_id])
+    await compat_remove_items(user_id, [item_id], [old_group])
+    await compat_add_item(user_id, item_id)
+
+async def update_compat_graph(user_id: int, work: Awaitable[None]):
+    """Ошибка правки графа не роняет сохранение или удаление: граф помечается устаревшим и соберётся заново."""
+    try:
+        await work
+    except Exception:
+        traceback.print_exc()
+        try:
+            await repo.execute("compat_invalidate", [user_id])
+        except Exception:
+            pass
+
+async def compat_lists(user_id: int, item_ids: List[int], groups: List[str]) -> Dict[Tuple[int, str], compat.Neighbours]:
+    rows = await repo.fetch("compat_lists", user_id, [int(i) for i in item_ids], groups)
+    return {(r['item_id'], r['grp']): compat.decode(r['neighbors']) for r in rows}
+
+async def matching_items(user_id: int, item_id: int, per_group: int = 2) -> List[Tuple[str, List[Any]]]:
+    """«С чем носить»: по per_group лучших вещей каждой другой группы — (группа, строки вещей) в порядке COMPAT_GROUPS."""
+    await ensure_compat_graph(user_id)
+    lists = await compat_lists(user_id, [item_id], COMPAT_GROUPS)
+    picked = {g: [int(i) for i in lists[(item_id, g)][0][:per_group]] for g in COMPAT_GROUPS if (item_id, g) in lists}
+    wanted = [i for ids in picked.values() for i in ids]
+    if not wanted:
+        return []
+    by_id = {r['id']: r for r in await repo.fetch("capsule_items", user_id, wanted)}
+    return [(g, [by_id[i] for i in ids if i in by_id]) for g, ids in picked.items() if any(i in by_id for i in ids)]
+
+# ---------------- Capsule generation ----------------
+# Капсула — поиск по готовым спискам графа совместимости: основа — платье или лучшая пара верх + низ (первый сосед
+# из списка «низ» у нескольких случайных верхов), затем в каждом слоте (верхняя одежда, обувь, аксессуары) вещь
+# с наибольшим средним косинусом к основе по спискам её вещей. Верхи берутся случайно — «Перегенерировать»
+# даёт другой набор.
+CAPSULE_SIM_THRESHOLD = 0.18
+
+async def generate_capsule_items_for_user(user_id: int, candidates_per_group: int = 25) -> Tuple[List[Dict[str, Any]], float]:
+    index = await get_label_index(user_id)
+    pools = compat_items(user_id, index)["pools"]
+    if not any(pools.values()):
+        return [], 0.0
+    await ensure_compat_graph(user_id)
+
+    selected: List[int] = []
+    if pools["dresses"]:
+        selected.append(random.choice(pools["dresses"]))
+    else:
+        tops = random.sample(pools["tops"], min(len(pools["tops"]), candidates_per_group))
+        if tops and pools["bottoms"]:
+            lists = await compat_lists(user_id, tops, ["bottoms"])
+            best = max(((float(nb_sims[0]), top, int(nb_ids[0])) for (top, _), (nb_ids, nb_sims) in lists.items()
+                        if len(nb_ids)), default=None)
+            if best:
+                selected += [best[1], best[2]]
+        if not selected:
             if tops:
                 selected.append(tops[0])
-            elif bottoms:
-                selected.append(bottoms[0])
-
-    def centroid(vectors: List[np.ndarray]) -> Optional[np.ndarray]:
-        if not vectors:
-            return None
-        arr = np.vstack(vectors)
-        c = np.mean(arr, axis=0)
-        norm = np.linalg.norm(c) + 1e-8
-        return c / norm
-
-    SIM_THRESHOLD = 0.18
-
-    for slot in ("outer", "shoes", "accessories"):
-        pool = candidates.get(slot, []) or []
-        if not pool:
-            continue
-        cent = centroid([s['emb_vec'] for s in selected]) if selected else None
-        best_cand = None; best_score = -999.0
-        for cand in pool:
-            score = cosine_sim(cand['emb_vec'], cent) if cent is not None else 0.0
-            if score > best_score:
-                best_score = score; best_cand = cand
-        if best_cand and best_score >= SIM_THRESHOLD:
-            selected.append(best_cand)
+            elif pools["bottoms"]:
+                selected.append(pools["bottoms"][0])
+
+    slots = [s for s in ("outer", "shoes", "accessories") if pools[s]]
+    if selected and slots:
+        base = list(selected)
+        lists = await compat_lists(user_id, base, slots)
+        for slot in slots:
+            scores: Dict[int, float] = {}
+            for anchor in base:
+                nb_ids, nb_sims = lists.get((anchor, slot), compat.EMPTY)
+                for cand, sim in zip(nb_ids.tolist(), nb_sims.tolist()):
+                    scores[cand] = scores.get(cand, 0.0) + sim / len(base)
+            if scores:
+                cand, score = max(scores.items(), key=lambda kv: kv[1])
+                if score >= CAPSULE_SIM_THRESHOLD:
+                    selected.append(cand)
 
     if len(selected) < 2:
-        for k in ("tops","bottoms","dresses","outer","shoes","accessories"):
-            if candidates.get(k):
-                selected.append(candidates[k][0])
-                if len(selected) >= 2: break
+        for g in ("tops", "bottoms", "dresses", "outer", "shoes", "accessories"):
+            if pools[g] and pools[g][0] not in selected:
+                selected.append(pools[g][0])
+                if len(selected) >= 2:
+                    break
 
     avg_pair_sim = 0.0
     if len(selected) >= 2:
-        sims = []
-        for i in range(len(selected)):
-            for j in range(i+1, len(selected)):
-                sims.append(cosine_sim(selected[i]['emb_vec'], selected[j]['emb_vec']))
-        avg_pair_sim = float(np.mean(sims)) if sims else 0.0
-
-    return selected, avg_pair_sim
+        vecs = index.vectors(selected)
+        sims = (vecs @ vecs.T)[np.triu_indices(len(selected), k=1)]
+        avg_pair_sim = float(np.mean(sims))
+
+    rows = await repo.fetch("capsule_items", user_id, selected)
+    remember_files(rows)
+    by_id = {r['id']: r for r in rows}
+    items = []
+    for item_id in selected:
+        r = by_id.get(item_id)
+        if r is not None:
+            items.append({
+                "id": r['id'],
+                "file_id": r['file_id'],
+                "name": r['name'] or "",
+                "color_ru": r['color_ru'] or "",
+                "category_en": r['category_en'] or ""
+            })
+    return items, avg_pair_sim
 
 # ---------------- send capsule ----------------
 async def send_capsule(user_id: int, force_regen: bool = False):
@@ -559,7 +1389,6 @@ async def send_capsule(user_id: int, force_regen: bool = False):
         if not sel:
             continue
         # переставим случайно — чтобы уменьшить шанс идентичности
-        import random
         random.shuffle(sel)
 
         sel_ids = [int(r['id']) for r in sel]
@@ -583,26 +1412,29 @@ async def send_capsule(user_id: int, force_regen: bool = False):
 
     kb_rows = []
     try:
-        kb_rows.extend(two_buttons_from_items(selected, lambda r: f"view_item_from_capsule:{r['id']}"))
+        kb_rows.extend(two_buttons_from_items(selected, lambda r: cb_data("view_item_from_capsule", r['id'])))
     except Exception:
         for r in selected:
-            kb_rows.append([InlineKeyboardButton(text=r.get('name') or "(без названия)", callback_data=f"view_item_from_capsule:{r['id']}")])
+            kb_rows.append([InlineKeyboardButton(text=r.get('name') or "(без названия)", callback_data=cb_data("view_item_from_capsule", r['id']))])
 
     kb_rows.append([InlineKeyboardButton(text="💾 Сохранить капсулу", callback_data="save_capsule"),
                     InlineKeyboardButton(text="🔁 Перегенерировать", callback_data="generate_capsule")])
     kb_rows.append([InlineKeyboardButton(text="❌ Закрыть", callback_data="close_capsule")])
     kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
 
-    # отправка/редактирование сообщения
-    preview_file = selected[0].get('file_id') if selected and selected[0].get('file_id') else None
-    if preview_file:
-        sent = await bot.send_photo(user_id, photo=preview_file, caption=text, parse_mode="HTML", reply_markup=kb)
-    else:
-        sent = await bot.send_message(user_id, text, parse_mode="HTML", reply_markup=kb)
+    # отправка: коллаж из всех вещей одним фото; его file_id потом станет thumbnail сохранённой капсулы
+    sent, thumbnail = await send_capsule_photo(user_id, [r['file_id'] for r in selected if r.get('file_id')], text, kb)
+    if not sent:
+        preview_file = selected[0].get('file_id') if selected and selected[0].get('file_id') else None
+        if preview_file:
+            sent = await bot.send_photo(user_id, photo=preview_file, caption=text, parse_mode="HTML", reply_markup=kb)
+        else:
+            sent = await bot.send_message(user_id, text, parse_mode="HTML", reply_markup=kb)
 
     pending_capsule[user_id] = {
         "items": [{"id": r['id'], "name": r['name'], "file_id": r.get('file_id'), "category_en": r.get('category_en')} for r in selected],
-        "avg_sim": avg_sim, "text": text, "chat_id": sent.chat.id, "message_id": sent.message_id, "created": datetime.now(timezone.utc)
+        "avg_sim": avg_sim, "text": text, "chat_id": sent.chat.id, "message_id": sent.message_id, "created": datetime.now(timezone.utc),
+        "thumbnail": thumbnail, "thumbnail_item_ids": [int(r['id']) for r in selected] if thumbnail else None
     }
     last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "capsule"}
 
@@ -623,7 +1455,7 @@ async def cmd_start(message: types.Message):
 @dp.message(Command(commands=["help"]))
 async def cmd_help(message: types.Message):
     await send_main_menu(message.from_user.id, HELP_TEXT)
-@dp.callback_query(lambda c: c.data == "save_capsule")
+@callback_router.route("save_capsule")
 async def save_capsule_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     cap = pending_capsule.get(user_id)
@@ -640,7 +1472,8 @@ async def save_capsule_callback(callback: types.CallbackQuery):
     pending_action[user_id] = {
         "action": "save_capsule_with_name",
         "items": item_ids,
-        "thumbnail": thumbnail
+        "thumbnail": thumbnail,
+        "thumbnail_item_ids": cap.get("thumbnail_item_ids")
     }
 
     # очистим клавиатуру у текущего сообщения (если нужно) и попросим имя
@@ -665,6 +1498,7 @@ async def text_router(message: types.Message):
         pending_action.pop(user_id, None)
         pending_photo_offer.pop(user_id, None)
         pending_capsule.pop(user_id, None)
+        wardrobe_selection.pop(user_id, None)
         # можно расширить на другие стейты, если нужно
 
         await send_main_menu(user_id, "Операция отменена.")
@@ -679,38 +1513,61 @@ async def text_router(message: types.Message):
             if not tag:
                 await bot.send_message(user_id, "Тег не может быть пустым. Введите текст или /cancel.")
                 return
-            async with db_pool.acquire() as conn:
-                exists = await conn.fetchval("SELECT 1 FROM tags WHERE item_id=$1 AND LOWER(tag)=LOWER($2) LIMIT 1", item_id, tag)
-                if exists:
-                    await bot.send_message(user_id, f"Тег «{escape(tag)}» уже есть.")
-                else:
-                    await conn.execute("INSERT INTO tags(item_id, user_id, tag) VALUES ($1, $2, $3)", item_id, user_id, tag)
-                    await bot.send_message(user_id, f"Тег «{escape(tag)}» добавлен.")
+            exists = await repo.fetchval("tag_insert", item_id, user_id, tag) is None
+            if exists:
+                await bot.send_message(user_id, f"Тег «{escape(tag)}» уже есть.")
+            else:
+                invalidate_item_card(user_id, item_id)
+                await bot.send_message(user_id, f"Тег «{escape(tag)}» добавлен.")
+            pending_action.pop(user_id, None); return
+
+        if action == "batch_tag":
+            tag = text.strip()
+            if not tag:
+                await bot.send_message(user_id, "Тег не может быть пустым. Введите текст или /cancel.")
+                return
+            async with repo.transaction() as db:
+                rows = await db.fetch("tags_insert_many", user_id, pa["item_ids"], tag)
+            changed = sorted({r['item_id'] for r in rows})
+            forget_selected(user_id, changed)
+            skipped = len(pa["item_ids"]) - len(changed)
+            note = f" (у {skipped} уже был)" if skipped else ""
+            await bot.send_message(user_id, f"Тег «{escape(tag)}» добавлен к вещам: {len(changed)}{note}.")
             pending_action.pop(user_id, None); return
 
         if action == "add_desc":
             item_id = pa.get("item_id"); desc = text.strip()
-            async with db_pool.acquire() as conn:
-                found = await conn.fetchval("SELECT 1 FROM wardrobe WHERE id=$1 AND user_id=$2", item_id, user_id)
-                if not found:
-                    await bot.send_message(user_id, "Вещь не найдена или нет прав.")
-                else:
-                    await conn.execute("UPDATE wardrobe SET description=$1 WHERE id=$2 AND user_id=$3", desc, item_id, user_id)
-                    await bot.send_message(user_id, "Описание сохранено.")
+            async with repo.session() as db:
+                found = await db.fetchval("item_exists", item_id, user_id)
+                if found:
+                    await db.execute("item_set_description", desc, item_id, user_id)
+            if not found:
+                await bot.send_message(user_id, "Вещь не найдена или нет прав.")
+            else:
+                invalidate_item_card(user_id, item_id)
+                await bot.send_message(user_id, "Описание сохранено.")
             pending_action.pop(user_id, None); return
 
+        if action == "label_feedback":
+            # исправление разбора фото: запоминаем как подсказку для похожих фото этого пользователя
+            labels = {"category_en": pa.get("category_en"), "color_en": pa.get("color_en"), **match_label_text(text)}
+            try:
+                index = await get_label_index(user_id)
+                index.add(("feedback", message.message_id), pa["emb"], **labels)
+            except Exception as e:
+                print("label_feedback failed:", e)
+            pending_action.pop(user_id, None)
+            await send_main_menu(user_id, "Спасибо, запомню для похожих фото.")
+            return
+
         if action == "save_capsule_with_name":
             name = text.strip()
             if not name:
                 await bot.send_message(user_id, "Имя не может быть пустым. Введите ещё раз или /cancel.")
                 return
             items = pa.get("items", []); thumbnail = pa.get("thumbnail")
-            async with db_pool.acquire() as conn:
-                row = await conn.fetchrow("""
-                    INSERT INTO capsules (user_id, name, item_ids, thumbnail_file_id, created_at)
-                    VALUES ($1, $2, $3, $4, $5)
-                    RETURNING id
-                """, user_id, name, items, thumbnail, datetime.now(timezone.utc))
+            await repo.fetchval("capsule_insert", user_id, name, items, thumbnail, pa.get("thumbnail_item_ids"),
+                                datetime.now(timezone.utc))
             pending_action.pop(user_id, None)
             pending_capsule.pop(user_id, None)
             await send_main_menu(user_id, f"Капсула <b>{escape(name)}</b> сохранена ✅")
@@ -867,7 +1724,7 @@ async def text_router(message: types.Message):
             return
 
     await send_main_menu(user_id, "Не распознал команду. Используйте меню ниже.")
-@dp.callback_query(lambda c: c.data == "search_continue")
+@callback_router.route("search_continue")
 async def search_continue_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     # переводим пользователя в режим ввода текста для нового поиска
@@ -881,7 +1738,7 @@ async def search_continue_callback(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "search_end")
+@callback_router.route("search_end")
 async def search_end_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     # завершаем режим поиска
@@ -903,59 +1760,25 @@ async def on_photo(message: types.Message):
 
     photo = message.photo[-1]
     file_id = photo.file_id
+    remember_file(file_id, photo.file_unique_id)
 
-    if state and state.get("stage") == "wait_photo":
-        try:
-            file = await bot.get_file(file_id)
-            bio = io.BytesIO(); await bot.download_file(file.file_path, bio); bio.seek(0)
-            pil_image = Image.open(bio).convert("RGB")
-        except Exception:
-            await bot.send_message(user_id, "Не удалось открыть изображение. Пришлите другое фото.")
-            return
-
-        image_input = preprocess(pil_image).unsqueeze(0).to(device)
-        with torch.no_grad():
-            emb = model.encode_image(image_input); emb = emb / emb.norm(dim=-1, keepdim=True)
-        emb_bytes = emb.cpu().numpy().astype(np.float32).tobytes()
-
-        cat_logits = clip_infer_logits(image_input); cat_probs = torch.softmax(cat_logits, dim=0)
-        top_idx = int(torch.argmax(cat_probs).item()); top_cat_en = CLOTHING_CATEGORIES[top_idx]; top_cat_ru = CATEGORY_MAP.get(top_cat_en, top_cat_en); top_cat_conf = float(cat_probs[top_idx].item())
-        color_logits = clip_color_logits(image_input); color_probs = torch.softmax(color_logits, dim=0)
-        top_color_vals = torch.topk(color_probs, k=1); top_color_en = COLOR_LABELS[int(top_color_vals.indices[0])]
-        top_color_ru = COLOR_MAP.get(top_color_en, top_color_en); top_color_conf = float(top_color_vals.values[0])
-
-        state.update({
-            "stage": "ready_to_confirm",
-            "file_id": file_id,
-            "emb_bytes": emb_bytes,
-            "suggested_category_en": top_cat_en,
-            "suggested_category_ru": top_cat_ru,
-            "suggested_category_conf": top_cat_conf,
-            "suggested_color_en": top_color_en,
-            "suggested_color_ru": top_color_ru,
-            "suggested_color_conf": top_color_conf,
-            "name": f"{top_cat_ru}"
-        })
+    # альбом — массовый импорт одним сообщением-итогом (см. Bulk album import)
+    if message.media_group_id:
+        collect_album_photo(message)
+        return
 
-        try:
-            sent = await bot.send_message(
-                user_id,
-                f"Предлагаю категорию/название: <b>{escape(state['name'])}</b> (уверенность {top_cat_conf:.0%}).\n"
-                f"Предлагаю цвет: <b>{escape(top_color_ru)}</b> (уверенность {top_color_conf:.0%}).\n\n"
-                "Сначала выбери название: принять или ввести вручную.",
-                parse_mode="HTML",
-                reply_markup=kb_name_choice()
-            )
-            state["suggestion_message_id"] = sent.message_id; state["suggestion_chat_id"] = sent.chat.id
-        except Exception:
-            await send_main_menu(user_id, "Предложение готово. Используйте меню.")
+    if state and state.get("stage") == "wait_photo":
+        state["stage"] = "analyzing"  # следующее фото, пока это в очереди, не запускает второй анализ
+        if not await admit_photo_job(user_id, lambda placeholder: suggest_for_add(user_id, file_id, placeholder)):
+            state["stage"] = "wait_photo"
+            await bot.send_message(user_id, OVERLOADED_TEXT)
         return
 
     # if not in add flow -> offer actions
     offer_msg = "Вы прислали фото. Хотите добавить его в гардероб или проанализировать?"
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Добавить в гардероб", callback_data=f"offer_add:{file_id}")],
-        [InlineKeyboardButton(text="🔍 Проанализировать фото", callback_data=f"offer_analyze:{file_id}")],
+        [InlineKeyboardButton(text="➕ Добавить в гардероб", callback_data=cb_data("offer_add", file_id))],
+        [InlineKeyboardButton(text="🔍 Проанализировать фото", callback_data=cb_data("offer_analyze", file_id))],
         [InlineKeyboardButton(text="❌ Отменить", callback_data="offer_cancel")]
     ])
     sent = await bot.send_message(user_id, offer_msg, reply_markup=kb)
@@ -965,15 +1788,198 @@ async def on_photo(message: types.Message):
     except Exception:
         pass
 
+# ---------------- Bulk album import ----------------
+def collect_album_photo(message: types.Message):
+    """Копит фото одного альбома; импорт стартует, когда новые фото группы перестали приходить."""
+    key = (message.from_user.id, message.media_group_id)
+    buf = album_buffers.get(key)
+    if buf is None:
+        buf = album_buffers[key] = {"photos": [], "task": None}
+    photo = message.photo[-1]
+    remember_file(photo.file_id, photo.file_unique_id)
+    buf["photos"].append((message.message_id, photo.file_id))
+    if buf["task"]:
+        buf["task"].cancel()
+    buf["task"] = asyncio.create_task(flush_album_later(key))
+
+async def flush_album_later(key: Tuple[int, str]):
+    await asyncio.sleep(ALBUM_COLLECT_DELAY)
+    buf = album_buffers.pop(key, None)
+    if not buf:
+        return
+    user_id = key[0]
+    file_ids = [fid for _, fid in sorted(buf["photos"])]
+
+    async def work(placeholder: Optional[types.Message]):
+        try:
+            await import_album(user_id, file_ids, placeholder)
+        except Exception:
+            traceback.print_exc()
+            await reply_or_edit(placeholder, user_id, "Не удалось импортировать альбом. Попробуйте ещё раз.")
+
+    # альбом — одна задача photo_queue (до 10 фото одним батчем CLIP), наравне с одиночными фото
+    if not await admit_photo_job(user_id, work):
+        await bot.send_message(user_id, OVERLOADED_ALBUM_TEXT)
+
+async def import_album(user_id: int, file_ids: List[str], placeholder: Optional[types.Message] = None):
+    """
+    Массовый импорт: параллельная загрузка (не больше ALBUM_DOWNLOAD_CONCURRENCY одновременно),
+    один батч через CLIP, одна вставка всех строк. В ответ — одно сообщение-итог с кнопками исправления категорий
+    (на месте заглушки photo_queue, если она есть).
+    """
+    # альбом в режиме добавления заменяет обычный поток «одна вещь»
+    if (pending_add.get(user_id) or {}).get("stage") == "wait_photo":
+        pending_add.pop(user_id, None)
+    await clear_last_menu_if_different(user_id)
+    status = await reply_or_edit(placeholder, user_id, f"Импортирую {len(file_ids)} фото…")
+
+    sem = asyncio.Semaphore(ALBUM_DOWNLOAD_CONCURRENCY)
+
+    async def fetch(fid: str) -> Image.Image:
+        async with sem:
+            buf = await fetch_photo(fid)
+        return await asyncio.to_thread(decode_rgb, buf)
+
+    results = await asyncio.gather(*(fetch(fid) for fid in file_ids), return_exceptions=True)
+    loaded = [(fid, img) for fid, img in zip(file_ids, results) if isinstance(img, Image.Image)]
+    failed = len(file_ids) - len(loaded)
+    if not loaded:
+        await reply_or_edit(status, user_id, "Не удалось открыть ни одного фото из альбома.")
+        return
+
+    analyses = await asyncio.to_thread(clip_analyze_batch, [img for _, img in loaded])
+    for a in analyses:
+        await apply_label_suggestions(user_id, a)
+
+    created_at = datetime.now(timezone.utc)
+    cols = {k: [] for k in ("file_id", "file_unique_id", "emb", "name", "color_en", "color_ru", "category_en", "category_ru")}
+    for (fid, _), a in zip(loaded, analyses):
+        cols["file_id"].append(fid); cols["file_unique_id"].append(known_unique_id(fid)); cols["emb"].append(a["emb_bytes"]); cols["name"].append(a["name"])
+        cols["color_en"].append(a["color_en"]); cols["color_ru"].append(a["color_ru"])
+        cols["category_en"].append(a["category_en"]); cols["category_ru"].append(a["category_ru"])
+    # одна set-based вставка всего альбома; RETURNING нужен для кнопок исправления в итоговом сообщении
+    rows = await repo.fetch("items_insert_bulk", user_id, cols["file_id"], cols["emb"], cols["name"], cols["color_en"],
+                            cols["color_ru"], cols["category_en"], cols["category_ru"], created_at, EMB_MODEL,
+                            cols["file_unique_id"])
+    # одно фото может прийти в альбоме дважды — строки сопоставляются по позиции, не по file_id:
+    # id выдаются из последовательности в порядке ORDER BY ord, значит по возрастанию id — в порядке вставки
+    ids = sorted(r['id'] for r in rows)
+    search_indexes.pop(user_id, None)
+    for item_id, a in zip(ids, analyses):
+        remember_labels(user_id, item_id, a["emb"], name=a["name"], category_en=a["category_en"], color_en=a["color_en"])
+
+    items = []
+    for item_id, (fid, _), a in zip(ids, loaded, analyses):
+        items.append({"id": item_id, "file_id": fid, "category_en": a["category_en"], "category_ru": a["category_ru"],
+                      "category_conf": a["category_conf"], "color_ru": a["color_ru"], "color_conf": a["color_conf"]})
+    pending_album[user_id] = {"items": items, "failed": failed, "chat_id": status.chat.id, "message_id": status.message_id}
+    await show_album_summary(user_id)
+    if await compat_graph_ready(user_id):
+        for item in items:
+            await update_compat_graph(user_id, compat_add_item(user_id, item["id"]))
+
+def album_summary_view(album: Dict[str, Any]) -> Tuple[str, InlineKeyboardMarkup]:
+    lines = [f"📥 <b>Добавлено вещей: {len(album['items'])}</b>"]
+    if album.get("failed"):
+        lines.append(f"Не удалось открыть фото: {album['failed']}")
+    lines.append("")
+    kb_rows = []
+    for i, it in enumerate(album["items"], 1):
+        lines.append(f"{i}. {escape(it['category_ru'])} ({it['category_conf']:.0%}) — {escape(it['color_ru'])} ({it['color_conf']:.0%})")
+        kb_rows.append([InlineKeyboardButton(text=f"✏️ {i}. {it['category_ru']}", callback_data=cb_data("album_fix", it["id"]))])
+    lines.append("\nЕсли категория определена неверно — нажмите на вещь и выберите правильную.")
+    kb_rows.append([InlineKeyboardButton(text="✅ Всё верно", callback_data="album_done"),
+                    InlineKeyboardButton(text="🗑 Отменить импорт", callback_data="album_undo")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=kb_rows)
+
+async def show_album_summary(user_id: int, origin: Optional[types.Message] = None):
+    album = pending_album.get(user_id)
+    if not album:
+        return
+    text, kb = album_summary_view(album)
+    target = origin
+    if target is None:
+        try:
+            await bot.edit_message_text(text, chat_id=album["chat_id"], message_id=album["message_id"], parse_mode="HTML", reply_markup=kb)
+            last_menu_message[user_id] = {"chat_id": album["chat_id"], "message_id": album["message_id"], "type": "album_summary"}
+            return
+        except Exception:
+            pass
+    sent = await reply_or_edit(target, user_id, text, reply_markup=kb)
+    album.update({"chat_id": sent.chat.id, "message_id": sent.message_id})
+    last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "album_summary"}
+
+@callback_router.route("album_fix", fields=(int,))
+async def album_fix_callback(callback: types.CallbackQuery, item_id: int):
+    user_id = callback.from_user.id
+    album = pending_album.get(user_id)
+    item = next((it for it in (album or {}).get("items", []) if it["id"] == item_id), None)
+    if not item:
+        await callback.answer("Импорт уже закрыт.", show_alert=True); return
+    kb_rows = []
+    row = []
+    for idx, cat in enumerate(CLOTHING_CATEGORIES):
+        row.append(InlineKeyboardButton(text=CATEGORY_MAP.get(cat, cat), callback_data=cb_data("album_setcat", item_id, idx)))
+        if len(row) == 3:
+            kb_rows.append(row); row = []
+    if row:
+        kb_rows.append(row)
+    kb_rows.append([InlineKeyboardButton(text="↩️ Назад", callback_data="album_back")])
+    await reply_or_edit(callback.message, user_id, f"Выберите категорию для «{escape(item['category_ru'])}»:",
+                        reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
+    await callback.answer()
+
+@callback_router.route("album_setcat", fields=(int, int))
+async def album_setcat_callback(callback: types.CallbackQuery, item_id: int, cat_idx: Optional[int]):
+    user_id = callback.from_user.id
+    album = pending_album.get(user_id)
+    item = next((it for it in (album or {}).get("items", []) if it["id"] == item_id), None)
+    if not item or cat_idx is None or not 0 <= cat_idx < len(CLOTHING_CATEGORIES):
+        await callback.answer("Импорт уже закрыт.", show_alert=True); return
+    cat_en = CLOTHING_CATEGORIES[cat_idx]; cat_ru = CATEGORY_MAP.get(cat_en, cat_en)
+    await repo.execute("item_set_category", cat_en, cat_ru, item_id, user_id)
+    invalidate_item_card(user_id, item_id)
+    remember_labels(user_id, item_id, None, category_en=cat_en)
+    old_group = GROUP_OF_CATEGORY.get(item["category_en"])
+    item.update({"category_en": cat_en, "category_ru": cat_ru, "category_conf": 1.0})
+    await show_album_summary(user_id, callback.message)
+    await callback.answer("Категория исправлена")
+    if GROUP_OF_CATEGORY.get(cat_en) != old_group:
+        await update_compat_graph(user_id, compat_move_item(user_id, item_id, old_group))
+
+@callback_router.route("album_back")
+async def album_back_callback(callback: types.CallbackQuery):
+    await show_album_summary(callback.from_user.id, callback.message)
+    await callback.answer()
+
+@callback_router.route("album_done", "album_undo")
+async def album_finish_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    album = pending_album.pop(user_id, None)
+    if not album:
+        await callback.answer(); return
+    if callback.data == "album_undo":
+        ids = [it["id"] for it in album["items"]]
+        await repo.execute("items_delete", user_id, ids)
+        forget_labels(user_id, ids)
+        for item_id in ids:
+            invalidate_item_card(user_id, item_id)
+        await update_compat_graph(user_id, compat_remove_items(
+            user_id, ids, [GROUP_OF_CATEGORY.get(it["category_en"]) for it in album["items"]]))
+        text = "Импорт отменён, вещи удалены."
+    else:
+        text = f"Готово ✅ В гардероб добавлено вещей: {len(album['items'])}."
+    if callback.message:
+        await safe_delete_message(callback.message.chat.id, callback.message.message_id)
+    last_menu_message.pop(user_id, None)
+    await send_main_menu(user_id, text)
+    await callback.answer()
+
 # ---------------- Offer callbacks ----------------
-@dp.callback_query(lambda c: c.data and c.data.startswith("view_saved_cap_item:"))
-async def view_saved_cap_item(callback: types.CallbackQuery):
-    # Разбираем данные: view_saved_cap_item:ID_ВЕЩИ:ID_КАПСУЛЫ
-    try:
-        parts = callback.data.split(":")
-        item_id = int(parts[1])
-        cap_id = int(parts[2])
-    except (IndexError, ValueError):
+@callback_router.route("view_saved_cap_item", fields=(int, int))
+async def view_saved_cap_item(callback: types.CallbackQuery, item_id: int, cap_id: Optional[int]):
+    # view_saved_cap_item:ID_ВЕЩИ:ID_КАПСУЛЫ
+    if cap_id is None:
         await callback.answer("Ошибка данных кнопки", show_alert=True)
         return
 
@@ -989,131 +1995,68 @@ async def view_saved_cap_item(callback: types.CallbackQuery):
         last_menu_message.pop(user_id, None)
 
     # 2. Грузим вещь
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT file_id, name, color_ru, category_ru, description FROM wardrobe WHERE id=$1 AND user_id=$2",
-            item_id, user_id
-        )
-        tags = await conn.fetch("SELECT tag FROM tags WHERE item_id=$1", item_id)
+    card = await load_item_card(user_id, item_id)
 
-    if not row:
+    if not card:
         await callback.answer("Вещь не найдена.", show_alert=True)
         # Если вещи нет, пробуем вернуть в капсулу
-        back_cb = types.CallbackQuery(id=callback.id, from_user=callback.from_user, message=callback.message,
-                                      data=f"view_capsule:{cap_id}")
-        await general_callback_router(back_cb)
+        await view_capsule_callback(callback, cap_id)
         return
 
-    # 3. Формируем карточку
-    caption = f"<b>{escape(row['name'] or '-')}</b>\n" \
-              f"Цвет: {escape(row['color_ru'] or '-')}\n" \
-              f"Категория: {escape(row['category_ru'] or '-')}"
+    # 3. Карточка, кнопка НАЗАД ведет обратно в view_capsule:{cap_id}
+    kb = item_card_kb(card, "saved_capsule", cap_id)
 
-    if row['description']:
-        caption += f"\nОписание: {escape(row['description'])}"
-    if tags:
-        caption += f"\nТеги: {escape(', '.join(t['tag'] for t in tags))}"
-
-    # 4. Кнопка НАЗАД ведет обратно в view_capsule:{cap_id}
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="↩️ Назад в капсулу", callback_data=f"view_capsule:{cap_id}")]
-    ])
-
-    # 5. Отправляем фото
-    sent = await bot.send_photo(user_id, photo=row['file_id'], caption=caption, parse_mode="HTML", reply_markup=kb)
+    # 4. Отправляем фото
+    sent = await bot.send_photo(user_id, photo=card['file_id'], caption=card['caption_short'], parse_mode="HTML", reply_markup=kb)
 
     # Запоминаем это сообщение, чтобы потом его можно было удалить при выходе
     last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "item_view_saved"}
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("ask_del_cap:"))
-async def ask_delete_capsule(callback: types.CallbackQuery):
-    cap_id = int(callback.data.split(":", 1)[1])
+@callback_router.route("ask_del_cap", fields=(int,))
+async def ask_delete_capsule(callback: types.CallbackQuery, cap_id: int):
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🗑 Да, удалить", callback_data=f"delete_capsule_confirm:{cap_id}")],
-        [InlineKeyboardButton(text="Нет, оставить", callback_data=f"view_capsule:{cap_id}")]
+        [InlineKeyboardButton(text="🗑 Да, удалить", callback_data=cb_data("delete_capsule_confirm", cap_id))],
+        [InlineKeyboardButton(text="Нет, оставить", callback_data=cb_data("view_capsule", cap_id))]
     ])
 
+    # Капсула показана фото-коллажем — его нельзя отредактировать в текст, поэтому удаляем и шлём вопрос заново
+    origin = callback.message
+    if origin and origin.photo:
+        await safe_delete_message(origin.chat.id, origin.message_id)
+        last_menu_message.pop(callback.from_user.id, None)
+        origin = None
+
     # Редактируем текущее сообщение с капсулой на вопрос о подтверждении
     await replace_menu_message(
         callback.from_user.id,
-        callback.message,
+        origin,
         "<b>Вы уверены, что хотите удалить эту капсулу?</b>",
         reply_markup=kb,
         typ="capsule_delete_confirm"
     )
     await callback.answer()
-@dp.callback_query(lambda c: c.data and c.data.startswith("offer_"))
-async def offer_callbacks(callback: types.CallbackQuery):
+@callback_router.route("offer_add", "offer_analyze", "offer_cancel", fields=(TokenField,))
+async def offer_callbacks(callback: types.CallbackQuery, file_id: Optional[str] = None):
+    # file_id приходит из серверного токена: сам file_id в 64 байта callback_data не всегда помещается
     data = callback.data; user_id = callback.from_user.id
+    # заглушкой анализа становится само сообщение с предложением — результат появится на его месте
     if data.startswith("offer_add:"):
-        file_id = data.split(":",1)[1]
-        pending_add[user_id] = {"stage":"wait_photo"}
-        try:
-            file = await bot.get_file(file_id)
-            bio = io.BytesIO(); await bot.download_file(file.file_path, bio); bio.seek(0)
-            pil_image = Image.open(bio).convert("RGB")
-            image_input = preprocess(pil_image).unsqueeze(0).to(device)
-            with torch.no_grad():
-                emb = model.encode_image(image_input); emb = emb / emb.norm(dim=-1, keepdim=True)
-            emb_bytes = emb.cpu().numpy().astype(np.float32).tobytes()
-            cat_logits = clip_infer_logits(image_input); cat_probs = torch.softmax(cat_logits, dim=0)
-            top_idx = int(torch.argmax(cat_probs).item()); top_cat_en = CLOTHING_CATEGORIES[top_idx]; top_cat_ru = CATEGORY_MAP.get(top_cat_en, top_cat_en); top_cat_conf = float(cat_probs[top_idx].item())
-            color_logits = clip_color_logits(image_input); color_probs = torch.softmax(color_logits, dim=0)
-            top_color_vals = torch.topk(color_probs, k=1); top_color_en = COLOR_LABELS[int(top_color_vals.indices[0])]
-            top_color_ru = COLOR_MAP.get(top_color_en, top_color_en); top_color_conf = float(top_color_vals.values[0])
-
-            entry = pending_add[user_id]
-            entry.update({
-                "stage":"ready_to_confirm",
-                "file_id": file_id,
-                "emb_bytes": emb_bytes,
-                "suggested_category_en": top_cat_en,
-                "suggested_category_ru": top_cat_ru,
-                "suggested_category_conf": top_cat_conf,
-                "suggested_color_en": top_color_en,
-                "suggested_color_ru": top_color_ru,
-                "suggested_color_conf": top_color_conf,
-                "name": f"{top_cat_ru}"
-            })
-            offer = pending_photo_offer.pop(user_id, None)
-            if offer:
-                try: await safe_delete_message(offer["chat_id"], offer["offer_message_id"])
-                except Exception: pass
-
-            sent = await bot.send_message(user_id,
-                f"Добавляем в гардероб. Предлагаю категорию/название: <b>{escape(entry['name'])}</b> (уверенность {top_cat_conf:.0%}).\n"
-                f"Предлагаю цвет: <b>{escape(top_color_ru)}</b> (уверенность {top_color_conf:.0%}).\n\n"
-                "Сначала выбери название: принять или ввести вручную.",
-                parse_mode="HTML",
-                reply_markup=kb_name_choice()
-            )
-            entry["suggestion_message_id"] = sent.message_id; entry["suggestion_chat_id"] = sent.chat.id
-        except Exception:
-            await bot.send_message(user_id, "Не удалось обработать фото для добавления.")
+        pending_add[user_id] = {"stage": "analyzing"}
+        if not await admit_photo_job(user_id, lambda placeholder: suggest_for_add(
+                user_id, file_id, placeholder, intro="Добавляем в гардероб. "), placeholder=callback.message):
+            pending_add.pop(user_id, None)
+            await callback.answer(OVERLOADED_TEXT, show_alert=True); return
+        pending_photo_offer.pop(user_id, None)
         await callback.answer(); return
 
     if data.startswith("offer_analyze:"):
-        file_id = data.split(":",1)[1]
-        try:
-            file = await bot.get_file(file_id)
-            bio = io.BytesIO(); await bot.download_file(file.file_path, bio); bio.seek(0)
-            pil_image = Image.open(bio).convert("RGB")
-            image_input = preprocess(pil_image).unsqueeze(0).to(device)
-            cat_logits = clip_infer_logits(image_input); cat_probs = torch.softmax(cat_logits, dim=0)
-            top_idx = int(torch.argmax(cat_probs).item()); top_cat_en = CLOTHING_CATEGORIES[top_idx]; top_cat_ru = CATEGORY_MAP.get(top_cat_en, top_cat_en); top_cat_conf = float(cat_probs[top_idx].item())
-            color_logits = clip_color_logits(image_input); color_probs = torch.softmax(color_logits, dim=0)
-            top_color_vals = torch.topk(color_probs, k=3); top_colors = [(COLOR_LABELS[int(i)], float(p)) for i, p in zip(top_color_vals.indices, top_color_vals.values)]
-            colors_str = ", ".join([f"{COLOR_MAP.get(name, name)} ({p:.0%})" for name, p in top_colors])
-            offer = pending_photo_offer.pop(user_id, None)
-            if offer:
-                try: await safe_delete_message(offer["chat_id"], offer["offer_message_id"])
-                except Exception: pass
-            await bot.send_message(user_id, f"Я думаю, это: <b>{escape(top_cat_ru)}</b> (уверенность {top_cat_conf:.0%}).\nЦвета: {escape(colors_str)}.", parse_mode="HTML", reply_markup=feedback_kb())
-        except Exception:
-            await bot.send_message(user_id, "Не удалось проанализировать фото.")
+        if not await admit_photo_job(user_id, lambda placeholder: report_analysis(user_id, file_id, placeholder),
+                                     placeholder=callback.message):
+            await callback.answer(OVERLOADED_TEXT, show_alert=True); return
+        pending_photo_offer.pop(user_id, None)
         await callback.answer(); return
 
     if data == "offer_cancel":
@@ -1126,7 +2069,7 @@ async def offer_callbacks(callback: types.CallbackQuery):
     await callback.answer()
 
 # ---------------- Wardrobe menu and viewing ----------------
-@dp.callback_query(lambda c: c.data == "menu_wardrobe")
+@callback_router.route("menu_wardrobe")
 async def menu_wardrobe(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
@@ -1140,7 +2083,7 @@ async def menu_wardrobe(callback: types.CallbackQuery):
         last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "wardrobe_menu"}
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "wardrobe_add_item")
+@callback_router.route("wardrobe_add_item")
 async def wardrobe_add_item(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     pending_add[user_id] = {"stage": "wait_photo"}
@@ -1153,7 +2096,7 @@ async def wardrobe_add_item(callback: types.CallbackQuery):
     await bot.send_message(user_id, "Пришлите фото вещи, чтобы добавить.", reply_markup=None)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "wardrobe_search")
+@callback_router.route("wardrobe_search")
 async def wardrobe_search(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     pending_add[user_id] = {"stage":"wait_search_text"}
@@ -1167,10 +2110,9 @@ async def wardrobe_search(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("wardrobe_group:"))
-async def wardrobe_group_callback(callback: types.CallbackQuery):
-    # Получаем название группы (tops, shoes и т.д.)
-    group_id = callback.data.split(":", 1)[1]
+@callback_router.route("wardrobe_group", fields=(str,))
+async def wardrobe_group_callback(callback: types.CallbackQuery, group_id: str):
+    # group_id — название группы (tops, shoes и т.д.)
     user_id = callback.from_user.id
 
     # Если нажали "Все вещи", сбрасываем фильтр
@@ -1182,28 +2124,27 @@ async def wardrobe_group_callback(callback: types.CallbackQuery):
 
 
 async def show_wardrobe_list(origin_message: Optional[types.Message], user_id: int, page: int = 0,
-                             page_size: int = PAGE_SIZE, group: Optional[str] = None):
+                             page_size: int = PAGE_SIZE, group: Optional[str] = None, select: bool = False):
+    """select=True — режим выбора (см. Wardrobe selection): галочки вместо карточек и кнопки пакетных действий."""
     offset = page * page_size
-    async with db_pool.acquire() as conn:
-        # Если выбрана конкретная группа и в ней есть список категорий
-        if group and group in CATEGORY_GROUPS and CATEGORY_GROUPS[group]["items"]:
-            items = CATEGORY_GROUPS[group]["items"]
-            rows = await conn.fetch(
-                "SELECT id, name, color_ru, category_ru FROM wardrobe WHERE user_id=$1 AND category_en = ANY($2::text[]) ORDER BY created_at DESC LIMIT $3 OFFSET $4",
-                user_id, items, page_size, offset
-            )
-            total = await conn.fetchval(
-                "SELECT COUNT(*) FROM wardrobe WHERE user_id=$1 AND category_en = ANY($2::text[])", user_id, items)
-            title = CATEGORY_GROUPS[group]["label"]
-        else:
-            # Иначе показываем всё
-            rows = await conn.fetch(
-                "SELECT id, name, color_ru, category_ru FROM wardrobe WHERE user_id=$1 ORDER BY created_at DESC LIMIT $2 OFFSET $3",
-                user_id, page_size, offset
-            )
-            total = await conn.fetchval("SELECT COUNT(*) FROM wardrobe WHERE user_id=$1", user_id)
-            title = "Все вещи"
-            group = None  # Сбрасываем group если он был некорректным или "all"
+    # страница и общее число — два чтения на одном соединении
+    # Если выбрана конкретная группа и в ней есть список категорий
+    if group and group in CATEGORY_GROUPS and CATEGORY_GROUPS[group]["items"]:
+        items = CATEGORY_GROUPS[group]["items"]
+        rows, total = await repo.read_many(("fetch", "wardrobe_page_group", user_id, items, page_size, offset),
+                                           ("fetchval", "wardrobe_count_group", user_id, items))
+        title = CATEGORY_GROUPS[group]["label"]
+    else:
+        # Иначе показываем всё
+        rows, total = await repo.read_many(("fetch", "wardrobe_page", user_id, page_size, offset),
+                                           ("fetchval", "wardrobe_count", user_id))
+        title = "Все вещи"
+        group = None  # Сбрасываем group если он был некорректным или "all"
+
+    if not rows and page > 0:
+        # страница опустела (вещи удалили) — показываем последнюю непустую
+        return await show_wardrobe_list(origin_message, user_id, (total - 1) // page_size if total else 0,
+                                        page_size, group, select)
 
     if not rows and page == 0:
         msg_text = f"В категории «{title}» пока пусто." if group else "Твой гардероб пока пуст — добавь вещи через «Добавить вещь»."
@@ -1215,51 +2156,301 @@ async def show_wardrobe_list(origin_message: Optional[types.Message], user_id: i
             await bot.send_message(user_id, msg_text, reply_markup=wardrobe_menu_kb_dynamic())
         return
 
+    sel = wardrobe_selection.get(user_id) if select else None
+    if sel is not None:
+        sel.update({"page": page, "group": group, "page_ids": [rec['id'] for rec in rows]})
+
     inline_rows = []
     for rec in rows:
         item_id = rec['id'];
         name = rec['name'] or '-';
         color = rec['color_ru'] or ''
         text = f"{name} — {color}"
-        inline_rows.append([InlineKeyboardButton(text=text, callback_data=f"view_item:{item_id}")])
+        if sel is not None:
+            mark = "✅" if item_id in sel["ids"] else "⬜"
+            inline_rows.append([InlineKeyboardButton(text=f"{mark} {text}", callback_data=cb_data("select_toggle", item_id))])
+        else:
+            inline_rows.append([InlineKeyboardButton(text=text, callback_data=cb_data("view_item", item_id))])
 
-    inline_rows.append([InlineKeyboardButton(text="↩️ Назад в меню", callback_data="menu_wardrobe")])
+    if sel is not None:
+        inline_rows.extend(selection_action_rows(sel))
+    else:
+        inline_rows.append([InlineKeyboardButton(text="☑️ Выбрать несколько", callback_data=cb_data("select_start", page, group))])
+        inline_rows.append([InlineKeyboardButton(text="↩️ Назад в меню", callback_data="menu_wardrobe")])
 
     # --- ЛОГИКА ПАГИНАЦИИ (ИСПРАВЛЕННАЯ) ---
     nav_buttons = []
     # Добавляем group в callback_data, если он есть. Формат: wardrobe_page:PAGE:GROUP
-    group_suffix = f":{group}" if group else ""
+    nav_action = "select_page" if sel is not None else "wardrobe_page"
 
     if page > 0:
         nav_buttons.append(
-            InlineKeyboardButton(text="◀️ Назад", callback_data=f"wardrobe_page:{page - 1}{group_suffix}"))
+            InlineKeyboardButton(text="◀️ Назад", callback_data=cb_data(nav_action, page - 1, group)))
     if (page + 1) * page_size < (total or 0):
         nav_buttons.append(
-            InlineKeyboardButton(text="▶️ Вперед", callback_data=f"wardrobe_page:{page + 1}{group_suffix}"))
+            InlineKeyboardButton(text="▶️ Вперед", callback_data=cb_data(nav_action, page + 1, group)))
 
     if nav_buttons:
         inline_rows.append(nav_buttons)
 
     kb = InlineKeyboardMarkup(inline_keyboard=inline_rows)
 
-    await replace_menu_message(user_id, origin_message, f"{title} — страница {page + 1}:", reply_markup=kb,
-                               typ="wardrobe_list")
-
+    header = f"{title} — страница {page + 1}:"
+    if sel is not None:
+        header = f"{title} — страница {page + 1}, выбрано: {len(sel['ids'])}.\nОтметьте вещи и выберите действие."
+    await replace_menu_message(user_id, origin_message, header, reply_markup=kb, typ="wardrobe_list")
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("wardrobe_page:"))
-async def wardrobe_page_callback(callback: types.CallbackQuery):
-    parts = callback.data.split(":")
-    page = int(parts[1])
-    group = parts[2] if len(parts) > 2 else None
 
+@callback_router.route("wardrobe_page", fields=(int, str))
+async def wardrobe_page_callback(callback: types.CallbackQuery, page: int, group: Optional[str]):
     user_id = callback.from_user.id
     await callback.answer()
     await show_wardrobe_list(callback.message or callback.from_user, user_id, page=page, group=group)
 
+# ---------------- Tag filter ----------------
+# «По тегам»: словарь тегов пользователя с числом вещей (один GROUP BY по idx_tags_user_lower) живёт в
+# tag_vocab_cache до первой правки тегов; вещи с тегом листаются по ключу item_id (новые сверху), без OFFSET.
+async def get_tag_vocabulary(user_id: int) -> List[Any]:
+    vocab = tag_vocab_cache.get(user_id)
+    if vocab is not None:
+        tag_vocab_cache.move_to_end(user_id)
+        return vocab
+    vocab = await repo.fetch("tag_vocabulary", user_id)
+    tag_vocab_cache[user_id] = vocab
+    while len(tag_vocab_cache) > TAG_VOCAB_CACHE_SIZE:
+        tag_vocab_cache.popitem(last=False)
+    return vocab
+
+async def load_tag_page(user_id: int, key: str, after: Optional[int] = None,
+                        before: Optional[int] = None) -> Tuple[List[Any], bool, bool]:
+    """Как load_capsule_page: (строки, есть ли страница новее, есть ли страница старше)."""
+    n = PAGE_SIZE
+    if before is not None:
+        rows = await repo.fetch("tag_items_before", user_id, key, before, n + 1)
+        return list(reversed(rows[:n])), len(rows) > n, True
+    if after is not None:
+        rows = await repo.fetch("tag_items_after", user_id, key, after, n + 1)
+        return rows[:n], True, len(rows) > n
+    rows = await repo.fetch("tag_items_first", user_id, key, n + 1)
+    return rows[:n], False, len(rows) > n
+
+@callback_router.route("menu_tags")
+async def menu_tags_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    await callback.answer()
+    vocab = await get_tag_vocabulary(user_id)
+    if not vocab:
+        await replace_menu_message(user_id, callback.message, "Тегов пока нет — их можно добавить в карточке вещи.",
+                                   reply_markup=wardrobe_menu_kb_dynamic(), typ="wardrobe_menu")
+        return
+    shown = vocab[:TAG_MENU_SIZE]
+    kb_rows = two_buttons_from_items([{"name": f"{r['tag']} ({r['items']})", "key": r['key']} for r in shown],
+                                     lambda r: cb_data("tag_items", r["key"]))
+    kb_rows.append([InlineKeyboardButton(text="↩️ Назад в меню", callback_data="menu_wardrobe")])
+    text = "Выберите тег:"
+    if len(vocab) > len(shown):
+        text = f"Самые частые теги ({len(shown)} из {len(vocab)}); остальные найдутся через «Поиск»:"
+    await replace_menu_message(user_id, callback.message, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows),
+                               typ="wardrobe_menu")
+
+@callback_router.route("tag_items", fields=(TokenField,))
+async def tag_items_callback(callback: types.CallbackQuery, key: str):
+    await show_tag_items(callback, key)
+
+@callback_router.route("tag_items_next", "tag_items_prev", fields=(TokenField, int))
+async def tag_items_page_callback(callback: types.CallbackQuery, key: str, item_id: int):
+    if callback.data.startswith("tag_items_next:"):
+        await show_tag_items(callback, key, after=item_id)
+    else:
+        await show_tag_items(callback, key, before=item_id)
+
+async def show_tag_items(callback: types.CallbackQuery, key: str, after: Optional[int] = None,
+                         before: Optional[int] = None):
+    user_id = callback.from_user.id
+    await callback.answer()
+    rows, has_newer, has_older = await load_tag_page(user_id, key, after=after, before=before)
+    if not rows and (after or before):
+        rows, has_newer, has_older = await load_tag_page(user_id, key)
+    vocab = {r['key']: r for r in await get_tag_vocabulary(user_id)}
+    entry = vocab.get(key)
+    if not rows or entry is None:
+        await replace_menu_message(user_id, callback.message, "С этим тегом вещей уже нет.",
+                                   reply_markup=wardrobe_menu_kb_dynamic(), typ="wardrobe_menu")
+        return
+    kb_rows = [[InlineKeyboardButton(text=f"{r['name'] or '-'} — {r['color_ru'] or ''}", callback_data=cb_data("view_item", r['id']))]
+               for r in rows]
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=cb_data("tag_items_prev", key, rows[0]['id'])))
+    if has_older:
+        nav.append(InlineKeyboardButton(text="▶️ Вперед", callback_data=cb_data("tag_items_next", key, rows[-1]['id'])))
+    if nav:
+        kb_rows.append(nav)
+    kb_rows.append([InlineKeyboardButton(text="↩️ К тегам", callback_data="menu_tags")])
+    await replace_menu_message(user_id, callback.message, f"🏷 {escape(entry['tag'])} — вещей: {entry['items']}",
+                               reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows), typ="wardrobe_list")
+
+# ---------------- Wardrobe selection (batch edit) ----------------
+# Режим выбора в списке гардероба: галочка переключается правкой того же сообщения, выбор (до SELECTION_MAX вещей,
+# в том числе с разных страниц) живёт в wardrobe_selection. Удаление, добавление и снятие тега применяются
+# ко всем выбранным вещам одним set-based запросом в одной транзакции.
+SELECTION_MAX = 100
+SELECTION_TAGS_SHOWN = 12
+
+def selection_action_rows(sel: Dict[str, Any]) -> List[List[InlineKeyboardButton]]:
+    n = len(sel["ids"])
+    rows = [[InlineKeyboardButton(text="☑️ Вся страница", callback_data="select_page_all"),
+             InlineKeyboardButton(text="Снять выбор", callback_data="select_clear")]]
+    if n:
+        rows.append([InlineKeyboardButton(text=f"🏷 Тег ({n})", callback_data="select_tag"),
+                     InlineKeyboardButton(text=f"✂️ Снять тег ({n})", callback_data="select_untag")])
+        rows.append([InlineKeyboardButton(text=f"🗑 Удалить ({n})", callback_data="select_delete")])
+    rows.append([InlineKeyboardButton(text="Готово ↩️", callback_data="select_done")])
+    return rows
+
+async def show_selection(callback: types.CallbackQuery, sel: Dict[str, Any]):
+    await show_wardrobe_list(callback.message, callback.from_user.id, page=sel["page"], group=sel["group"], select=True)
+
+async def current_selection(callback: types.CallbackQuery) -> Optional[Dict[str, Any]]:
+    sel = wardrobe_selection.get(callback.from_user.id)
+    if sel is None:
+        await callback.answer("Режим выбора уже закрыт.", show_alert=True)
+    return sel
+
+def forget_selected(user_id: int, item_ids: List[int]):
+    """Вещи изменились или удалены — сбросить их карточки и поисковый индекс."""
+    for item_id in item_ids:
+        invalidate_item_card(user_id, item_id)
+
+@callback_router.route("select_start", fields=(int, str))
+async def select_start_callback(callback: types.CallbackQuery, page: int, group: Optional[str]):
+    wardrobe_selection[callback.from_user.id] = {"ids": set(), "page": page or 0, "group": group, "page_ids": []}
+    await callback.answer()
+    await show_selection(callback, wardrobe_selection[callback.from_user.id])
+
+@callback_router.route("select_page", fields=(int, str))
+async def select_page_callback(callback: types.CallbackQuery, page: int, group: Optional[str]):
+    sel = await current_selection(callback)
+    if sel is None:
+        return
+    sel.update({"page": page or 0, "group": group})
+    await callback.answer()
+    await show_selection(callback, sel)
+
+@callback_router.route("select_toggle", fields=(int,))
+async def select_toggle_callback(callback: types.CallbackQuery, item_id: int):
+    sel = await current_selection(callback)
+    if sel is None:
+        return
+    if item_id in sel["ids"]:
+        sel["ids"].discard(item_id)
+    elif len(sel["ids"]) >= SELECTION_MAX:
+        await callback.answer(f"Можно выбрать не больше {SELECTION_MAX} вещей.", show_alert=True); return
+    else:
+        sel["ids"].add(item_id)
+    await callback.answer()
+    await show_selection(callback, sel)
+
+@callback_router.route("select_page_all", "select_clear")
+async def select_bulk_callback(callback: types.CallbackQuery):
+    sel = await current_selection(callback)
+    if sel is None:
+        return
+    before = set(sel["ids"])
+    if callback.data == "select_clear":
+        sel["ids"].clear()
+    else:
+        room = SELECTION_MAX - len(sel["ids"])
+        sel["ids"].update([i for i in sel["page_ids"] if i not in sel["ids"]][:max(0, room)])
+    await callback.answer()
+    if sel["ids"] != before:  # иначе Telegram ответит «message is not modified»
+        await show_selection(callback, sel)
+
+@callback_router.route("select_done", "select_back")
+async def select_done_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    sel = wardrobe_selection.get(user_id) if callback.data == "select_back" else wardrobe_selection.pop(user_id, None)
+    await callback.answer()
+    page, group = (sel["page"], sel["group"]) if sel else (0, None)
+    await show_wardrobe_list(callback.message, user_id, page=page, group=group, select=sel is not None and callback.data == "select_back")
+
+@callback_router.route("select_delete")
+async def select_delete_callback(callback: types.CallbackQuery):
+    sel = await current_selection(callback)
+    if sel is None:
+        return
+    if not sel["ids"]:
+        await callback.answer("Ничего не выбрано."); return
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=f"Да, удалить ({len(sel['ids'])})", callback_data="select_delete_ok"),
+        InlineKeyboardButton(text="Нет", callback_data="select_back")]])
+    await callback.answer()
+    await replace_menu_message(callback.from_user.id, callback.message,
+                               f"Удалить выбранные вещи ({len(sel['ids'])})? Это нельзя отменить.", reply_markup=kb,
+                               typ="wardrobe_list")
+
+@callback_router.route("select_delete_ok")
+async def select_delete_ok_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    sel = await current_selection(callback)
+    if sel is None:
+        return
+    async with repo.transaction() as db:
+        rows = await db.fetch("items_delete", user_id, sorted(sel["ids"]))
+    deleted = [r['id'] for r in rows]
+    sel["ids"].clear()
+    forget_labels(user_id, deleted)
+    forget_selected(user_id, deleted)
+    await callback.answer(f"Удалено вещей: {len(deleted)}")
+    await show_selection(callback, sel)
+    await update_compat_graph(user_id, compat_remove_items(user_id, deleted, [GROUP_OF_CATEGORY.get(r['category_en']) for r in rows]))
+
+@callback_router.route("select_tag")
+async def select_tag_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    sel = await current_selection(callback)
+    if sel is None:
+        return
+    if not sel["ids"]:
+        await callback.answer("Ничего не выбрано."); return
+    pending_action[user_id] = {"action": "batch_tag", "item_ids": sorted(sel["ids"])}
+    await callback.answer()
+    await bot.send_message(user_id, f"Введите тег для выбранных вещей ({len(sel['ids'])}). Для отмены /cancel")
+
+@callback_router.route("select_untag")
+async def select_untag_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    sel = await current_selection(callback)
+    if sel is None:
+        return
+    if not sel["ids"]:
+        await callback.answer("Ничего не выбрано."); return
+    rows = await repo.fetch("tags_of_items", user_id, sorted(sel["ids"]), SELECTION_TAGS_SHOWN)
+    if not rows:
+        await callback.answer("У выбранных вещей нет тегов.", show_alert=True); return
+    kb_rows = [[InlineKeyboardButton(text=f"✂️ {r['tag']} ({r['items']})", callback_data=cb_data("select_untag_do", r['tag']))]
+               for r in rows]
+    kb_rows.append([InlineKeyboardButton(text="↩️ К выбору", callback_data="select_back")])
+    await callback.answer()
+    await replace_menu_message(user_id, callback.message, "Какой тег снять с выбранных вещей?",
+                               reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows), typ="wardrobe_list")
+
+@callback_router.route("select_untag_do", fields=(TokenField,))
+async def select_untag_do_callback(callback: types.CallbackQuery, tag: str):
+    user_id = callback.from_user.id
+    sel = await current_selection(callback)
+    if sel is None:
+        return
+    async with repo.transaction() as db:
+        rows = await db.fetch("tags_delete_many", user_id, sorted(sel["ids"]), tag)
+    changed = sorted({r['item_id'] for r in rows})
+    forget_selected(user_id, changed)
+    await callback.answer(f"Тег «{tag}» снят с вещей: {len(changed)}")
+    await show_selection(callback, sel)
+
 # ---------------- View item handlers (unchanged, but last_menu_message tracking left intact) ----------------
-@dp.callback_query(lambda c: c.data and c.data.startswith("view_item:"))
-async def view_item_callback(callback: types.CallbackQuery):
-    item_id = int(callback.data.split(":", 1)[1])
+@callback_router.route("view_item", fields=(int,))
+async def view_item_callback(callback: types.CallbackQuery, item_id: int):
     user_id = callback.from_user.id
 
     # 1) Попытка удалить предыдущее меню / карточку, чтобы не засорять чат
@@ -1276,41 +2467,13 @@ async def view_item_callback(callback: types.CallbackQuery):
         # убираем запись, чтобы следующий экран не пытался удалить уже удалённое сообщение
         last_menu_message.pop(user_id, None)
 
-    # 2) Получаем данные вещи из БД
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT file_id, name, color_ru, category_ru, created_at, description FROM wardrobe WHERE id=$1 AND user_id=$2",
-            item_id, user_id
-        )
-        if not row:
-            await callback.answer("Предмет не найден или у вас нет прав.", show_alert=True)
-            return
-        tags = await conn.fetch("SELECT id, tag FROM tags WHERE item_id=$1 ORDER BY id", item_id)
-
-    file_id = row['file_id']; name = row['name'] or '-'; color_ru = row['color_ru'] or '-'; category_ru = row['category_ru'] or '-'
-    created_at = row['created_at']; description = row['description'] or ''
-    caption_lines = [
-        f"<b>{escape(name)}</b>",
-        f"Цвет: {escape(color_ru)}",
-        f"Категория: {escape(category_ru)}",
-        f"Добавлено: {escape(format_dt(created_at))}"
-    ]
-    if description:
-        caption_lines.append(f"\nОписание: {escape(description)}")
-    if tags:
-        tag_texts = ", ".join(t['tag'] for t in tags)
-        caption_lines.append(f"\nТеги: {escape(tag_texts)}")
-    caption = "\n".join(caption_lines)
-
-    kb_rows = [
-        [InlineKeyboardButton(text="Добавить тег ➕", callback_data=f"add_tag:{item_id}"),
-         InlineKeyboardButton(text="Добавить описание ✍️", callback_data=f"add_desc:{item_id}")],
-        [InlineKeyboardButton(text="Удалить вещь ❌", callback_data=f"delete_item:{item_id}")],
-        [InlineKeyboardButton(text="Назад к списку ↩️", callback_data="menu_wardrobe")]  # удобная кнопка назад
-    ]
-    for t in tags:
-        kb_rows.append([InlineKeyboardButton(text=f"❌ {t['tag']}", callback_data=f"delete_tag:{t['id']}")])
-    kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
+    # 2) Получаем карточку вещи (кеш или один запрос в БД)
+    card = await load_item_card(user_id, item_id)
+    if not card:
+        await callback.answer("Предмет не найден или у вас нет прав.", show_alert=True)
+        return
+    file_id = card['file_id']; caption = card['caption']
+    kb = item_card_kb(card, "list")
 
     # 3) Отправляем карточку вещи и сохраняем её как last_menu_message
     try:
@@ -1321,8 +2484,26 @@ async def view_item_callback(callback: types.CallbackQuery):
     last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "item_view"}
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("view_item_from_capsule:"))
-async def view_item_from_capsule(callback: types.CallbackQuery):
+@callback_router.route("item_matches", fields=(int,))
+async def item_matches_callback(callback: types.CallbackQuery, item_id: int):
+    """«С чем носить»: лучшие вещи других групп из графа совместимости — один запрос за списками, один за вещами."""
+    user_id = callback.from_user.id
+    groups = await matching_items(user_id, item_id)
+    if not groups:
+        await callback.answer("Пока не с чем сочетать — добавьте вещи других категорий.", show_alert=True)
+        return
+    lines = ["👗 <b>С чем носить</b>\n"]
+    kb_rows = []
+    for g, rows in groups:
+        lines.append(f"{CATEGORY_GROUPS[g]['label']}: " + ", ".join(escape(r['name'] or '(без названия)') for r in rows))
+        kb_rows.extend(two_buttons_from_items(rows, lambda r: cb_data("view_item", r['id'])))
+    kb_rows.append([InlineKeyboardButton(text="↩️ Назад к вещи", callback_data=cb_data("view_item", item_id))])
+    await replace_menu_message(user_id, None, "\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows),
+                               typ="item_matches")
+    await callback.answer()
+
+@callback_router.route("view_item_from_capsule", fields=(int,))
+async def view_item_from_capsule(callback: types.CallbackQuery, item_id: int):
     user_id = callback.from_user.id
     lm = last_menu_message.get(user_id)
     if lm and lm.get("type") in ("item_view", "item_from_cap"):
@@ -1331,31 +2512,11 @@ async def view_item_from_capsule(callback: types.CallbackQuery):
         except Exception:
             pass
         last_menu_message.pop(user_id, None)
-    item_id = int(callback.data.split(":", 1)[1]); user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT file_id, name, color_ru, category_ru, created_at, description FROM wardrobe WHERE id=$1", item_id)
-        if not row:
-            await callback.answer("Предмет не найден.", show_alert=True); return
-        tags = await conn.fetch("SELECT id, tag FROM tags WHERE item_id=$1 ORDER BY id", item_id)
-
-    file_id = row['file_id']; name = row['name'] or '-'; color_ru = row['color_ru'] or '-'; category_ru = row['category_ru'] or '-'
-    created_at = row['created_at']; description = row['description'] or ''
-    caption_lines = [f"<b>{escape(name)}</b>", f"Цвет: {escape(color_ru)}", f"Категория: {escape(category_ru)}", f"Добавлено: {escape(format_dt(created_at))}"]
-    if description: caption_lines.append(f"\nОписание: {escape(description)}")
-    if tags:
-        tag_texts = ", ".join(t['tag'] for t in tags); caption_lines.append(f"\nТеги: {escape(tag_texts)}")
-    caption = "\n".join(caption_lines)
-
-    kb_rows = [
-        [InlineKeyboardButton(text="Добавить тег ➕", callback_data=f"add_tag:{item_id}"),
-         InlineKeyboardButton(text="Добавить описание ✍️", callback_data=f"add_desc:{item_id}")],
-        [InlineKeyboardButton(text="Удалить вещь ❌", callback_data=f"delete_item:{item_id}")],
-        [InlineKeyboardButton(text="↩️ Вернуться в капсулу", callback_data="back_to_capsule")],
-    ]
-    for t in tags:
-        kb_rows.append([InlineKeyboardButton(text=f"❌ {t['tag']}", callback_data=f"delete_tag:{t['id']}")])
-    kb_rows.append([InlineKeyboardButton(text="Закрыть", callback_data="close_view")])
-    kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
+    card = await load_item_card(user_id, item_id)
+    if not card:
+        await callback.answer("Предмет не найден.", show_alert=True); return
+    file_id = card['file_id']; caption = card['caption']
+    kb = item_card_kb(card, "capsule")
 
     try:
         sent = await bot.send_photo(user_id, photo=file_id, caption=caption, parse_mode="HTML", reply_markup=kb)
@@ -1365,7 +2526,7 @@ async def view_item_from_capsule(callback: types.CallbackQuery):
         last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "item_from_cap"}
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "back_to_capsule")
+@callback_router.route("back_to_capsule")
 async def back_to_capsule(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     cap = pending_capsule.get(user_id)
@@ -1376,7 +2537,7 @@ async def back_to_capsule(callback: types.CallbackQuery):
 
     kb_rows = []
     # по 2 вещи в ряд
-    kb_rows.extend(two_buttons_from_items(cap.get("items", []), lambda it: f"view_item_from_capsule:{it.get('id')}"))
+    kb_rows.extend(two_buttons_from_items(cap.get("items", []), lambda it: cb_data("view_item_from_capsule", it.get('id'))))
 
     kb_rows.append([InlineKeyboardButton(text="💾 Сохранить капсулу", callback_data="save_capsule"),
                     InlineKeyboardButton(text="🔁 Сгенерировать ещё", callback_data="generate_capsule")])
@@ -1398,7 +2559,7 @@ async def back_to_capsule(callback: types.CallbackQuery):
         except Exception: pass
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "close_capsule")
+@callback_router.route("close_capsule")
 async def close_capsule(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
@@ -1449,9 +2610,7 @@ async def close_capsule(callback: types.CallbackQuery):
     await callback.answer("Капсула закрыта.")
 
 # ---------------- Add flows callbacks (название/цвет/сохранить/отмена) ----------------
-@dp.callback_query(lambda c: c.data is not None and c.data in {
-    "add_accept_name", "add_enter_name", "add_accept_color", "add_enter_color", "add_save", "add_cancel"
-})
+@callback_router.route("add_accept_name", "add_enter_name", "add_accept_color", "add_enter_color", "add_save", "add_cancel")
 async def add_flow_callbacks(callback: types.CallbackQuery):
     data = callback.data; user_id = callback.from_user.id
     state = pending_add.get(user_id)
@@ -1513,11 +2672,10 @@ async def add_flow_callbacks(callback: types.CallbackQuery):
         color_en = state.get("color_en","") or ""; color_ru = state.get("color_ru","") or ""
         category_en = state.get("suggested_category_en","") or ""; category_ru = state.get("suggested_category_ru","") or ""
         created_at = datetime.now(timezone.utc)
-        async with db_pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO wardrobe (user_id, file_id, emb, name, color_en, color_ru, category_en, category_ru, created_at, description)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-            """, user_id, file_id, emb_bytes, name, color_en, color_ru, category_en, category_ru, created_at, "")
+        item_id = await repo.fetchval("item_insert", user_id, file_id, emb_bytes, EMB_MODEL, name, color_en, color_ru,
+                                      category_en, category_ru, created_at, "", known_unique_id(file_id))
+        remember_labels(user_id, item_id, to_vector_from_bytes(emb_bytes), name=name, category_en=category_en, color_en=color_en)
+        search_indexes.pop(user_id, None)
         try:
             await safe_delete_message(state.get("suggestion_chat_id"), state.get("suggestion_message_id"))
         except Exception:
@@ -1525,6 +2683,7 @@ async def add_flow_callbacks(callback: types.CallbackQuery):
         pending_add.pop(user_id, None)
         await send_main_menu(user_id, f"Вещь <b>{escape(name)}</b> добавлена в гардероб ✅")
         await callback.answer("Вещь сохранена ✅")
+        await update_compat_graph(user_id, compat_add_item(user_id, item_id))
         return
 
     # Отмена
@@ -1542,11 +2701,10 @@ async def add_flow_callbacks(callback: types.CallbackQuery):
     await callback.answer()
 
 # ---------------- Handlers for add_tag/add_desc/delete_tag/delete_item/close_view ----------------
-@dp.callback_query(lambda c: c.data and c.data.startswith("add_tag:"))
-async def add_tag_request(callback: types.CallbackQuery):
-    item_id = int(callback.data.split(":",1)[1]); user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        has = await conn.fetchval("SELECT 1 FROM wardrobe WHERE id=$1 AND user_id=$2", item_id, user_id)
+@callback_router.route("add_tag", fields=(int,))
+async def add_tag_request(callback: types.CallbackQuery, item_id: int):
+    user_id = callback.from_user.id
+    has = await repo.fetchval("item_exists", item_id, user_id)
     if not has:
         await callback.answer("Нет прав или вещь не найдена.", show_alert=True); return
     try:
@@ -1558,11 +2716,10 @@ async def add_tag_request(callback: types.CallbackQuery):
     await bot.send_message(user_id, "Введите тег для этой вещи (одно слово или фраза). Для отмены /cancel")
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("add_desc:"))
-async def add_desc_request(callback: types.CallbackQuery):
-    item_id = int(callback.data.split(":",1)[1]); user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        has = await conn.fetchval("SELECT 1 FROM wardrobe WHERE id=$1 AND user_id=$2", item_id, user_id)
+@callback_router.route("add_desc", fields=(int,))
+async def add_desc_request(callback: types.CallbackQuery, item_id: int):
+    user_id = callback.from_user.id
+    has = await repo.fetchval("item_exists", item_id, user_id)
     if not has:
         await callback.answer("Нет прав или вещь не найдена.", show_alert=True); return
     try:
@@ -1574,41 +2731,28 @@ async def add_desc_request(callback: types.CallbackQuery):
     await bot.send_message(user_id, "Введите описание для этой вещи. Для отмены /cancel")
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("delete_tag:"))
-async def delete_tag_callback(callback: types.CallbackQuery):
-    tag_id = int(callback.data.split(":",1)[1]); user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT item_id, user_id, tag FROM tags WHERE id=$1", tag_id)
-        if not row:
-            await callback.answer("Тег не найден.", show_alert=True); return
-        if row['user_id'] != user_id:
-            await callback.answer("Нет прав удалять этот тег.", show_alert=True); return
-        await conn.execute("DELETE FROM tags WHERE id=$1", tag_id)
-        item_id = row['item_id']
+@callback_router.route("delete_tag", fields=(int,))
+async def delete_tag_callback(callback: types.CallbackQuery, tag_id: int):
+    user_id = callback.from_user.id
+    # удаление с проверкой владельца и перечитывание карточки — на одном соединении
+    async with repo.session() as db:
+        item_id = await db.fetchval("tag_delete", tag_id, user_id)
+        card = None
+        if item_id is not None:
+            invalidate_item_card(user_id, item_id)
+            try:
+                card = await load_item_card(user_id, item_id, db=db)
+            except Exception:
+                card = None
+    if item_id is None:
+        await callback.answer("Тег не найден или нет прав.", show_alert=True); return
 
     # обновляем карточку (если возможно)
     try:
-        async with db_pool.acquire() as conn:
-            r = await conn.fetchrow("SELECT file_id, name, color_ru, category_ru, created_at, description FROM wardrobe WHERE id=$1 AND user_id=$2", item_id, user_id)
-            tags = await conn.fetch("SELECT id, tag FROM tags WHERE item_id=$1 ORDER BY id", item_id)
-        if not r:
+        if not card:
             await send_main_menu(user_id, "Вещь не найдена (после удаления тега)."); await callback.answer("Тег удалён."); return
-        file_id = r['file_id']; name = r['name'] or '-'; color_ru = r['color_ru'] or '-'; category_ru = r['category_ru'] or '-'
-        created_at = r['created_at']; description = r['description'] or ''
-        caption_lines = [f"<b>{escape(name)}</b>", f"Цвет: {escape(color_ru)}", f"Категория: {escape(category_ru)}", f"Добавлено: {escape(format_dt(created_at))}"]
-        if description: caption_lines.append(f"\nОписание: {escape(description)}")
-        if tags: tag_texts = ", ".join(t['tag'] for t in tags); caption_lines.append(f"\nТеги: {escape(tag_texts)}")
-        caption = "\n".join(caption_lines)
-
-        kb_rows = [
-            [InlineKeyboardButton(text="Добавить тег ➕", callback_data=f"add_tag:{item_id}"),
-             InlineKeyboardButton(text="Добавить описание ✍️", callback_data=f"add_desc:{item_id}")],
-            [InlineKeyboardButton(text="Удалить вещь ❌", callback_data=f"delete_item:{item_id}")]
-        ]
-        for t in tags:
-            kb_rows.append([InlineKeyboardButton(text=f"❌ {t['tag']}", callback_data=f"delete_tag:{t['id']}")])
-        kb_rows.append([InlineKeyboardButton(text="Закрыть", callback_data="close_view")])
-        kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
+        file_id = card['file_id']; caption = card['caption']
+        kb = item_card_kb(card, "edit")
 
         if callback.message:
             try:
@@ -1647,15 +2791,14 @@ def two_buttons_from_items(items, cb_builder):
         rows.append(buf)
     return rows
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("delete_item:"))
-async def delete_item_request(callback: types.CallbackQuery):
-    item_id = int(callback.data.split(":",1)[1]); user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        name = await conn.fetchval("SELECT name FROM wardrobe WHERE id=$1 AND user_id=$2", item_id, user_id)
+@callback_router.route("delete_item", fields=(int,))
+async def delete_item_request(callback: types.CallbackQuery, item_id: int):
+    user_id = callback.from_user.id
+    name = await repo.fetchval("item_name", item_id, user_id)
     if not name:
         await callback.answer("Предмет не найден или у вас нет прав.", show_alert=True); return
     confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Подтвердить удаление ❗️", callback_data=f"delete_confirm:{item_id}")],
+        [InlineKeyboardButton(text="Подтвердить удаление ❗️", callback_data=cb_data("delete_confirm", item_id))],
         [InlineKeyboardButton(text="Отмена ↩️", callback_data="delete_cancel")]
     ])
     try:
@@ -1667,20 +2810,23 @@ async def delete_item_request(callback: types.CallbackQuery):
         await bot.send_message(user_id, f"Удаление предмета: <b>{escape(name)}</b>\nВы уверены?", parse_mode="HTML", reply_markup=confirm_kb)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("delete_confirm:"))
-async def delete_item_confirm(callback: types.CallbackQuery):
-    item_id = int(callback.data.split(":",1)[1]); user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT file_id, name FROM wardrobe WHERE id=$1 AND user_id=$2", item_id, user_id)
-        if not row:
-            await callback.answer("Уже удалено или нет прав.", show_alert=True)
-            try:
-                await bot.edit_message_reply_markup(callback.message.chat.id, callback.message.message_id, reply_markup=None)
-            except Exception:
-                pass
-            return
-        name = row['name']
-        await conn.execute("DELETE FROM wardrobe WHERE id=$1 AND user_id=$2", item_id, user_id)
+@callback_router.route("delete_confirm", fields=(int,))
+async def delete_item_confirm(callback: types.CallbackQuery, item_id: int):
+    user_id = callback.from_user.id
+    async with repo.session() as db:
+        row = await db.fetchrow("item_file_and_name", item_id, user_id)
+        if row:
+            await db.execute("item_delete", item_id, user_id)
+    if not row:
+        await callback.answer("Уже удалено или нет прав.", show_alert=True)
+        try:
+            await bot.edit_message_reply_markup(callback.message.chat.id, callback.message.message_id, reply_markup=None)
+        except Exception:
+            pass
+        return
+    name = row['name']
+    invalidate_item_card(user_id, item_id)
+    forget_labels(user_id, [item_id])
     try:
         if callback.message and callback.message.photo:
             await bot.edit_message_caption(chat_id=callback.message.chat.id, message_id=callback.message.message_id, caption=f"🗑️ Предмет <b>{escape(name)}</b> удалён.", parse_mode="HTML", reply_markup=None)
@@ -1689,8 +2835,9 @@ async def delete_item_confirm(callback: types.CallbackQuery):
     except Exception:
         await bot.send_message(user_id, f"🗑️ Предмет <b>{escape(name)}</b> удалён.", parse_mode="HTML")
     await callback.answer("Предмет удалён.", show_alert=False)
+    await update_compat_graph(user_id, compat_remove_items(user_id, [item_id], [GROUP_OF_CATEGORY.get(row['category_en'])]))
 
-@dp.callback_query(lambda c: c.data == "delete_cancel")
+@callback_router.route("delete_cancel")
 async def delete_cancel(callback: types.CallbackQuery):
     try:
         await bot.edit_message_reply_markup(chat_id=callback.message.chat.id, message_id=callback.message.message_id, reply_markup=None)
@@ -1698,7 +2845,7 @@ async def delete_cancel(callback: types.CallbackQuery):
         pass
     await callback.answer("Удаление отменено", show_alert=False)
 
-@dp.callback_query(lambda c: c.data == "close_view")
+@callback_router.route("close_view")
 async def close_view(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     await callback.answer()
@@ -1710,7 +2857,7 @@ async def close_view(callback: types.CallbackQuery):
     if lm and lm.get("type") == "item_from_cap" and cap:
         try:
             kb_rows = []
-            kb_rows.extend(two_buttons_from_items(cap.get("items", []), lambda it: f"view_item_from_capsule:{it.get('id')}"))
+            kb_rows.extend(two_buttons_from_items(cap.get("items", []), lambda it: cb_data("view_item_from_capsule", it.get('id'))))
 
             kb_rows.append([InlineKeyboardButton(text="💾 Сохранить капсулу", callback_data="save_capsule"),
                             InlineKeyboardButton(text="🔁 Сгенерировать ещё", callback_data="generate_capsule")])
@@ -1775,188 +2922,272 @@ async def close_view(callback: types.CallbackQuery):
         pass
 
 # ---------------- General callbacks: menu navigation, capsule save, feedback ----------------
-@dp.callback_query(lambda c: c.data == "generate_capsule")
+@callback_router.route("generate_capsule")
 async def generate_capsule_cb(callback: types.CallbackQuery):
     await callback.answer("Генерирую новую капсулу…")
     await send_capsule(callback.from_user.id, force_regen=True)
 
 
-@dp.callback_query()
-async def general_callback_router(callback: types.CallbackQuery):
-    data = callback.data or ""; user_id = callback.from_user.id
+@callback_router.route("menu_generate_capsule")
+async def menu_generate_capsule(callback: types.CallbackQuery):
+    await callback.answer(); await send_capsule(callback.from_user.id)
 
-    # menu navigation
-    if data == "menu_generate_capsule":
-        await callback.answer(); await send_capsule(user_id); return
-    if data == "menu_help":
-        await callback.answer()
+@callback_router.route("menu_help")
+async def menu_help(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    await callback.answer()
+    try:
+        await send_main_menu(user_id, HELP_TEXT)
+    except Exception:
         try:
-            await send_main_menu(user_id, HELP_TEXT)
+            sent = await bot.send_message(user_id, HELP_TEXT, parse_mode="HTML")
+            last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "start"}
         except Exception:
-            try:
-                sent = await bot.send_message(user_id, HELP_TEXT, parse_mode="HTML")
-                last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "start"}
-            except Exception:
-                pass
-        return
-    if data == "menu_back":
-        await callback.answer()
+            pass
 
-        # 1) Попытка удалить текущее сообщение (чтобы не оставлять "карточку" откуда нажали назад)
+@callback_router.route("menu_back")
+async def menu_back(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    await callback.answer()
+
+    # 1) Попытка удалить текущее сообщение (чтобы не оставлять "карточку" откуда нажали назад)
+    try:
+        if callback.message and callback.message.chat and callback.message.message_id:
+            await safe_delete_message(callback.message.chat.id, callback.message.message_id)
+    except Exception:
+        # молча игнорируем ошибки удаления
+        pass
+
+    # 2) Показать главное меню, стараясь не дублировать
+    # send_main_menu уже реализована так, чтобы удалять/редактировать last_menu_message — используем её.
+    try:
+        await send_main_menu(user_id)
+    except Exception:
+        # Фоллбек: просто отправляем и обновляем last_menu_message вручную
         try:
-            if callback.message and callback.message.chat and callback.message.message_id:
-                await safe_delete_message(callback.message.chat.id, callback.message.message_id)
+            sent = await bot.send_message(user_id, "Главное меню:", reply_markup=main_menu_kb())
+            last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "start"}
         except Exception:
-            # молча игнорируем ошибки удаления
             pass
 
-        # 2) Показать главное меню, стараясь не дублировать
-        # send_main_menu уже реализована так, чтобы удалять/редактировать last_menu_message — используем её.
-        try:
-            await send_main_menu(user_id)
-        except Exception:
-            # Фоллбек: просто отправляем и обновляем last_menu_message вручную
-            try:
-                sent = await bot.send_message(user_id, "Главное меню:", reply_markup=main_menu_kb())
-                last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "start"}
-            except Exception:
-                pass
 
+# view saved capsules
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def capsule_cursor(row) -> Tuple[int, int]:
+    """Ключ капсулы для callback_data: created_at в микросекундах (целым, без потерь) и id."""
+    return (row['created_at'] - EPOCH) // timedelta(microseconds=1), row['id']
+
+async def load_capsule_page(user_id: int, after: Optional[Tuple[int, int]] = None,
+                            before: Optional[Tuple[int, int]] = None) -> Tuple[List[Any], bool, bool]:
+    """
+    Страница списка капсул (новые сверху) по ключу (created_at, id), без OFFSET:
+    after — следующая страница после курсора, before — предыдущая перед ним, ничего — первая.
+    Возвращает (строки, есть ли страница новее, есть ли страница старше).
+    """
+    n = CAPSULE_PAGE_SIZE
+    if before is not None:
+        us, cap_id = before
+        rows = await repo.fetch("capsules_before", user_id, EPOCH + timedelta(microseconds=us), cap_id, n + 1)
+        return list(reversed(rows[:n])), len(rows) > n, True
+    if after is not None:
+        us, cap_id = after
+        rows = await repo.fetch("capsules_after", user_id, EPOCH + timedelta(microseconds=us), cap_id, n + 1)
+        return rows[:n], True, len(rows) > n
+    rows = await repo.fetch("capsules_first", user_id, n + 1)
+    return rows[:n], False, len(rows) > n
+
+def capsule_list_kb(rows, has_newer: bool, has_older: bool) -> InlineKeyboardMarkup:
+    kb_rows = [[InlineKeyboardButton(text=f"{r['name']} — {format_dt(r['created_at'])}",
+                                     callback_data=cb_data("view_capsule", r['id']))] for r in rows]
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=cb_data("capsules_prev", *capsule_cursor(rows[0]))))
+    if has_older:
+        nav.append(InlineKeyboardButton(text="Старше ➡️", callback_data=cb_data("capsules_next", *capsule_cursor(rows[-1]))))
+    if nav:
+        kb_rows.append(nav)
+    kb_rows.append([InlineKeyboardButton(text="↩️ Назад", callback_data="menu_back")])
+    return InlineKeyboardMarkup(inline_keyboard=kb_rows)
+
+@callback_router.route("menu_view_capsules")
+async def menu_view_capsules(callback: types.CallbackQuery):
+    await show_capsule_list(callback)
+
+@callback_router.route("capsules_next", "capsules_prev", fields=(int, int))
+async def capsules_page(callback: types.CallbackQuery, us: int, cap_id: int):
+    if callback.data.startswith("capsules_next:"):
+        await show_capsule_list(callback, after=(us, cap_id))
+    else:
+        await show_capsule_list(callback, before=(us, cap_id))
+
+async def show_capsule_list(callback: types.CallbackQuery, after: Optional[Tuple[int, int]] = None,
+                            before: Optional[Tuple[int, int]] = None):
+    user_id = callback.from_user.id
+    await callback.answer()
+    rows, has_newer, has_older = await load_capsule_page(user_id, after=after, before=before)
+    if not rows and (after or before):
+        # соседние капсулы удалили, пока список был открыт — показываем с начала
+        rows, has_newer, has_older = await load_capsule_page(user_id)
+
+    if not rows:
+        # используем replace_menu_message чтобы аккуратно показать ответ и удалить старое меню
+        await replace_menu_message(user_id, callback.message, "У тебя ещё нет сохранённых капсул.",
+                                   reply_markup=main_menu_kb(), typ="start")
         return
-    # view saved capsules
-    # Внутри general_callback_router: замените обработку data == "menu_view_capsules" на этот блок
-    if data == "menu_view_capsules":
-        await callback.answer()
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch(
-                "SELECT id, name, created_at FROM capsules WHERE user_id=$1 ORDER BY created_at DESC", user_id)
-
-        if not rows:
-            # используем replace_menu_message чтобы аккуратно показать ответ и удалить старое меню
-            await replace_menu_message(user_id, callback.message, "У тебя ещё нет сохранённых капсул.",
-                                       reply_markup=main_menu_kb(), typ="start")
-            return
 
-        kb_rows = [[InlineKeyboardButton(text=f"{r['name']} — {format_dt(r['created_at'])}",
-                                         callback_data=f"view_capsule:{r['id']}")] for r in rows]
-        kb_rows.append([InlineKeyboardButton(text="↩️ Назад", callback_data="menu_back")])
-        kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
+    kb = capsule_list_kb(rows, has_newer, has_older)
+    try:
+        await replace_menu_message(user_id, callback.message, "Твои капсулы:", reply_markup=kb, typ="capsule_list")
+    except Exception:
+        sent = await bot.send_message(user_id, "Твои капсулы:", reply_markup=kb)
+        last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id,
+                                      "type": "capsule_list"}
 
+@callback_router.route("view_capsule", fields=(int,))
+async def view_capsule_callback(callback: types.CallbackQuery, cap_id: int):
+    user_id = callback.from_user.id
+    origin = callback.message
+
+    # 1. Если мы вернулись из просмотра вещи (сообщение с фото),
+    # его нельзя отредактировать в текст. Поэтому удаляем его принудительно.
+    if origin and origin.photo:
         try:
-            await replace_menu_message(user_id, callback.message, "Твои капсулы:", reply_markup=kb, typ="capsule_list")
+            await safe_delete_message(origin.chat.id, origin.message_id)
         except Exception:
-            sent = await bot.send_message(user_id, "Твои капсулы:", reply_markup=kb)
-            last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id,
-                                          "type": "capsule_list"}
-        return
+            pass
+        # Обнуляем message, чтобы replace_menu_message отправил новое, а не пытался редактировать удаленное
+        origin = None
+    try:
+        # может быть уже отвечен (view_saved_cap_item возвращает сюда, если вещь не найдена)
+        await callback.answer()
+    except Exception:
+        pass
 
-    if data.startswith("view_capsule:"):
-        cap_id = int(data.split(":", 1)[1])
+    # Чистим запись о последнем меню, если это было что-то другое
+    await clear_last_menu_if_different(user_id, origin)
 
-        # 1. Если мы вернулись из просмотра вещи (сообщение с фото),
-        # его нельзя отредактировать в текст. Поэтому удаляем его принудительно.
-        if callback.message.photo:
-            try:
-                await safe_delete_message(callback.message.chat.id, callback.message.message_id)
-                # Обнуляем message, чтобы replace_menu_message отправил новое, а не пытался редактировать удаленное
-                callback.message = None
-            except Exception:
-                pass
-        else:
-            await callback.answer()
-
-        # Чистим запись о последнем меню, если это было что-то другое
-        await clear_last_menu_if_different(user_id, callback.message)
+    # капсула и её вещи одним запросом; вещи, удалённые из гардероба, просто пропускаются
+    cap_rows = await repo.fetch("capsule_view", cap_id, user_id)
+    cap = cap_rows[0] if cap_rows else None
 
-        async with db_pool.acquire() as conn:
-            cap = await conn.fetchrow(
-                "SELECT id, name, item_ids, created_at FROM capsules WHERE id=$1 AND user_id=$2", cap_id, user_id)
+    if not cap:
+        # Если капсула удалена, кидаем в главное меню
+        await replace_menu_message(user_id, origin, "Капсула не найдена.",
+                                   reply_markup=main_menu_kb(), typ="start")
+        return
 
-        if not cap:
-            # Если капсула удалена, кидаем в главное меню
-            await replace_menu_message(user_id, callback.message, "Капсула не найдена.",
-                                       reply_markup=main_menu_kb(), typ="start")
-            return
+    rows = [{"id": r['item_id'], "name": r['item_name'], "file_id": r['file_id'], "file_unique_id": r['file_unique_id'],
+             "category_ru": r['category_ru']} for r in cap_rows if r['item_id'] is not None]
+    remember_files(rows)
+    lines = [f"💾 <b>{escape(cap['name'])}</b> — {format_dt(cap['created_at'])}", "", "Список вещей:"]
+    kb_rows = []
 
-        item_ids = cap['item_ids'] or []
-        lines = [f"💾 <b>{escape(cap['name'])}</b> — {format_dt(cap['created_at'])}", "", "Список вещей:"]
-        kb_rows = []
+    if rows:
+        # добавляем кнопки по 2 в ряд, без слова "Открыть:"
+        kb_rows.extend(two_buttons_from_items(rows, lambda r: cb_data("view_saved_cap_item", r['id'], cap_id)))
 
-        if item_ids:
-            async with db_pool.acquire() as conn:
-                rows = await conn.fetch(
-                    "SELECT id, name, file_id, category_ru FROM wardrobe WHERE id = ANY($1::int[])", item_ids)
+        lines.append("\nВыберите вещь для просмотра.")
+    else:
+        lines.append("В капсуле нет сохранённых вещей.")
 
-            # добавляем кнопки по 2 в ряд, без слова "Открыть:"
-            kb_rows.extend(two_buttons_from_items(rows, lambda r: f"view_saved_cap_item:{r['id']}:{cap_id}"))
+    text = "\n".join(lines)
 
-            lines.append("\nВыберите вещь для просмотра.")
-        else:
-            lines.append("В капсуле нет сохранённых вещей.")
+    kb_rows.append([InlineKeyboardButton(text="❌ Удалить капсулу", callback_data=cb_data("ask_del_cap", cap['id'])),
+                    InlineKeyboardButton(text="↩️ Назад к списку капсул", callback_data="menu_view_capsules")])
+    kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
 
-        text = "\n".join(lines)
+    # 2. Капсула — одно фото-коллаж. Уже загруженный коллаж переиспользуем по file_id,
+    # перерисовываем только если его нет или набор вещей изменился (например, вещь удалили).
+    if rows:
+        row_ids = sorted(int(r['id']) for r in rows)
+        cached = cap['thumbnail_file_id'] if sorted(cap['thumbnail_item_ids'] or []) == row_ids else None
+        sent, thumb = await send_capsule_photo(user_id, [r['file_id'] for r in rows], text, kb, cached_file_id=cached)
+        if sent:
+            if thumb != cached:
+                try:
+                    await repo.execute("capsule_set_thumbnail", thumb, row_ids, cap_id, user_id)
+                except Exception as e:
+                    print("view_capsule: thumbnail update failed:", e)
+            if origin:
+                await safe_delete_message(origin.chat.id, origin.message_id)
+            last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id, "type": "capsule_view"}
+            return
 
-        kb_rows.append([InlineKeyboardButton(text="❌ Удалить капсулу", callback_data=f"ask_del_cap:{cap['id']}"),
-                        InlineKeyboardButton(text="↩️ Назад к списку капсул", callback_data="menu_view_capsules")])
-        kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
+    await replace_menu_message(user_id, origin, text, reply_markup=kb, typ="capsule_view")
 
-        await replace_menu_message(user_id, callback.message, text, reply_markup=kb, typ="capsule_view")
-        return
-    # Внутри general_callback_router: замените обработку delete_capsule_confirm на этот блок
-    if data.startswith("delete_capsule_confirm:"):
-        cap_id = int(data.split(":", 1)[1])
-        async with db_pool.acquire() as conn:
-            await conn.execute("DELETE FROM capsules WHERE id=$1 AND user_id=$2", cap_id, user_id)
+@callback_router.route("delete_capsule_confirm", fields=(int,))
+async def delete_capsule_confirm(callback: types.CallbackQuery, cap_id: int):
+    user_id = callback.from_user.id
+    await repo.execute("capsule_delete", cap_id, user_id)
 
-        # Попробуем обновить текущий список капсул в том же сообщении (если вызвано из списка)
-        try:
-            async with db_pool.acquire() as conn:
-                rows = await conn.fetch(
-                    "SELECT id, name, created_at FROM capsules WHERE user_id=$1 ORDER BY created_at DESC", user_id)
-            if rows:
-                kb_rows = [[InlineKeyboardButton(text=f"{r['name']} — {format_dt(r['created_at'])}",
-                                                 callback_data=f"view_capsule:{r['id']}")] for r in rows]
-                kb_rows.append([InlineKeyboardButton(text="↩️ Назад", callback_data="menu_back")])
-                kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
-                # если есть callback.message — редактируем её, иначе отправим новое
-                if callback.message:
-                    await bot.edit_message_text("Капсула удалена. Обновлённый список:",
-                                                chat_id=callback.message.chat.id,
-                                                message_id=callback.message.message_id, parse_mode="HTML",
-                                                reply_markup=kb)
-                    last_menu_message[user_id] = {"chat_id": callback.message.chat.id,
-                                                  "message_id": callback.message.message_id, "type": "capsule_list"}
-                else:
-                    sent = await bot.send_message(user_id, "Капсула удалена. Обновлённый список:", parse_mode="HTML",
-                                                  reply_markup=kb)
-                    last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id,
-                                                  "type": "capsule_list"}
+    # Попробуем обновить текущий список капсул в том же сообщении (если вызвано из списка)
+    try:
+        rows, has_newer, has_older = await load_capsule_page(user_id)
+        if rows:
+            kb = capsule_list_kb(rows, has_newer, has_older)
+            # если есть callback.message — редактируем её, иначе отправим новое
+            if callback.message:
+                await bot.edit_message_text("Капсула удалена. Обновлённый список:",
+                                            chat_id=callback.message.chat.id,
+                                            message_id=callback.message.message_id, parse_mode="HTML",
+                                            reply_markup=kb)
+                last_menu_message[user_id] = {"chat_id": callback.message.chat.id,
+                                              "message_id": callback.message.message_id, "type": "capsule_list"}
             else:
-                # больше нет капсул — очищаем запись и показываем главное меню
-                last_menu_message.pop(user_id, None)
-                await send_main_menu(user_id, "Капсула удалена.")
-        except Exception as e:
-            print("delete_capsule_confirm: update failed:", e)
-            try:
-                last_menu_message.pop(user_id, None)
-            except Exception:
-                pass
+                sent = await bot.send_message(user_id, "Капсула удалена. Обновлённый список:", parse_mode="HTML",
+                                              reply_markup=kb)
+                last_menu_message[user_id] = {"chat_id": sent.chat.id, "message_id": sent.message_id,
+                                              "type": "capsule_list"}
+        else:
+            # больше нет капсул — очищаем запись и показываем главное меню
+            last_menu_message.pop(user_id, None)
             await send_main_menu(user_id, "Капсула удалена.")
-        await callback.answer("Капсула удалена")
-        return
+    except Exception as e:
+        print("delete_capsule_confirm: update failed:", e)
+        try:
+            last_menu_message.pop(user_id, None)
+        except Exception:
+            pass
+        await send_main_menu(user_id, "Капсула удалена.")
+    await callback.answer("Капсула удалена")
 
-    # feedback (simple)
-    if data.startswith("fb_"):
-        if data == "fb_yes":
-            await send_main_menu(user_id, "Спасибо за подтверждение.")
-            await callback.answer("Спасибо!"); return
-        if data == "fb_no_retry":
-            await send_main_menu(user_id, "Повторный анализ — пришлите фото заново.")
-            await callback.answer(); return
-        if data == "fb_no_input":
-            await bot.send_message(user_id, "Введите правильную метку текстом (или /cancel)."); await callback.answer(); return
+# feedback (simple)
+@callback_router.route("fb_yes", "fb_no_retry", "fb_no_input")
+async def feedback_callbacks(callback: types.CallbackQuery):
+    data = callback.data; user_id = callback.from_user.id
+    if data == "fb_yes":
+        await send_main_menu(user_id, "Спасибо за подтверждение.")
+        await callback.answer("Спасибо!"); return
+    if data == "fb_no_retry":
+        await send_main_menu(user_id, "Повторный анализ — пришлите фото заново.")
+        await callback.answer(); return
+    if data == "fb_no_input":
+        analysis = last_analysis.pop(user_id, None)
+        if analysis:
+            pending_action[user_id] = {"action": "label_feedback", **analysis}
+        await bot.send_message(user_id, "Введите правильную метку текстом (или /cancel)."); await callback.answer(); return
 
-    await callback.answer()
+@dp.callback_query()
+async def dispatch_callback(callback: types.CallbackQuery):
+    """Единая точка входа для всех callback-кнопок: обработчик находится по action из таблицы callback_router."""
+    try:
+        handler, args = callback_router.unpack(callback.data or "")
+    except CallbackDataError:
+        await callback.answer("Кнопка устарела — откройте меню заново.", show_alert=True)
+        return
+    if handler is None:
+        await callback.answer()
+        return
+    tracing.set_name(handler.__name__)
+    t0 = time.perf_counter()
+    try:
+        await handler(callback, *args)
+    except Exception:
+        HANDLER_ERRORS.labels(handler.__name__).inc()
+        raise
+    finally:
+        HANDLER_SECONDS.labels(handler.__name__).observe(time.perf_counter() - t0)
 
 # ---------------- Search helper ----------------
 async def do_search(message: types.Message, user_id: int, query: str):
@@ -1975,34 +3206,35 @@ async def do_search(message: types.Message, user_id: int, query: str):
     if q_short and q_short != q_norm:
         like_patterns.append(f"%{q_short}%")
 
-    async with db_pool.acquire() as conn:
-        params = [user_id]
-        idx = 2
-        where_parts = []
-        for p in like_patterns:
-            params.append(p)
-            where_parts.append(f"w.name ILIKE ${idx} OR w.color_ru ILIKE ${idx} OR w.description ILIKE ${idx} OR t.tag ILIKE ${idx}")
-            idx += 1
-        where_sql = " OR ".join(where_parts)
-        sql = f"""
-            SELECT DISTINCT w.id, w.name, w.color_ru, w.created_at
-            FROM wardrobe w
-            LEFT JOIN tags t ON t.item_id = w.id
-            WHERE w.user_id = $1 AND ({where_sql})
-            ORDER BY w.created_at DESC
-            LIMIT 200
-        """
-        rows = await conn.fetch(sql, *params)
-        print(f"[DEBUG] do_search found {len(rows)} rows for user={user_id!r} query={query!r}")
-
-    if not rows:
+    # шаблоны уходят одним массивом — текст запроса не зависит от их числа и готовится один раз;
+    # смысловой поиск идёт параллельно с запросом в БД и добавляет то, что словами не нашлось
+    lexical = repo.fetch("search", user_id, like_patterns)
+    if SEMANTIC_SEARCH:
+        rows, similar = await asyncio.gather(lexical, semantic_search(user_id, query), return_exceptions=True)
+        if isinstance(rows, BaseException):
+            raise rows
+        if isinstance(similar, BaseException):
+            print("do_search: semantic search failed:", similar)
+            similar = []
+    else:
+        rows, similar = await lexical, []
+    found_ids = {rec['id'] for rec in rows}
+    similar = [s for s in similar if s["id"] not in found_ids]
+    SEARCH_RESULTS.labels("words").observe(len(rows))
+    if SEMANTIC_SEARCH:
+        SEARCH_RESULTS.labels("semantic").observe(len(similar))
+
+    if not rows and not similar:
         await bot.send_message(user_id, "Ничего не найдено. Попробуйте другой запрос или /cancel чтобы выйти.", reply_markup=None)
         return
 
     kb_rows = []
     for rec in rows:
         name = rec['name'] or "(без названия)"; color = rec['color_ru'] or ""
-        kb_rows.append([InlineKeyboardButton(text=f"{name} — {color}".strip(), callback_data=f"view_item:{rec['id']}")])
+        kb_rows.append([InlineKeyboardButton(text=f"{name} — {color}".strip(), callback_data=cb_data("view_item", rec['id']))])
+    for rec in similar:
+        kb_rows.append([InlineKeyboardButton(text=f"≈ {rec['name'] or '(без названия)'} — {rec['color_ru']}".strip(" —"),
+                                             callback_data=cb_data("view_item", rec['id']))])
     kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
 
     bottom_kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -2010,14 +3242,182 @@ async def do_search(message: types.Message, user_id: int, query: str):
         [InlineKeyboardButton(text="⛔ Завершить поиск", callback_data="search_end")]
     ])
 
-    await bot.send_message(user_id, f"Найдено {len(rows)} предметов:", reply_markup=kb)
+    header = f"Найдено {len(rows)} предметов"
+    if similar:
+        header += f", похожих по смыслу (≈): {len(similar)}"
+    await bot.send_message(user_id, header + ":", reply_markup=kb)
     await bot.send_message(user_id, "Чтобы сделать ещё поиск — введите новый запрос. Чтобы выйти — нажмите «Завершить поиск» или /cancel.", reply_markup=bottom_kb)
 
+# ---------------- Semantic search ----------------
+# Текстовый энкодер CLIP понимает английский: известные русские слова (категории и цвета бота) переводятся
+# по CATEGORY_MAP/COLOR_MAP, остальное уходит как есть. Эмбеддинги вещей берутся из индекса подсказок
+# (get_label_index) — он уже в памяти и обновляется при сохранении и удалении вещей.
+QUERY_WORDS = {normalize_russian(ru_part): en for en, ru in {**CATEGORY_MAP, **COLOR_MAP}.items() for ru_part in ru.split("/")}
+
+def clip_query_prompt(query: str) -> str:
+    words = [QUERY_WORDS.get(normalize_russian(w), w) for w in query.split()]
+    return "a photo of " + " ".join(words)
+
+async def embed_query(query: str) -> np.ndarray:
+    key = " ".join(query.lower().split())
+    vec = query_emb_cache.get(key)
+    if vec is not None:
+        query_emb_cache.move_to_end(key)
+        return vec
+    vec = await asyncio.to_thread(clip_encode_text, clip_query_prompt(key))
+    query_emb_cache[key] = vec
+    while len(query_emb_cache) > QUERY_EMB_CACHE_SIZE:
+        query_emb_cache.popitem(last=False)
+    return vec
+
+async def semantic_search(user_id: int, query: str) -> List[Dict[str, Any]]:
+    """До SEMANTIC_TOP_K вещей, похожих на текст запроса по CLIP, по убыванию сходства."""
+    index = await get_label_index(user_id)
+    if not len(index):
+        return []
+    vec = await embed_query(query)
+    # в индексе бывают и исправления без вещи (ключ — кортеж), в выдачу идут только вещи
+    hits = index.nearest(vec, k=SEMANTIC_TOP_K, min_sim=SEMANTIC_MIN_SIM, where=lambda key: isinstance(key, int))
+    return [{"id": key, "name": labels.get("name") or CATEGORY_MAP.get(labels.get("category_en"), ""),
+             "color_ru": COLOR_MAP.get(labels.get("color_en"), ""), "sim": sim} for sim, key, labels in hits]
+
+# ---------------- Inline search ----------------
+# @bot <запрос> в любом чате: фото вещей пользователя по мере набора. Индекс (search_index.py) строится одним
+# запросом при первом inline-запросе и сбрасывается при любом изменении вещей пользователя (invalidate_item_card,
+# сохранение, импорт альбомом) — следующий запрос построит его заново
+async def get_search_index(user_id: int) -> Dict[str, Any]:
+    fut = search_indexes.get(user_id)
+    if fut is None:
+        # строим один раз, даже если запросы на каждое нажатие пришли одновременно
+        fut = search_indexes[user_id] = asyncio.ensure_future(build_search_index(user_id))
+        while len(search_indexes) > SEARCH_INDEX_USERS:
+            search_indexes.popitem(last=False)
+    else:
+        search_indexes.move_to_end(user_id)
+    try:
+        return await asyncio.shield(fut)
+    except Exception:
+        if search_indexes.get(user_id) is fut:
+            search_indexes.pop(user_id, None)
+        raise
+
+async def build_search_index(user_id: int) -> Dict[str, Any]:
+    rows = await repo.fetch("search_index_rows", user_id)
+    index = await asyncio.to_thread(search_index.build, rows)
+    items = {r['id']: {"file_id": r['file_id'], "name": r['name'] or "", "color_ru": r['color_ru'] or ""} for r in rows}
+    return {"index": index, "items": items}
+
+@dp.inline_query()
+async def inline_search(query: types.InlineQuery):
+    user_id = query.from_user.id
+    offset = int(query.offset) if (query.offset or "").isdigit() else 0
+    try:
+        found = await get_search_index(user_id)
+    except Exception as e:
+        print("inline_search: index unavailable:", e)
+        await query.answer([], cache_time=1, is_personal=True)
+        return
+    ids = found["index"].search(query.query, limit=offset + INLINE_PAGE_SIZE + 1)
+    page = ids[offset:offset + INLINE_PAGE_SIZE]
+    results = []
+    for item_id in page:
+        item = found["items"][item_id]
+        title = f"{item['name'] or '(без названия)'} — {item['color_ru']}".strip(" —")
+        results.append(types.InlineQueryResultCachedPhoto(id=str(item_id), photo_file_id=item["file_id"],
+                                                          title=title, caption=title))
+    next_offset = str(offset + INLINE_PAGE_SIZE) if len(ids) > offset + INLINE_PAGE_SIZE else ""
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, next_offset=next_offset)
+
+# ---------------- Re-embedding worker ----------------
+async def wait_for_photo_slot():
+    """
+    Фоновая пачка уступает фото пользователей: стартует, когда в photo_queue есть свободный воркер и никто
+    не ждёт, — но не позже чем через REEMBED_MAX_WAIT, чтобы под постоянной нагрузкой проход всё равно шёл.
+    """
+    deadline = time.monotonic() + REEMBED_MAX_WAIT
+    while (photo_queue.waiting or photo_queue.running >= photo_queue.workers) and time.monotonic() < deadline:
+        await asyncio.sleep(min(0.5, REEMBED_MAX_WAIT))
+
+async def reembed_batch(rows) -> Tuple[List[int], np.ndarray, int]:
+    remember_files(rows)
+    sem = asyncio.Semaphore(ALBUM_DOWNLOAD_CONCURRENCY)
+
+    async def fetch(fid: str) -> Image.Image:
+        async with sem:
+            buf = await fetch_photo(fid)
+        return await asyncio.to_thread(decode_rgb, buf)
+
+    results = await asyncio.gather(*(fetch(r['file_id']) for r in rows), return_exceptions=True)
+    loaded = [(r['id'], img) for r, img in zip(rows, results) if isinstance(img, Image.Image)]
+    if not loaded:
+        return [], np.zeros((0, 0), dtype=np.float32), len(rows)
+    embs = await asyncio.to_thread(clip_embed_batch, [img for _, img in loaded])
+    return [i for i, _ in loaded], embs, len(rows) - len(loaded)
+
+async def reembed_worker():
+    """
+    Перевычисляет emb у строк с emb_model != EMB_MODEL. Идёт по id (keyset) пачками по REEMBED_BATCH,
+    обновляет пачку одним UPDATE и в той же транзакции сохраняет last_id в reembed_progress —
+    после рестарта продолжает с места остановки. Между пачками спит REEMBED_PAUSE и пропускает вперёд
+    фото пользователей (wait_for_photo_slot): одна пачка за раз — не больше REEMBED_BATCH картинок в CLIP.
+    Дойдя до конца, начинает новый проход с id 0: устаревшие строки появляются и позже (импорт старых выгрузок),
+    а строки, чьё фото не скачалось, остаются устаревшими и пробуются снова. Если проход ничего не перевычислил,
+    следующий — через REEMBED_RECHECK секунд.
+    """
+    row = await repo.fetchrow("reembed_progress", EMB_MODEL)
+    last_id = row['last_id'] if row else 0
+    done = row['done'] if row else 0
+    failed = row['failed'] if row else 0  # неудачных попыток: такие строки остаются в очереди на следующий проход
+    pass_done = 0
+    print(f"[reembed] {EMB_MODEL}: resume from id>{last_id} (done={done}, failed={failed})")
+    while True:
+        await wait_for_photo_slot()
+        pause = REEMBED_PAUSE
+        try:
+            rows = await repo.fetch("reembed_next_batch", last_id, EMB_MODEL, REEMBED_BATCH)
+            if not rows:
+                if last_id == 0:
+                    await repo.execute("reembed_finish", EMB_MODEL, done, failed)
+                    pause = REEMBED_RECHECK
+                else:
+                    # конец прохода: строки с меньшими id могли устареть после него или не скачаться
+                    print(f"[reembed] {EMB_MODEL}: pass ended at id {last_id} (re-embedded {pass_done}, done={done}, failed={failed})")
+                    await repo.execute("reembed_checkpoint", EMB_MODEL, 0, done, failed)
+                    if pass_done == 0:
+                        pause = REEMBED_RECHECK
+                    last_id, pass_done = 0, 0
+            else:
+                ids, embs, n_failed = await reembed_batch(rows)
+                last_id = rows[-1]['id']; done += len(ids); failed += n_failed; pass_done += len(ids)
+                async with repo.transaction() as db:
+                    if ids:
+                        await db.execute("reembed_update", EMB_MODEL, ids, [emb_to_bytes(e) for e in embs])
+                    await db.execute("reembed_checkpoint", EMB_MODEL, last_id, done, failed)
+                if ids:
+                    # в индексах подсказок только вещи текущей модели — перевычисленные вещи добавляются в уже
+                    # загруженные индексы владельцев (исправления из «Нет — я введу сам(а)» остаются на месте);
+                    # графы совместимости владельцев пачки соберутся заново при следующей капсуле
+                    by_id = {r['id']: r for r in rows}
+                    for item_id, vec in zip(ids, embs):
+                        r = by_id[item_id]
+                        remember_labels(r['user_id'], item_id, vec, name=r['name'], category_en=r['category_en'],
+                                        color_en=r['color_en'])
+                    users = sorted({r['user_id'] for r in rows})
+                    await repo.execute("compat_invalidate", users)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+        await asyncio.sleep(pause)
+
 # ---------------- Startup ----------------
 async def on_startup():
-    global db_pool
-    db_pool = await create_pool_with_retries(DATABASE_URL, attempts=5, delay=2.0)
-    await init_db_and_migrate()
+    global repo
+    repo = await repository.Repository.connect(DATABASE_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+                                               command_timeout=DB_COMMAND_TIMEOUT, acquire_timeout=DB_ACQUIRE_TIMEOUT,
+                                               timeouts=DB_QUERY_TIMEOUTS, attempts=5, delay=2.0)
+    await repo.migrate()
+    await asyncio.to_thread(open_photo_cache)
     try:
         await bot.set_my_commands([
             types.BotCommand("start", "Запустить бота"),
@@ -2027,8 +3427,29 @@ async def on_startup():
     except Exception:
         pass
 
+async def on_shutdown():
+    # принятые фото пользователи ждут — даём им досчитаться (сессия бота закрывается уже после shutdown)
+    left = photo_queue.running + photo_queue.waiting
+    if not left:
+        return
+    print(f"[shutdown] waiting for {left} queued photo job(s), up to {ADMISSION_DRAIN_TIMEOUT:g}s")
+    try:
+        await asyncio.wait_for(photo_queue.drain(), ADMISSION_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"[shutdown] dropped {photo_queue.running + photo_queue.waiting} photo job(s) after timeout")
+
 async def main():
     await on_startup()
+    dp.shutdown.register(on_shutdown)
+    loop_watchdog.start()
+    if METRICS_PORT:
+        try:
+            await metrics.start_http_server(METRICS_HOST, int(METRICS_PORT))
+            print(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except Exception:
+            traceback.print_exc()
+    if REEMBED_ENABLED:
+        asyncio.create_task(reembed_worker())
     print("Bot starting...")
     await dp.start_polling(bot)
 
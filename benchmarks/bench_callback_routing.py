@@ -0,0 +1,124 @@
+"""
+Микробенчмарк маршрутизации callback-кнопок: стоимость выбора обработчика на один апдейт.
+
+Сравнивает прежнюю схему (цепочка фильтров-лямбд dp.callback_query + лестница if/startswith в
+general_callback_router) с таблицей CallbackRouter из callbacks.py. Сеть, aiogram и БД не нужны.
+
+    python benchmarks/bench_callback_routing.py [--n 200000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callbacks import CallbackRouter, TokenField  # noqa: E402
+
+# (action, поля) в порядке регистрации обработчиков в af.py
+ROUTES = [
+    ("save_capsule", ()), ("search_continue", ()), ("search_end", ()),
+    ("view_saved_cap_item", (int, int)), ("ask_del_cap", (int,)),
+    ("offer_add", (TokenField,)), ("offer_analyze", (TokenField,)), ("offer_cancel", (TokenField,)),
+    ("menu_wardrobe", ()), ("wardrobe_add_item", ()), ("wardrobe_search", ()),
+    ("wardrobe_group", (str,)), ("wardrobe_page", (int, str)), ("view_item", (int,)),
+    ("view_item_from_capsule", (int,)), ("back_to_capsule", ()), ("close_capsule", ()),
+    ("add_accept_name", ()), ("add_enter_name", ()), ("add_accept_color", ()), ("add_enter_color", ()),
+    ("add_save", ()), ("add_cancel", ()),
+    ("add_tag", (int,)), ("add_desc", (int,)), ("delete_tag", (int,)), ("delete_item", (int,)),
+    ("delete_confirm", (int,)), ("delete_cancel", ()), ("close_view", ()), ("generate_capsule", ()),
+    ("menu_generate_capsule", ()), ("menu_help", ()), ("menu_back", ()), ("menu_view_capsules", ()),
+    ("view_capsule", (int,)), ("delete_capsule_confirm", (int,)),
+    ("fb_yes", ()), ("fb_no_retry", ()), ("fb_no_input", ()),
+]
+
+
+def build_legacy():
+    """Прежняя схема: фильтры проверяются по очереди, хвост — лестница в general_callback_router."""
+    exact_first = ["save_capsule", "search_continue", "search_end"]
+    chain = [(lambda d, a=a: d == a) for a in exact_first]
+    chain += [lambda d: d and d.startswith("view_saved_cap_item:"),
+              lambda d: d and d.startswith("ask_del_cap:"),
+              lambda d: d and d.startswith("offer_"),
+              lambda d: d == "menu_wardrobe", lambda d: d == "wardrobe_add_item", lambda d: d == "wardrobe_search",
+              lambda d: d and d.startswith("wardrobe_group:"), lambda d: d and d.startswith("wardrobe_page:"),
+              lambda d: d and d.startswith("view_item:"), lambda d: d and d.startswith("view_item_from_capsule:"),
+              lambda d: d == "back_to_capsule", lambda d: d == "close_capsule",
+              lambda d: d is not None and d in {"add_accept_name", "add_enter_name", "add_accept_color",
+                                                "add_enter_color", "add_save", "add_cancel"},
+              lambda d: d and d.startswith("add_tag:"), lambda d: d and d.startswith("add_desc:"),
+              lambda d: d and d.startswith("delete_tag:"), lambda d: d and d.startswith("delete_item:"),
+              lambda d: d and d.startswith("delete_confirm:"), lambda d: d == "delete_cancel",
+              lambda d: d == "close_view", lambda d: d == "generate_capsule"]
+
+    def ladder(d):
+        if d == "menu_generate_capsule": return 1
+        if d == "menu_help": return 2
+        if d == "menu_back": return 3
+        if d == "menu_view_capsules": return 4
+        if d.startswith("view_capsule:"):
+            return int(d.split(":", 1)[1])
+        if d.startswith("delete_capsule_confirm:"):
+            return int(d.split(":", 1)[1])
+        if d.startswith("fb_"):
+            return 5
+        return 0
+
+    def route(d):
+        for i, pred in enumerate(chain):
+            if pred(d):
+                parts = d.split(":")
+                return i, [int(p) if p.isdigit() else p for p in parts[1:]]
+        return ladder(d)
+
+    return route
+
+
+def build_table():
+    router = CallbackRouter()
+    handler = lambda *a: None  # noqa: E731
+    for action, fields in ROUTES:
+        router.route(action, fields=fields)(handler)
+    return router
+
+
+def workload(router):
+    """Смесь апдейтов, похожая на реальную: навигация по гардеробу, карточки, капсулы, фидбек."""
+    file_id = "AgACAgIAAxkBAAIBQ2ZrY3VzdG9tX2ZpbGVfaWRfdGhhdF9pc19sb25nX2Vub3VnaF90b19icmVha182NA"
+    return [
+        "menu_wardrobe", "wardrobe_group:tops", "wardrobe_page:3:tops", "view_item:1842",
+        "add_tag:1842", "delete_tag:99120", "menu_back", "menu_view_capsules", "view_capsule:731",
+        "view_saved_cap_item:1842:731", "delete_capsule_confirm:731", "fb_no_input",
+        router.pack("offer_add", file_id), "add_accept_color", "generate_capsule",
+    ]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--n", type=int, default=200000, help="число маршрутизаций на каждую схему")
+    args = ap.parse_args()
+
+    router = build_table()
+    legacy = build_legacy()
+    data = workload(router)
+    k = len(data)
+
+    def run_table():
+        for d in data:
+            router.unpack(d)
+
+    def run_legacy():
+        for d in data:
+            legacy(d)
+
+    reps = max(1, args.n // k)
+    for name, fn in (("legacy_chain", run_legacy), ("dispatch_table", run_table)):
+        best = min(timeit.repeat(fn, number=reps, repeat=5))
+        print(f"{name:15s} {best / (reps * k) * 1e9:8.1f} ns/update")
+
+    pack_t = min(timeit.repeat(lambda: router.pack("view_saved_cap_item", 1842, 731), number=args.n, repeat=5))
+    print(f"{'pack':15s} {pack_t / args.n * 1e9:8.1f} ns/call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Бенчмарк определения цвета: пиксельный движок (colors.py) против zero-shot прохода CLIP (af.clip_color_logits).
+
+Размеченный набор синтетический: силуэт вещи эталонного оттенка (с разбросом и шумом) на светлом, сером
+или тёмном фоне — для него считается точность каждого движка. С --images DIR добавляются настоящие фото
+(jpg/png) — для них истины нет, считается только согласие движков между собой.
+Для CLIP нужна та же среда, что и боту (torch, clip, веса в локальном кэше); без неё меряется только pixels.
+
+    python benchmarks/bench_color_engine.py [--per-color 6] [--images ~/wardrobe_photos] [--out colors.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+os.environ.setdefault("tg_bot_token", "123456:BENCHMARK")
+os.environ.setdefault("DATABASE_URL", "postgres://bench@localhost/bench")
+os.environ.setdefault("REEMBED_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import colors  # noqa: E402
+
+LABELS = ["white", "black", "gray", "red", "orange", "yellow", "green", "blue", "purple", "pink", "brown", "beige",
+          "maroon", "olive"]
+BACKGROUNDS = [(248, 248, 246), (205, 205, 200), (55, 55, 60), (230, 220, 200)]
+
+
+def garment(rng, color: Tuple[int, int, int], background: Tuple[int, int, int], size=(768, 1024)) -> Image.Image:
+    w, h = size
+    im = Image.new("RGB", size, background)
+    d = ImageDraw.Draw(im)
+    jitter = lambda v: int(np.clip(v + rng.integers(-12, 13), 0, 255))  # noqa: E731
+    fill = tuple(jitter(v) for v in color)
+    cx, top, bottom = w * rng.uniform(0.4, 0.6), h * rng.uniform(0.1, 0.25), h * rng.uniform(0.8, 0.95)
+    half_top, half_bottom = w * rng.uniform(0.2, 0.3), w * rng.uniform(0.25, 0.38)
+    d.polygon([(cx - half_top, top), (cx + half_top, top), (cx + half_bottom, bottom), (cx - half_bottom, bottom)], fill=fill)
+    # пуговицы/принт — немного чужого цвета поверх
+    for _ in range(int(rng.integers(0, 4))):
+        r = w * 0.02
+        x, y = cx + rng.uniform(-half_top, half_top) * 0.5, rng.uniform(top, bottom)
+        d.ellipse([x - r, y - r, x + r, y + r], fill=tuple(int(v) for v in rng.integers(0, 256, 3)))
+    arr = np.asarray(im).astype(np.int16) + rng.integers(-8, 9, (h, w, 3))
+    return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+
+
+def labelled_set(per_color: int, seed: int = 0) -> List[Tuple[Image.Image, str]]:
+    rng = np.random.default_rng(seed)
+    out = []
+    for label in LABELS:
+        shades = colors.PALETTE[label]
+        for i in range(per_color):
+            out.append((garment(rng, shades[i % len(shades)], BACKGROUNDS[i % len(BACKGROUNDS)]), label))
+    return out
+
+
+def load_photos(path: str) -> List[Image.Image]:
+    out = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
+            with Image.open(os.path.join(path, name)) as im:
+                out.append(im.convert("RGB"))
+    return out
+
+
+def clip_engine() -> Optional[Callable[[Image.Image], str]]:
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            import af
+            import torch
+    except Exception as e:
+        print(f"clip: skipped ({type(e).__name__}: {e})", file=sys.stderr)
+        return None
+
+    def predict(img: Image.Image) -> str:
+        image_input = af.preprocess(img).unsqueeze(0).to(af.device)
+        return af.COLOR_LABELS[int(torch.argmax(af.clip_color_logits(image_input)).item())]
+    return predict
+
+
+def pixel_engine(img: Image.Image) -> str:
+    return colors.dominant_colors(img, LABELS)[0][0]
+
+
+def run_engine(predict: Callable[[Image.Image], str], images: List[Image.Image]) -> Tuple[List[str], Dict[str, float]]:
+    predict(images[0])  # прогрев
+    times, out = [], []
+    for img in images:
+        t0 = time.perf_counter()
+        out.append(predict(img))
+        times.append((time.perf_counter() - t0) * 1000)
+    times.sort()
+    return out, {"p50_ms": statistics.median(times), "p95_ms": times[min(len(times) - 1, int(0.95 * len(times)))],
+                 "mean_ms": statistics.fmean(times)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--per-color", type=int, default=6, help="синтетических картинок на цвет")
+    ap.add_argument("--images", help="папка с настоящими фото (только согласие движков)")
+    ap.add_argument("--no-clip", action="store_true", help="не загружать CLIP")
+    ap.add_argument("--out", help="записать результат в JSON")
+    args = ap.parse_args()
+
+    data = labelled_set(args.per_color)
+    images = [im for im, _ in data]
+    truth = [label for _, label in data]
+    photos = load_photos(args.images) if args.images else []
+
+    engines: Dict[str, Callable[[Image.Image], str]] = {"pixels": pixel_engine}
+    if not args.no_clip:
+        clip_predict = clip_engine()
+        if clip_predict is not None:
+            engines["clip"] = clip_predict
+
+    result: Dict[str, Any] = {"meta": {"synthetic": len(images), "photos": len(photos)}, "engines": {}}
+    preds: Dict[str, Dict[str, List[str]]] = {}
+    for name, predict in engines.items():
+        got, stats = run_engine(predict, images)
+        stats["accuracy"] = sum(g == t for g, t in zip(got, truth)) / len(truth)
+        preds[name] = {"synthetic": got}
+        if photos:
+            preds[name]["photos"], photo_stats = run_engine(predict, photos)
+            stats["photo_p50_ms"] = photo_stats["p50_ms"]
+        result["engines"][name] = {k: round(v, 4) for k, v in stats.items()}
+        print(f"{name:<8} p50 {stats['p50_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms  accuracy {stats['accuracy']:.1%}",
+              file=sys.stderr)
+
+    if "clip" in preds:
+        for subset in ("synthetic", "photos"):
+            a, b = preds["pixels"].get(subset), preds["clip"].get(subset)
+            if a:
+                agree = sum(x == y for x, y in zip(a, b)) / len(a)
+                result[f"agreement_{subset}"] = round(agree, 4)
+                print(f"agreement pixels/clip on {subset}: {agree:.1%}", file=sys.stderr)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
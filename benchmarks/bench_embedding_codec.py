@@ -0,0 +1,81 @@
+"""
+Бенчмарк форматов хранения эмбеддингов (embeddings.py): размер строки, скорость раскодирования
+и расхождение оценок капсулы относительно float32.
+
+Векторы синтетические: нормированные, сгруппированные вокруг нескольких центров (как вещи одной категории).
+Расхождение считается на тех же величинах, что и generate_capsule_items_for_user: косинус пары верх/низ
+и косинус кандидата к центроиду выбранных вещей; плюс доля совпадений лучшей пары.
+
+    python benchmarks/bench_embedding_codec.py [--n 2000] [--dim 512]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embeddings  # noqa: E402
+
+
+def make_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((12, dim)).astype(np.float32)
+    v = centers[rng.integers(0, len(centers), n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return (v / np.linalg.norm(v, axis=1, keepdims=True)).astype(np.float32)
+
+
+def cos_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / (np.linalg.norm(a, axis=1, keepdims=True) + 1e-8)
+    b = b / (np.linalg.norm(b, axis=1, keepdims=True) + 1e-8)
+    return a @ b.T
+
+
+def best_pair_agreement(ref: np.ndarray, got: np.ndarray, group: int, rng) -> float:
+    """Доля случайных наборов кандидатов (как в капсуле: по group верхов и низов), где лучшая пара та же."""
+    trials, same = 200, 0
+    for _ in range(trials):
+        idx = rng.choice(len(ref), 2 * group, replace=False)
+        t, b = idx[:group], idx[group:]
+        same += int(np.argmax(cos_matrix(ref[t], ref[b])) == np.argmax(cos_matrix(got[t], got[b])))
+    return same / trials
+
+
+def bench(vecs: np.ndarray, codec: str, repeat: int):
+    blobs = [v.tobytes() for v in vecs] if codec == "legacy" else [embeddings.encode(v, codec) for v in vecs]
+    out = np.empty(vecs.shape, dtype=np.float32)
+    best_matrix = best_rows = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter(); embeddings.decode_matrix(blobs, out=out); best_matrix = min(best_matrix, time.perf_counter() - t0)
+        t0 = time.perf_counter(); [embeddings.decode(b) for b in blobs]; best_rows = min(best_rows, time.perf_counter() - t0)
+    return blobs, out, best_matrix, best_rows
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=2000)
+    ap.add_argument("--dim", type=int, default=512)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--group", type=int, default=25, help="кандидатов на группу (candidates_per_group)")
+    args = ap.parse_args()
+
+    vecs = make_vectors(args.n, args.dim)
+    ref_pairs = cos_matrix(vecs[: args.n // 2], vecs[args.n // 2:])
+    cent = vecs[:3].mean(axis=0, keepdims=True)
+    ref_cent = cos_matrix(vecs, cent)
+
+    print(f"n={args.n} dim={args.dim}")
+    print(f"{'codec':<8}{'bytes/row':>10}{'matrix us/row':>15}{'decode us/row':>15}{'pair |d| max':>14}{'pair |d| mean':>15}{'centroid |d| max':>18}{'best pair same':>16}")
+    for codec in ("legacy", "f32", "f16", "int8"):
+        blobs, got, t_matrix, t_rows = bench(vecs, codec, args.repeat)
+        d_pairs = np.abs(cos_matrix(got[: args.n // 2], got[args.n // 2:]) - ref_pairs)
+        d_cent = np.abs(cos_matrix(got, got[:3].mean(axis=0, keepdims=True)) - ref_cent)
+        agree = best_pair_agreement(vecs, got, args.group, np.random.default_rng(1))
+        print(f"{codec:<8}{len(blobs[0]):>10}{t_matrix / args.n * 1e6:>15.2f}{t_rows / args.n * 1e6:>15.2f}"
+              f"{d_pairs.max():>14.2e}{d_pairs.mean():>15.2e}{d_cent.max():>18.2e}{agree:>16.1%}")
+
+
+if __name__ == "__main__":
+    main()
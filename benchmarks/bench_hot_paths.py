@@ -0,0 +1,425 @@
+"""
+Бенчмарк горячих путей бота без Telegram: CLIP-инференс, полный разбор фото (on_photo),
+generate_capsule_items_for_user, do_search и глубокие страницы show_wardrobe_list
+на синтетических гардеробах разного размера.
+
+Bot подменяется заглушкой (ничего не отправляет, get_file/download_file отдают синтетический JPEG).
+База — либо встроенная in-memory замена (по умолчанию; измеряет Python-часть обработчиков, SQL не исполняется),
+либо настоящий Postgres через --dsn: синтетические вещи пишутся под отрицательными user_id и удаляются после прогона.
+Нужна та же среда, что и боту (torch, clip, веса модели в локальном кэше); сеть не используется.
+
+    python benchmarks/bench_hot_paths.py --sizes 10,100,1000,10000 --out bench.json
+    python benchmarks/bench_hot_paths.py --baseline bench.json          # сравнить с сохранённым прогоном
+    python benchmarks/bench_hot_paths.py --dsn postgres://... --only capsule,search,page
+
+Результат — JSON: {"meta": {...}, "results": [{"name", "size", "runs", "p50_ms", "p95_ms", "mean_ms", "min_ms"}]}.
+С --baseline выводит отношение p50 к базовому и завершается с кодом 1, если что-то медленнее в --tolerance раз.
+С --strict-loop-ms прогон идёт под сторожем event loop (loopwatch): бенчмарк, который держал цикл дольше N мс,
+получает loop_blocked_ms, а весь прогон завершается с кодом 2. По умолчанию порог берётся из LOOP_STRICT_MS
+(тот же, что у строгого режима бота), так что один env включает проверку и в боте, и в CI.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+os.environ.setdefault("tg_bot_token", "123456:BENCHMARK")
+os.environ.setdefault("DATABASE_URL", "postgres://bench@localhost/bench")
+os.environ.setdefault("REEMBED_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+from aiogram import types  # noqa: E402
+
+with contextlib.redirect_stdout(sys.stderr):
+    import af  # noqa: E402
+import embeddings  # noqa: E402
+import loopwatch  # noqa: E402
+import repository  # noqa: E402
+
+BENCHES = ("clip", "photo", "capsule", "search", "page")
+SEARCH_QUERIES = ["чёрный", "платье", "офис", "синий", "кроссовки"]
+WORDS = ["офис", "лето", "вечер", "спорт", "дача", "поездка", "любимое", "новое", "хлопок", "шерсть"]
+
+
+def synthetic_jpeg(seed: int = 0, size=(768, 1024)) -> bytes:
+    rng = random.Random(seed)
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle([x0, y0, x0 + rng.randrange(50, 300), y0 + rng.randrange(50, 300)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    bio = io.BytesIO(); img.save(bio, "JPEG", quality=85)
+    return bio.getvalue()
+
+
+# ---------------- Stub Bot ----------------
+class StubBot:
+    """Отвечает на любой метод Bot API «отправленным сообщением»; файлы отдаёт из памяти."""
+
+    def __init__(self, photo: bytes):
+        self.photo = photo
+        self.calls = 0
+        self._next_id = 0
+
+    async def get_file(self, file_id: str):
+        self.calls += 1
+        return SimpleNamespace(file_id=file_id, file_path=f"photos/{file_id}.jpg")
+
+    async def download_file(self, file_path: str, destination=None, **kwargs):
+        self.calls += 1
+        destination.write(self.photo)
+        return destination
+
+    def __getattr__(self, name):
+        async def method(*args, **kwargs):
+            self.calls += 1
+            self._next_id += 1
+            chat_id = kwargs.get("chat_id") or (args[0] if args and isinstance(args[0], int) else 0)
+            return SimpleNamespace(message_id=self._next_id, chat=SimpleNamespace(id=chat_id),
+                                   photo=[SimpleNamespace(file_id=f"stub-{self._next_id}")])
+        return method
+
+
+# ---------------- In-memory DB stand-in ----------------
+class MemorySession:
+    """
+    Исполняет ровно те именованные запросы (repository.STATEMENTS), что делают измеряемые функции, по данным в памяти.
+    Незнакомое имя — NotImplementedError: значит, af.py стал делать другой запрос и замену надо обновить.
+    """
+
+    def __init__(self, db: "MemoryDB"):
+        self.db = db
+
+    async def fetch(self, name: str, *args):
+        if name == "capsule_items":
+            user_id, ids = args
+            wanted = set(ids)
+            return [r for r in self.db.items(user_id) if r["id"] in wanted]
+        if name == "compat_group_rows":
+            user_id, grps = args
+            return [{"item_id": i, "grp": g, "neighbors": b} for (i, g), (u, b) in self.db.neighbors.items()
+                    if u == user_id and g in grps]
+        if name == "compat_lists":
+            user_id, ids, grps = args
+            return [{"item_id": i, "grp": g, "neighbors": self.db.neighbors[(i, g)][1]} for i in ids for g in grps
+                    if (i, g) in self.db.neighbors and self.db.neighbors[(i, g)][0] == user_id]
+        if name == "wardrobe_page_group":
+            user_id, cats, limit, offset = args
+            rows = [r for r in self.db.items(user_id) if r["category_en"] in cats]
+            return rows[offset:offset + limit]
+        if name == "wardrobe_page":
+            user_id, limit, offset = args
+            return self.db.items(user_id)[offset:offset + limit]
+        if name == "label_index_rows":
+            user_id, emb_model = args
+            return [r for r in self.db.items(user_id) if r["emb"] is not None]
+        if name == "search":
+            user_id, patterns = args
+            needles = [p.strip("%").lower() for p in patterns]
+            out = []
+            for r in self.db.items(user_id):
+                hay = [(r["name"] or "").lower(), (r["color_ru"] or "").lower(), (r["description"] or "").lower()]
+                hay += [t.lower() for t in r["tags"]]
+                if any(n in h for n in needles for h in hay):
+                    out.append(r)
+                    if len(out) >= 200:
+                        break
+            return out
+        raise NotImplementedError(f"in-memory DB: unsupported statement: {name}")
+
+    async def fetchval(self, name: str, *args):
+        if name == "wardrobe_count_group":
+            return sum(1 for r in self.db.items(args[0]) if r["category_en"] in args[1])
+        if name == "wardrobe_count":
+            return len(self.db.items(args[0]))
+        if name == "compat_state":
+            return 1 if self.db.neighbor_state.get(args[0]) == tuple(args[1:]) else None
+        raise NotImplementedError(f"in-memory DB: unsupported statement: {name}")
+
+    async def fetchrow(self, name: str, *args):
+        rows = await self.fetch(name, *args)
+        return rows[0] if rows else None
+
+    async def execute(self, name: str, *args):
+        if name == "compat_clear":
+            for key in [k for k, (u, _) in self.db.neighbors.items() if u == args[0]]:
+                del self.db.neighbors[key]
+        elif name == "compat_upsert":
+            user_id, ids, grps, blobs = args
+            for i, g, b in zip(ids, grps, blobs):
+                self.db.neighbors[(i, g)] = (user_id, b)
+        elif name == "compat_mark_built":
+            self.db.neighbor_state[args[0]] = tuple(args[1:])
+        return None
+
+
+class MemoryDB:
+    """Тот же интерфейс, что у repository.Repository, поверх словаря user_id -> вещи."""
+
+    def __init__(self):
+        self.by_user: Dict[int, List[Dict[str, Any]]] = {}
+        self.neighbors: Dict[Any, Any] = {}  # (item_id, grp) -> (user_id, neighbors) — как item_neighbors
+        self.neighbor_state: Dict[int, Any] = {}  # user_id -> (emb_model, k) — как item_neighbors_state
+
+    def items(self, user_id: int) -> List[Dict[str, Any]]:
+        return self.by_user.get(user_id, [])
+
+    async def seed(self, user_id: int, rows: List[Dict[str, Any]]):
+        # как ORDER BY created_at DESC
+        self.by_user[user_id] = sorted(rows, key=lambda r: r["created_at"], reverse=True)
+
+    async def cleanup(self, user_ids: List[int]):
+        for uid in user_ids:
+            self.by_user.pop(uid, None)
+            self.neighbor_state.pop(uid, None)
+        self.neighbors = {k: v for k, v in self.neighbors.items() if v[0] not in user_ids}
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        yield MemorySession(self)
+
+    transaction = session
+
+    async def fetch(self, name: str, *args):
+        return await MemorySession(self).fetch(name, *args)
+
+    async def fetchrow(self, name: str, *args):
+        return await MemorySession(self).fetchrow(name, *args)
+
+    async def fetchval(self, name: str, *args):
+        return await MemorySession(self).fetchval(name, *args)
+
+    async def execute(self, name: str, *args):
+        return await MemorySession(self).execute(name, *args)
+
+    async def read_many(self, *reads):
+        db = MemorySession(self)
+        return [await getattr(db, method)(name, *args) for method, name, *args in reads]
+
+
+class PostgresDB:
+    """Настоящая база через repository.Repository: схема — repo.migrate(), данные пишутся одной вставкой на размер."""
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    async def seed(self, user_id: int, rows: List[Dict[str, Any]]):
+        await self.cleanup([user_id])
+        # у синтетических вещей разные created_at — вставка своя, не items_insert_bulk
+        async with self.repo.transaction() as db:
+            ids = await db.conn.fetch("""
+                INSERT INTO wardrobe (user_id, file_id, emb, emb_model, name, color_en, color_ru, category_en, category_ru, created_at, description)
+                SELECT $1, f, e, $2, n, ce, cr, ke, kr, c, d
+                FROM unnest($3::text[], $4::bytea[], $5::text[], $6::text[], $7::text[], $8::text[], $9::text[],
+                            $10::timestamptz[], $11::text[]) AS u(f, e, n, ce, cr, ke, kr, c, d)
+                RETURNING id
+            """, user_id, af.EMB_MODEL, *[[r[k] for r in rows] for k in (
+                "file_id", "emb", "name", "color_en", "color_ru", "category_en", "category_ru", "created_at", "description")])
+            tag_records = [(rec["id"], user_id, t) for rec, r in zip(ids, rows) for t in r["tags"]]
+            if tag_records:
+                await db.conn.copy_records_to_table("tags", records=tag_records, columns=["item_id", "user_id", "tag"])
+
+    async def cleanup(self, user_ids: List[int]):
+        async with self.repo.session() as db:
+            await db.conn.execute("DELETE FROM wardrobe WHERE user_id = ANY($1::bigint[])", user_ids)
+            await db.conn.execute("DELETE FROM item_neighbors_state WHERE user_id = ANY($1::bigint[])", user_ids)
+
+
+def synthetic_rows(n: int, seed: int) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(seed)
+    cats = af.CLOTHING_CATEGORIES; colors = list(af.COLOR_MAP)
+    vecs = rng.standard_normal((n, 512)).astype(np.float32)
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    now = datetime.now(timezone.utc)
+    rows = []
+    for i in range(n):
+        cat = cats[int(rng.integers(len(cats)))]; color = colors[int(rng.integers(len(colors)))]
+        words = [WORDS[int(j)] for j in rng.choice(len(WORDS), size=2, replace=False)]  # теги вещи уникальны (uq_tags_item_lower)
+        rows.append({
+            "id": i + 1, "file_id": f"bench-{seed}-{i}", "emb": embeddings.encode(vecs[i], af.EMB_CODEC),
+            "name": af.CATEGORY_MAP.get(cat, cat), "color_en": color, "color_ru": af.COLOR_MAP[color],
+            "category_en": cat, "category_ru": af.CATEGORY_MAP.get(cat, cat),
+            "created_at": now - timedelta(minutes=i), "description": " ".join(words),
+            "tags": words[:int(rng.integers(0, 3))]
+        })
+    return rows
+
+
+def photo_message(user_id: int) -> types.Message:
+    return types.Message(
+        message_id=1, date=datetime.now(timezone.utc),
+        chat=types.Chat(id=user_id, type="private"),
+        from_user=types.User(id=user_id, is_bot=False, first_name="bench"),
+        photo=[types.PhotoSize(file_id="bench-photo", file_unique_id="bench-photo", width=768, height=1024)])
+
+
+# ---------------- Runner ----------------
+async def measure(fn, runs: int, warmup: int = 1, strict_loop_ms: float = None) -> Dict[str, float]:
+    for _ in range(warmup):
+        await fn()
+    wd = loopwatch.LoopWatchdog(interval=0.005, threshold_ms=strict_loop_ms, strict_ms=strict_loop_ms,
+                                log=lambda _: None).start() if strict_loop_ms else None
+    samples = []
+    try:
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            await fn()
+            samples.append((time.perf_counter() - t0) * 1000)
+        if wd:
+            await asyncio.sleep(0.01)
+    finally:
+        if wd:
+            await wd.stop()
+    samples.sort()
+    stats = {"runs": runs, "p50_ms": statistics.median(samples),
+             "p95_ms": samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+             "mean_ms": statistics.fmean(samples), "min_ms": samples[0]}
+    if wd and wd.violations:
+        stats["loop_blocked_ms"] = max(v["lag_ms"] for v in wd.violations)
+    return stats
+
+
+async def run(args) -> List[Dict[str, Any]]:
+    photo = synthetic_jpeg()
+    af.bot = StubBot(photo)
+    if args.dsn:
+        af.repo = await repository.Repository.connect(args.dsn, attempts=1)
+        await af.repo.migrate()
+        db = PostgresDB(af.repo)
+    else:
+        db = af.repo = MemoryDB()
+
+    results = []
+
+    async def measure_(fn, runs):
+        return await measure(fn, runs, strict_loop_ms=args.strict_loop_ms)
+
+    def record(name: str, size: int, stats: Dict[str, float]):
+        results.append({"name": name, "size": size, **{k: round(v, 4) if isinstance(v, float) else v for k, v in stats.items()}})
+        blocked = f"  loop blocked {stats['loop_blocked_ms']:.0f} ms" if "loop_blocked_ms" in stats else ""
+        print(f"{name:<24}{size:>7}  p50 {stats['p50_ms']:9.3f} ms  p95 {stats['p95_ms']:9.3f} ms{blocked}", file=sys.stderr)
+
+    if "clip" in args.only:
+        image_input = af.preprocess(Image.open(io.BytesIO(photo)).convert("RGB")).unsqueeze(0).to(af.device)
+
+        async def cat():
+            af.clip_infer_logits(image_input)
+
+        async def col():
+            af.clip_color_logits(image_input)
+        record("clip_infer_logits", 1, await measure_(cat, args.runs))
+        record("clip_color_logits", 1, await measure_(col, args.runs))
+
+    if "photo" in args.only:
+        uid = -1
+        msg = photo_message(uid)
+
+        async def analyze():
+            af.pending_add[uid] = {"stage": "wait_photo"}
+            await af.on_photo(msg)
+        record("photo_analysis", 1, await measure_(analyze, args.runs))
+        af.pending_add.pop(uid, None)
+
+    user_ids = []
+    try:
+        for size in args.sizes:
+            if not ({"capsule", "search", "page"} & set(args.only)):
+                break
+            uid = -1000 - size
+            user_ids.append(uid)
+            await db.seed(uid, synthetic_rows(size, seed=size))
+
+            if "capsule" in args.only:
+                async def capsule():
+                    await af.generate_capsule_items_for_user(uid)
+                record("generate_capsule", size, await measure_(capsule, args.runs))
+
+            if "search" in args.only:
+                msg = photo_message(uid)
+                queries = iter(SEARCH_QUERIES * (args.runs + 1))
+
+                async def search():
+                    await af.do_search(msg, uid, next(queries))
+                record("do_search", size, await measure_(search, args.runs))
+
+            if "page" in args.only:
+                last_page = max(0, (size - 1) // af.PAGE_SIZE)
+
+                async def deep_page():
+                    await af.show_wardrobe_list(None, uid, page=last_page)
+                record("wardrobe_last_page", size, await measure_(deep_page, args.runs))
+    finally:
+        if user_ids:
+            await db.cleanup(user_ids)
+        if args.dsn:
+            await af.repo.close()
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, tolerance: float) -> bool:
+    with open(baseline_path, encoding="utf-8") as f:
+        base = {(r["name"], r["size"]): r for r in json.load(f)["results"]}
+    ok = True
+    print(f"\n{'bench':<24}{'size':>7}{'base p50':>12}{'p50':>12}{'ratio':>8}", file=sys.stderr)
+    for r in results:
+        b = base.get((r["name"], r["size"]))
+        if not b:
+            continue
+        ratio = r["p50_ms"] / b["p50_ms"] if b["p50_ms"] else float("inf")
+        flag = "  REGRESSION" if ratio > tolerance else ""
+        ok = ok and not flag
+        print(f"{r['name']:<24}{r['size']:>7}{b['p50_ms']:>12.3f}{r['p50_ms']:>12.3f}{ratio:>8.2f}{flag}", file=sys.stderr)
+    return ok
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="10,100,1000,10000", help="размеры гардероба через запятую")
+    ap.add_argument("--runs", type=int, default=20)
+    ap.add_argument("--only", default=",".join(BENCHES), help=f"подмножество из {','.join(BENCHES)}")
+    ap.add_argument("--dsn", default=None, help="прогон на настоящем Postgres вместо in-memory замены")
+    ap.add_argument("--out", default=None, help="куда записать JSON (по умолчанию stdout)")
+    ap.add_argument("--baseline", default=None, help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--tolerance", type=float, default=1.2, help="допустимое отношение p50 к базовому")
+    ap.add_argument("--strict-loop-ms", type=float, default=af.LOOP_STRICT_MS,
+                    help="падать (код 2), если измеряемый код блокирует event loop дольше N мс (по умолчанию $LOOP_STRICT_MS)")
+    args = ap.parse_args()
+    args.sizes = [int(s) for s in args.sizes.split(",") if s]
+    args.only = [s for s in args.only.split(",") if s]
+
+    with contextlib.redirect_stdout(sys.stderr):  # отладочные print() из af.py не должны смешиваться с JSON
+        results = asyncio.run(run(args))
+
+    report = {"meta": {"created_at": datetime.now(timezone.utc).isoformat(), "python": platform.python_version(),
+                       "machine": platform.machine(), "device": af.device, "db": "postgres" if args.dsn else "memory",
+                       "emb_codec": af.EMB_CODEC, "runs": args.runs},
+              "results": results}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+    blocked = [f"{r['name']}[{r['size']}] {r['loop_blocked_ms']:.0f}ms" for r in results if "loop_blocked_ms" in r]
+    if blocked:
+        print(f"event loop blocked longer than {args.strict_loop_ms:.0f}ms: " + ", ".join(blocked), file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""
+Нагрузочный прогон бота целиком, без Telegram: виртуальные пользователи шлют реалистичные потоки апдейтов
+в dp.feed_update, а бот ходит в локальный поддельный Bot API (aiohttp) с настраиваемой задержкой ответа.
+
+Поток (flow) — то, что делает живой пользователь, от первого апдейта до последнего ответа бота:
+    start    — /start;
+    add      — «Добавить вещь», фото, «Принять название», «Принять цвет», «Сохранить»;
+    analyze  — фото вне добавления, «Проанализировать», «Да, верно»;
+    page     — «Мой гардероб», «Все вещи», следующая страница;
+    search   — «Поиск» и текст запроса;
+    capsule  — «Создать капсулу» (коллаж скачивает фото вещей из поддельного API).
+Кнопки пользователь нажимает те, что бот ему показал: поддельный API запоминает клавиатуры сообщений по чатам.
+Фото анализируются в фоне (admission.py) — поток ждёт появления следующей кнопки, поэтому в его время входят
+и очередь, и CLIP; переполненная очередь видна как ошибки по таймауту.
+
+Нужна та же среда, что боту (torch, clip, веса модели), и Postgres: гардеробы виртуальных пользователей
+засеваются синтетическими вещами под user_id от USER_ID_BASE и удаляются после прогона. Поддельный API
+работает в том же процессе и event loop, что и бот, — он лёгкий, но его доля в задержке цикла тоже видна.
+
+    python benchmarks/load_test.py --dsn postgres://postgres@127.0.0.1:5432/bot --users 20 --duration 20 --ramp 3 \
+        --latency-ms 40 --out load.json
+    python benchmarks/load_test.py --dsn ... --users 50 --duration 60 --mix start=1,add=1,page=4,search=2,capsule=1
+    LOOP_STRICT_MS=50 python benchmarks/load_test.py --dsn ...   # код 2, если цикл стоял дольше 50 мс
+
+Результат — JSON: {"meta": {...}, "totals": {...}, "flows": [{"name", "runs", "errors", "error_rate",
+"p50_ms", "p99_ms", "mean_ms", "error_types"}], "api_calls": {метод: число}}; таблица — в stderr.
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+os.environ.setdefault("PHOTO_CACHE_DIR", tempfile.mkdtemp(prefix="load-test-photos-"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiohttp import web  # noqa: E402
+from aiogram import Bot, types  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+import bench_hot_paths as bench  # noqa: E402  (импортирует af с тестовым токеном и без re-embed)
+
+af = bench.af
+repository = bench.repository
+
+FLOWS = ("start", "add", "analyze", "page", "search", "capsule")
+DEFAULT_MIX = "start=1,add=2,analyze=1,page=4,search=2,capsule=1"
+USER_ID_BASE = 7_000_000_000
+
+UPDATE_IDS = itertools.count(1)
+USER_MESSAGE_IDS = itertools.count(10_000_000)
+CALLBACK_IDS = itertools.count(1)
+PHOTO_IDS = itertools.count(1)
+
+
+# ---------------- Fake Bot API ----------------
+class FakeBotAPI:
+    """
+    Отвечает на методы Bot API как Telegram: отправка и правка сообщений возвращают Message, getFile — путь,
+    /file/... — синтетический JPEG (или картинку, которую бот сам загрузил, например коллаж). Каждый вызов
+    ждёт latency ± jitter секунд. Клавиатуры отправленных и изменённых сообщений запоминаются по чатам.
+    """
+    MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageCaption",
+                       "editMessageReplyMarkup", "editMessageMedia"}
+    EVENTS_PER_CHAT = 50
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.url: Optional[str] = None
+        self._photo = bench.synthetic_jpeg()
+        self._files: Dict[str, bytes] = {}  # file_id -> загруженные ботом байты
+        self._message_ids = itertools.count(1)
+        self._upload_ids = itertools.count(1)
+        self._seq = 0
+        self._events: Dict[int, List[Tuple[int, int, List[str]]]] = {}  # chat_id -> (seq, message_id, кнопки)
+        self._changed = asyncio.Condition()
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> "FakeBotAPI":
+        app = web.Application(client_max_size=64 << 20)
+        app.router.add_route("*", "/bot{token}/{method}", self._method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def mark(self) -> int:
+        """Отметка «сейчас»: wait_button/shown ищут кнопки, показанные после неё."""
+        return self._seq
+
+    def shown(self, chat_id: int, prefix: str, after: int) -> Optional[Tuple[int, str]]:
+        """(message_id, callback_data) самой свежей кнопки с этим action, показанной после after."""
+        current = set()  # правка сообщения заменяет его клавиатуру — старые кнопки этого сообщения не в счёт
+        for seq, message_id, buttons in reversed(self._events.get(chat_id, ())):
+            if seq <= after:
+                break
+            if message_id in current:
+                continue
+            current.add(message_id)
+            for data in buttons:
+                if data == prefix or data.startswith(prefix + ":"):
+                    return message_id, data
+        return None
+
+    async def wait_button(self, chat_id: int, prefix: str, after: int, timeout: float) -> Tuple[int, str]:
+        async with self._changed:
+            return await asyncio.wait_for(self._changed.wait_for(lambda: self.shown(chat_id, prefix, after)), timeout)
+
+    async def _delay(self):
+        delay = self.rng.gauss(self.latency, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+        self.calls[method] += 1
+        await self._delay()
+        return web.json_response({"ok": True, "result": await self._answer(method, form)})
+
+    async def _file(self, request: web.Request) -> web.Response:
+        await self._delay()
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        return web.Response(body=self._files.get(file_id, self._photo), content_type="image/jpeg")
+
+    async def _answer(self, method: str, form) -> Any:
+        chat_id = int(form.get("chat_id") or 0)
+        if method == "getFile":
+            file_id = form["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id,
+                    "file_size": len(self._files.get(file_id, self._photo)), "file_path": f"photos/{file_id}"}
+        if method not in self.MESSAGE_METHODS:
+            return True  # answerCallbackQuery, deleteMessage, answerInlineQuery, setMyCommands, ...
+        message_id = int(form["message_id"]) if "message_id" in form else next(self._message_ids)
+        message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        for field in ("text", "caption"):
+            if field in form:
+                message[field] = form[field]
+        photo = form.get("photo")
+        if isinstance(photo, str) and photo.startswith("attach://"):
+            photo = form.get(photo[len("attach://"):])  # aiogram шлёт файл отдельной частью формы
+        if photo is not None:
+            file_id = photo if isinstance(photo, str) else self._store(photo.file.read())
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 320, "height": 320}]
+        if chat_id and ("reply_markup" in form or method.startswith("edit")):
+            await self._record(chat_id, message_id, form.get("reply_markup"))
+        return message
+
+    def _store(self, data: bytes) -> str:
+        file_id = f"upload-{next(self._upload_ids)}"
+        self._files[file_id] = data
+        return file_id
+
+    async def _record(self, chat_id: int, message_id: int, markup: Optional[str]):
+        buttons = []
+        if markup:
+            for row in json.loads(markup).get("inline_keyboard", []):
+                buttons.extend(b["callback_data"] for b in row if b.get("callback_data"))
+        async with self._changed:
+            self._seq += 1
+            events = self._events.setdefault(chat_id, [])
+            events.append((self._seq, message_id, buttons))
+            del events[:-self.EVENTS_PER_CHAT]
+            self._changed.notify_all()
+
+
+# ---------------- Virtual users ----------------
+class VirtualUser:
+    """Один пользователь: шлёт апдейты по очереди, как живой человек, и нажимает показанные ботом кнопки."""
+
+    def __init__(self, user_id: int, bot: Bot, api: FakeBotAPI, timeout: float, rng: random.Random):
+        self.user = types.User(id=user_id, is_bot=False, first_name="load")
+        self.chat = types.Chat(id=user_id, type="private")
+        self.bot = bot
+        self.api = api
+        self.timeout = timeout
+        self.rng = rng
+        self.updates = 0
+
+    async def feed(self, **event):
+        await af.dp.feed_update(self.bot, types.Update(update_id=next(UPDATE_IDS), **event))
+        self.updates += 1
+
+    def message(self, **fields) -> types.Message:
+        return types.Message(message_id=next(USER_MESSAGE_IDS), date=datetime.now(timezone.utc), chat=self.chat,
+                             from_user=self.user, **fields)
+
+    async def send_text(self, text: str):
+        await self.feed(message=self.message(text=text))
+
+    async def send_photo(self):
+        file_id = f"load-{self.user.id}-{next(PHOTO_IDS)}"
+        await self.feed(message=self.message(photo=[types.PhotoSize(file_id=file_id, file_unique_id=file_id,
+                                                                    width=768, height=1024)]))
+
+    async def press(self, data: str, message_id: int = 1):
+        origin = types.Message(message_id=message_id, date=datetime.now(timezone.utc), chat=self.chat, text="…")
+        await self.feed(callback_query=types.CallbackQuery(id=str(next(CALLBACK_IDS)), from_user=self.user,
+                                                           chat_instance="load", data=data, message=origin))
+
+    async def press_shown(self, prefix: str, after: int):
+        """Дождаться кнопки, показанной ботом после отметки after, и нажать её."""
+        message_id, data = await self.api.wait_button(self.user.id, prefix, after, self.timeout)
+        await self.press(data, message_id)
+
+    async def flow_start(self):
+        await self.send_text("/start")
+
+    async def flow_add(self):
+        mark = self.api.mark()
+        await self.press("wardrobe_add_item")
+        await self.send_photo()
+        await self.press_shown("add_accept_name", mark)
+        await self.press_shown("add_accept_color", mark)
+        await self.press_shown("add_save", mark)
+
+    async def flow_analyze(self):
+        mark = self.api.mark()
+        await self.send_photo()
+        await self.press_shown("offer_analyze", mark)
+        await self.press_shown("fb_yes", mark)
+
+    async def flow_page(self):
+        mark = self.api.mark()
+        await self.press("menu_wardrobe")
+        await self.press(af.cb_data("wardrobe_group", "all"))
+        shown = self.api.shown(self.user.id, "wardrobe_page", mark)
+        if shown:
+            await self.press(shown[1], shown[0])
+
+    async def flow_search(self):
+        await self.press("wardrobe_search")
+        await self.send_text(self.rng.choice(bench.SEARCH_QUERIES))
+
+    async def flow_capsule(self):
+        await self.press("menu_generate_capsule")
+
+
+# ---------------- Runner ----------------
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in filter(None, text.split(",")):
+        name, _, weight = part.partition("=")
+        if name not in FLOWS:
+            raise SystemExit(f"unknown flow {name!r}; known: {', '.join(FLOWS)}")
+        mix[name] = float(weight or 1)
+    return {k: v for k, v in mix.items() if v > 0}
+
+
+def percentile(sorted_samples: List[float], q: float) -> float:
+    return sorted_samples[min(len(sorted_samples) - 1, int(round(q * (len(sorted_samples) - 1))))]
+
+
+async def user_loop(vu: VirtualUser, mix: Dict[str, float], start_at: float, deadline: float, think: float,
+                    stats: Dict[str, Dict[str, Any]]):
+    names, weights = list(mix), list(mix.values())
+    await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+    while time.monotonic() < deadline:
+        name = vu.rng.choices(names, weights)[0]
+        t0 = time.perf_counter()
+        try:
+            await getattr(vu, f"flow_{name}")()
+            stats[name]["samples"].append(time.perf_counter() - t0)
+        except Exception as e:
+            stats[name]["errors"][type(e).__name__] += 1
+        if think > 0:
+            await asyncio.sleep(vu.rng.expovariate(1.0 / think))
+
+
+async def run(args) -> Dict[str, Any]:
+    api = await FakeBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, seed=args.seed).start()
+    bot = Bot(token=af.TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api.url)))
+    bot.session.middleware(af.ApiMetricsMiddleware())
+    af.bot = bot
+    af.repo = await repository.Repository.connect(args.dsn, max_size=args.db_pool, attempts=1)
+    await af.repo.migrate()
+    await asyncio.to_thread(af.open_photo_cache)
+    db = bench.PostgresDB(af.repo)
+    mix = parse_mix(args.mix)
+    user_ids = [USER_ID_BASE + i for i in range(args.users)]
+    stats = {name: {"samples": [], "errors": Counter()} for name in mix}
+    af.loop_watchdog.start()
+    try:
+        for uid in user_ids:
+            await db.seed(uid, bench.synthetic_rows(args.items, seed=uid - USER_ID_BASE))
+        users = [VirtualUser(uid, bot, api, args.timeout, random.Random(args.seed * 1_000_003 + uid)) for uid in user_ids]
+        started = time.monotonic()
+        deadline = started + args.ramp + args.duration
+        await asyncio.gather(*(user_loop(vu, mix, started + args.ramp * i / max(1, len(users)), deadline, args.think,
+                                         stats) for i, vu in enumerate(users)))
+        elapsed = time.monotonic() - started
+        await af.photo_queue.drain()
+    finally:
+        with contextlib.suppress(Exception):
+            await db.cleanup(user_ids)
+        await af.loop_watchdog.stop()
+        await af.repo.close()
+        await bot.session.close()
+        await api.stop()
+
+    flows = []
+    for name, st in stats.items():
+        samples = sorted(st["samples"])
+        errors = sum(st["errors"].values())
+        runs = len(samples) + errors
+        row = {"name": name, "runs": runs, "errors": errors, "error_rate": round(errors / runs, 4) if runs else 0.0,
+               "error_types": dict(st["errors"])}
+        if samples:
+            row.update({"p50_ms": round(statistics.median(samples) * 1000, 2),
+                        "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+                        "mean_ms": round(statistics.fmean(samples) * 1000, 2)})
+        flows.append(row)
+    ok = sum(len(st["samples"]) for st in stats.values())
+    failed = sum(r["errors"] for r in flows)
+    lag = af.loop_watchdog.percentiles()
+    totals = {"elapsed_s": round(elapsed, 2), "flows_ok": ok, "flows_failed": failed,
+              "flows_per_s": round(ok / elapsed, 2), "updates_per_s": round(sum(u.updates for u in users) / elapsed, 2),
+              "api_calls_per_s": round(sum(api.calls.values()) / elapsed, 2),
+              "error_rate": round(failed / (ok + failed), 4) if ok + failed else 0.0,
+              "admission_rejected": af.photo_queue.rejected,
+              "loop_lag_p99_ms": round(lag["0.99"] * 1000, 2), "loop_lag_max_ms": round(lag["max"] * 1000, 2)}
+    if af.LOOP_STRICT_MS is not None:
+        totals["loop_strict_violations"] = len(af.loop_watchdog.violations)
+    return {"totals": totals, "flows": flows, "api_calls": dict(api.calls.most_common())}
+
+
+def print_table(report: Dict[str, Any]):
+    t = report["totals"]
+    print(f"{t['flows_ok']} flows ok, {t['flows_failed']} failed in {t['elapsed_s']} s: "
+          f"{t['flows_per_s']} flows/s, {t['updates_per_s']} updates/s, {t['api_calls_per_s']} API calls/s; "
+          f"loop lag p99 {t['loop_lag_p99_ms']} ms", file=sys.stderr)
+    for r in report["flows"]:
+        timing = f"p50 {r['p50_ms']:9.1f} ms  p99 {r['p99_ms']:9.1f} ms" if "p50_ms" in r else f"{'no successful runs':>33}"
+        errors = f"  errors {r['error_rate']:.1%} {r['error_types']}" if r["errors"] else ""
+        print(f"{r['name']:<10}{r['runs']:>7}  {timing}{errors}", file=sys.stderr)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dsn", default=os.getenv("LOAD_TEST_DSN"), help="Postgres DSN (по умолчанию $LOAD_TEST_DSN)")
+    ap.add_argument("--users", type=int, default=20, help="одновременных виртуальных пользователей")
+    ap.add_argument("--duration", type=float, default=30, help="секунд под полной нагрузкой (после разгона)")
+    ap.add_argument("--ramp", type=float, default=5, help="за сколько секунд подключаются все пользователи")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help=f"веса потоков из {','.join(FLOWS)}")
+    ap.add_argument("--think", type=float, default=0.5, help="средняя пауза пользователя между потоками, сек")
+    ap.add_argument("--items", type=int, default=50, help="вещей в засеянном гардеробе каждого пользователя")
+    ap.add_argument("--latency-ms", type=float, default=30, help="средняя задержка ответа поддельного Bot API")
+    ap.add_argument("--jitter-ms", type=float, default=10, help="разброс задержки (нормальный)")
+    ap.add_argument("--timeout", type=float, default=60, help="сколько ждать кнопку от бота, прежде чем считать ошибкой")
+    ap.add_argument("--db-pool", type=int, default=af.DB_POOL_MAX, help="максимум соединений пула")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default=None, help="куда записать JSON (по умолчанию stdout)")
+    args = ap.parse_args()
+    if not args.dsn:
+        ap.error("нужен Postgres: --dsn или $LOAD_TEST_DSN")
+
+    with contextlib.redirect_stdout(sys.stderr):  # отладочные print() из af.py не должны смешиваться с JSON
+        result = asyncio.run(run(args))
+
+    report = {"meta": {"created_at": datetime.now(timezone.utc).isoformat(), "python": platform.python_version(),
+                       "machine": platform.machine(), "device": af.device, "users": args.users,
+                       "duration_s": args.duration, "mix": parse_mix(args.mix), "latency_ms": args.latency_ms,
+                       "jitter_ms": args.jitter_ms, "items": args.items,
+                       "admission": {"workers": af.ADMISSION_WORKERS, "max_backlog": af.ADMISSION_MAX_BACKLOG}},
+              **result}
+    print_table(report)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if report["totals"].get("loop_strict_violations"):
+        worst = max(v["lag_ms"] for v in af.loop_watchdog.violations)
+        print(f"event loop blocked longer than {af.LOOP_STRICT_MS:.0f}ms {report['totals']['loop_strict_violations']} time(s), "
+              f"worst {worst:.0f}ms", file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Маршрутизация callback-кнопок по таблице действий.
+
+callback_data имеет вид "action" или "action:field1:field2...". Обработчик ищется по action одним
+поиском в словаре (вместо цепочки фильтров-лямбд), поля разбираются по типам, объявленным при регистрации:
+    int   — целое (id вещи, номер страницы),
+    str   — короткая строка без ":" (id группы и т.п.),
+    TokenField — длинное значение (например file_id), которое хранится на сервере, а в кнопку попадает короткий токен.
+Telegram ограничивает callback_data 64 байтами — pack() это проверяет.
+"""
+import secrets
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+MAX_CALLBACK_DATA = 64
+SEP = ":"
+
+
+class TokenField:
+    """Маркер типа поля: значение заменяется серверным токеном (см. TokenStore)."""
+
+
+class CallbackDataError(ValueError):
+    """callback_data не разбирается: чужой формат, неверный тип поля или устаревший токен."""
+
+
+class TokenStore:
+    """
+    Короткие токены для длинных значений (file_id и т.п.), LRU по количеству.
+    Одно и то же значение получает один и тот же токен, пока не вытеснено.
+    """
+
+    def __init__(self, max_size: int = 20000, nbytes: int = 6):
+        self.max_size = max_size
+        self.nbytes = nbytes
+        self._by_token: "OrderedDict[str, str]" = OrderedDict()
+        self._by_value: Dict[str, str] = {}
+
+    def put(self, value: str) -> str:
+        token = self._by_value.get(value)
+        if token is not None:
+            self._by_token.move_to_end(token)
+            return token
+        token = secrets.token_urlsafe(self.nbytes)
+        while token in self._by_token:
+            token = secrets.token_urlsafe(self.nbytes)
+        self._by_token[token] = value
+        self._by_value[value] = token
+        while len(self._by_token) > self.max_size:
+            _, old = self._by_token.popitem(last=False)
+            self._by_value.pop(old, None)
+        return token
+
+    def get(self, token: str) -> Optional[str]:
+        value = self._by_token.get(token)
+        if value is not None:
+            self._by_token.move_to_end(token)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._by_token)
+
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+class CallbackRouter:
+    def __init__(self, tokens: Optional[TokenStore] = None):
+        self.tokens = tokens if tokens is not None else TokenStore()  # пустой TokenStore ложен (__len__)
+        self._routes: Dict[str, Tuple[Handler, Tuple[type, ...]]] = {}
+
+    def route(self, *actions: str, fields: Tuple[type, ...] = ()):
+        """Декоратор: регистрирует обработчик для одного или нескольких action с одной схемой полей."""
+        def decorator(fn: Handler) -> Handler:
+            for action in actions:
+                if SEP in action:
+                    raise ValueError(f"action must not contain {SEP!r}: {action!r}")
+                if action in self._routes:
+                    raise ValueError(f"callback action {action!r} is already registered")
+                self._routes[action] = (fn, tuple(fields))
+            return fn
+        return decorator
+
+    def pack(self, action: str, *values: Any) -> str:
+        entry = self._routes.get(action)
+        fields = entry[1] if entry else ()
+        if len(values) > len(fields):
+            raise ValueError(f"{action!r} takes {len(fields)} field(s), got {len(values)}")
+        parts = [action]
+        for typ, value in zip(fields, values):
+            if value is None:
+                break  # необязательные хвостовые поля просто не пишем
+            if typ is TokenField:
+                parts.append(self.tokens.put(str(value)))
+            elif typ is int:
+                parts.append(str(int(value)))
+            else:
+                value = str(value)
+                if SEP in value:
+                    raise ValueError(f"field value must not contain {SEP!r}: {value!r}")
+                parts.append(value)
+        data = SEP.join(parts)
+        if len(data.encode("utf-8")) > MAX_CALLBACK_DATA:
+            raise ValueError(f"callback_data longer than {MAX_CALLBACK_DATA} bytes: {data!r}")
+        return data
+
+    def unpack(self, data: str) -> Tuple[Optional[Handler], Tuple[Any, ...]]:
+        """
+        Возвращает (обработчик, разобранные поля). Для неизвестного action — (None, ()).
+        Недостающие хвостовые поля приходят как None.
+        """
+        action, _, rest = data.partition(SEP)
+        entry = self._routes.get(action)
+        if entry is None:
+            return None, ()
+        fn, fields = entry
+        raw = rest.split(SEP, len(fields) - 1) if (rest and fields) else []
+        if rest and not fields:
+            raise CallbackDataError(f"{action!r} takes no fields: {data!r}")
+        args = []
+        for i, typ in enumerate(fields):
+            if i >= len(raw):
+                args.append(None)
+                continue
+            value = raw[i]
+            if typ is int:
+                try:
+                    args.append(int(value))
+                except ValueError:
+                    raise CallbackDataError(f"bad int field in {data!r}") from None
+            elif typ is TokenField:
+                resolved = self.tokens.get(value)
+                if resolved is None:
+                    raise CallbackDataError(f"unknown or expired token in {data!r}")
+                args.append(resolved)
+            else:
+                args.append(value)
+        return fn, tuple(args)
+
+    def __contains__(self, action: str) -> bool:
+        return action in self._routes
+
+    def __len__(self) -> int:
+        return len(self._routes)
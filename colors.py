@@ -0,0 +1,158 @@
+"""
+Основные цвета вещи по пикселям: без второго прохода CLIP, только numpy.
+
+Картинка уменьшается до ~SAMPLE_SIDE px по длинной стороне, переводится в Lab, каждому пикселю даётся вес:
+ближе к центру кадра — больше (вещь обычно в центре), похожие на фон — меньше (фон оценивается по рамке кадра).
+Взвешенный k-means в Lab (k-means++ с фиксированным seed, векторизованные расстояния) даёт кластеры;
+центр кластера сопоставляется ближайшему эталону палитры, доли кластеров с одной меткой складываются.
+
+    dominant_colors(img, ["white", "black", ...]) -> [("blue", 0.71), ("white", 0.22)]   # доли, по убыванию
+
+Доля веса — это и «уверенность» для подсказки, и основа для многоцветного ответа (метки с долей >= min_share).
+"""
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+SAMPLE_SIDE = 96
+
+# эталоны sRGB для меток; у некоторых несколько оттенков (тёмно-синий — тоже blue)
+PALETTE: Dict[str, List[Tuple[int, int, int]]] = {
+    "white": [(245, 245, 245), (225, 225, 220)],
+    "black": [(15, 15, 15), (40, 40, 45)],
+    "gray": [(128, 128, 128), (175, 175, 175), (85, 85, 90)],
+    "red": [(200, 25, 30), (230, 60, 50)],
+    "orange": [(240, 130, 30), (220, 100, 40)],
+    "yellow": [(245, 215, 40), (240, 230, 120)],
+    "green": [(40, 140, 60), (25, 80, 45), (120, 190, 120)],
+    "blue": [(40, 80, 180), (25, 35, 80), (110, 160, 220)],
+    "purple": [(120, 60, 150), (80, 40, 110), (170, 130, 200)],
+    "pink": [(240, 150, 180), (225, 90, 140)],
+    "brown": [(110, 70, 40), (75, 50, 30), (150, 100, 60)],
+    "beige": [(215, 195, 160), (235, 220, 190)],
+    "maroon": [(120, 20, 35), (90, 15, 30)],
+    "olive": [(110, 110, 40), (85, 90, 45)],
+}
+
+
+def srgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """(..., 3) uint8/float 0..255 sRGB -> (..., 3) float32 Lab (D65)."""
+    c = np.asarray(rgb, dtype=np.float32) / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124, 0.2126, 0.0193],
+                        [0.3576, 0.7152, 0.1192],
+                        [0.1805, 0.0722, 0.9505]], dtype=np.float32)
+    xyz /= np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116.0 * f[..., 1] - 16.0
+    lab[..., 1] = 500.0 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200.0 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+_palette_cache: Dict[Tuple[str, ...], Tuple[np.ndarray, np.ndarray]] = {}
+
+
+def _palette(labels: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Эталоны в Lab (M, 3) и индекс метки для каждого эталона (M,)."""
+    key = tuple(labels)
+    cached = _palette_cache.get(key)
+    if cached is None:
+        refs, owners = [], []
+        for i, label in enumerate(labels):
+            for rgb in PALETTE[label]:
+                refs.append(rgb)
+                owners.append(i)
+        cached = _palette_cache[key] = (srgb_to_lab(np.array(refs, dtype=np.float32)), np.array(owners))
+    return cached
+
+
+def sample_pixels(img: Union[Image.Image, np.ndarray], side: int = SAMPLE_SIDE) -> np.ndarray:
+    """Уменьшенная копия (h, w, 3) uint8; большие фото не раскодируются в полном размере повторно."""
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    w, h = img.size
+    scale = side / max(w, h)
+    if scale < 1:
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BILINEAR, reducing_gap=2.0)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def pixel_weights(lab: np.ndarray, sigma: float = 0.35, border: int = 3, bg_delta: float = 14.0,
+                  bg_weight: float = 0.1) -> np.ndarray:
+    """Вес пикселя (h, w): гауссиана от центра кадра, пиксели цвета фона (медиана рамки) ослабляются."""
+    h, w = lab.shape[:2]
+    ys = (np.arange(h, dtype=np.float32) + 0.5) / h - 0.5
+    xs = (np.arange(w, dtype=np.float32) + 0.5) / w - 0.5
+    weights = np.exp(-(ys[:, None] ** 2 + xs[None, :] ** 2) / (2 * sigma ** 2))
+    b = min(border, h // 4, w // 4)
+    if b > 0:
+        ring = np.concatenate([lab[:b].reshape(-1, 3), lab[-b:].reshape(-1, 3),
+                               lab[b:-b, :b].reshape(-1, 3), lab[b:-b, -b:].reshape(-1, 3)])
+        bg = np.median(ring, axis=0)
+        # фон считаем фоном, только если рамка однородная (иначе вещь, скорее всего, занимает весь кадр)
+        if np.median(np.linalg.norm(ring - bg, axis=1)) < bg_delta:
+            near_bg = np.linalg.norm(lab - bg, axis=-1) < bg_delta
+            weights = np.where(near_bg, weights * bg_weight, weights)
+    return weights.astype(np.float32)
+
+
+def weighted_kmeans(x: np.ndarray, w: np.ndarray, k: int, iters: int = 10, seed: int = 0,
+                    tol: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
+    """(N, D) точки с весами (N,) -> центры (k, D) и метки (N,). Инициализация k-means++ по весам."""
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    k = min(k, n)
+    p = w / w.sum()
+    centers = np.empty((k, x.shape[1]), dtype=np.float32)
+    centers[0] = x[rng.choice(n, p=p)]
+    d2 = ((x - centers[0]) ** 2).sum(1)
+    for j in range(1, k):
+        q = d2 * w
+        total = q.sum()
+        if total <= 0:
+            centers = centers[:j]
+            break
+        centers[j] = x[rng.choice(n, p=q / total)]
+        d2 = np.minimum(d2, ((x - centers[j]) ** 2).sum(1))
+    x2 = (x ** 2).sum(1)[:, None]
+    for _ in range(iters):
+        dist = x2 - 2 * x @ centers.T + (centers ** 2).sum(1)[None, :]
+        labels = dist.argmin(1)
+        mass = np.bincount(labels, weights=w, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, weights=w * x[:, d], minlength=len(centers)) for d in range(x.shape[1])], 1)
+        keep = mass > 0
+        new = centers.copy()
+        new[keep] = (sums[keep] / mass[keep, None]).astype(np.float32)
+        shift = float(np.abs(new - centers).max())
+        centers = new
+        if shift < tol:
+            break
+    dist = x2 - 2 * x @ centers.T + (centers ** 2).sum(1)[None, :]
+    return centers, dist.argmin(1)
+
+
+def dominant_colors(img: Union[Image.Image, np.ndarray], labels: Sequence[str], k: int = 4,
+                    min_share: float = 0.0, side: int = SAMPLE_SIDE, seed: int = 0) -> List[Tuple[str, float]]:
+    """Метки палитры с долями веса пикселей (сумма 1), по убыванию; метки с долей < min_share отбрасываются."""
+    lab = srgb_to_lab(sample_pixels(img, side))
+    weights = pixel_weights(lab)
+    x = lab.reshape(-1, 3)
+    w = weights.reshape(-1)
+    centers, assign = weighted_kmeans(x, w, k, seed=seed)
+    mass = np.bincount(assign, weights=w, minlength=len(centers))
+    refs, owners = _palette(labels)
+    nearest = owners[((centers[:, None, :] - refs[None, :, :]) ** 2).sum(-1).argmin(1)]
+    shares = np.bincount(nearest, weights=mass, minlength=len(labels))
+    shares = shares / max(float(shares.sum()), 1e-12)
+    order = np.argsort(-shares)
+    return [(labels[i], float(shares[i])) for i in order if shares[i] > 0 and shares[i] >= min_share]
+
+
+def top_color(img: Union[Image.Image, np.ndarray], labels: Sequence[str], k: int = 4) -> Optional[Tuple[str, float]]:
+    found = dominant_colors(img, labels, k=k)
+    return found[0] if found else None
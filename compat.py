@@ -0,0 +1,94 @@
+"""
+Граф совместимости вещей пользователя: для каждой вещи и каждой чужой группы категорий (верх, низ, обувь, ...)
+top-K вещей этой группы, ближайших по косинусу CLIP-эмбеддингов. Капсула и «с чем носить» читают готовые списки
+вместо попарного перебора вещей.
+
+Список хранится компактно: K id (int32), затем K косинусов (float16), по убыванию косинуса — 60 байт при K=10.
+Обновления инкрементальные: новая вещь — её собственные списки (одно умножение матрицы на вектор) и вставка
+в списки вещей других групп, где она проходит в top-K; удалённая вещь вычёркивается, и только затронутые списки
+пересчитываются.
+
+    for item_id, grp, ids, sims in build(mat, ids, groups, k=10): ...
+    ids, sims = decode(blob)
+    merged = insert(ids, sims, new_id, new_sim, k=10)   # None — список не изменился
+"""
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+Neighbours = Tuple[np.ndarray, np.ndarray]  # (ids int32, sims float32), по убыванию sims
+
+EMPTY: Neighbours = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+
+
+def encode(ids: np.ndarray, sims: np.ndarray) -> bytes:
+    return np.asarray(ids, dtype="<i4").tobytes() + np.asarray(sims, dtype="<f2").tobytes()
+
+
+def decode(blob: Optional[bytes]) -> Neighbours:
+    if not blob:
+        return EMPTY
+    n = len(blob) // 6
+    ids = np.frombuffer(blob, dtype="<i4", count=n).astype(np.int32)
+    sims = np.frombuffer(blob, dtype="<f2", count=n, offset=4 * n).astype(np.float32)
+    return ids, sims
+
+
+def top_k(sims: np.ndarray, ids: np.ndarray, k: int) -> Neighbours:
+    """k лучших (id, косинус) из выровненных массивов, по убыванию."""
+    n = len(sims)
+    if n == 0 or k <= 0:
+        return EMPTY
+    k = min(k, n)
+    top = np.argpartition(-sims, k - 1)[:k] if k < n else np.arange(n)
+    top = top[np.argsort(-sims[top], kind="stable")]
+    return ids[top].astype(np.int32), sims[top].astype(np.float32)
+
+
+def neighbours_of(sims: np.ndarray, ids: np.ndarray, groups: np.ndarray, own_group: str, k: int,
+                  exclude: Optional[int] = None) -> Dict[str, Neighbours]:
+    """Списки одной вещи по всем чужим группам; sims — её косинусы со всеми вещами (выровнены с ids и groups)."""
+    out: Dict[str, Neighbours] = {}
+    for grp in np.unique(groups):
+        if grp == own_group:
+            continue
+        mask = groups == grp
+        if exclude is not None:
+            mask &= ids != exclude
+        if mask.any():
+            out[str(grp)] = top_k(sims[mask], ids[mask], k)
+    return out
+
+
+def build(mat: np.ndarray, ids: np.ndarray, groups: np.ndarray, k: int,
+          block: int = 1024) -> Iterator[Tuple[int, str, np.ndarray, np.ndarray]]:
+    """Все списки с нуля: (item_id, группа, ids, sims). Косинусы считаются блоками строк, память — block x N."""
+    n = len(ids)
+    masks = {str(grp): groups == grp for grp in np.unique(groups)}
+    for start in range(0, n, block):
+        sims = mat[start:start + block] @ mat.T
+        for row in range(sims.shape[0]):
+            i = start + row
+            for grp, mask in masks.items():
+                if grp == groups[i]:
+                    continue
+                nb_ids, nb_sims = top_k(sims[row][mask], ids[mask], k)
+                if len(nb_ids):
+                    yield int(ids[i]), grp, nb_ids, nb_sims
+
+
+def insert(ids: np.ndarray, sims: np.ndarray, new_id: int, new_sim: float, k: int) -> Optional[Neighbours]:
+    """Список с новой вещью на своём месте или None, если она не проходит в top-K."""
+    if k <= 0:
+        return None
+    keep = ids != new_id
+    ids, sims = ids[keep], sims[keep]
+    if len(ids) >= k and new_sim <= sims[k - 1]:
+        return None
+    pos = int(np.searchsorted(-sims, -new_sim, side="right"))
+    return (np.insert(ids, pos, new_id)[:k].astype(np.int32),
+            np.insert(sims, pos, new_sim)[:k].astype(np.float32))
+
+
+def contains_any(ids: np.ndarray, gone: Sequence[int]) -> bool:
+    return bool(np.isin(ids, np.asarray(list(gone), dtype=np.int32)).any())
@@ -0,0 +1,85 @@
+"""
+Формат хранения эмбеддингов в wardrobe.emb (BYTEA).
+
+Старые строки — «голые» float32 без заголовка (D*4 байт). Новые начинаются с байта-кодека:
+    0x01 float32  — 1 + 4*D байт
+    0x02 float16  — 1 + 2*D байт
+    0x03 int8     — 1 + 4 (float32 масштаб вектора) + D байт; x ≈ q * scale, scale = max|x| / 127
+Старый формат узнаётся по длине: у заголовочных форматов длина не кратна 4 (при D=512: 2049, 1025, 517),
+encode() это проверяет, поэтому старые строки читаются без миграции.
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+
+F32, F16, INT8 = 0x01, 0x02, 0x03
+CODECS = {"f32": F32, "f16": F16, "int8": INT8}
+
+
+def encode(vec: np.ndarray, codec: str = "f16") -> bytes:
+    v = np.asarray(vec, dtype=np.float32).reshape(-1)
+    code = CODECS[codec]
+    if code == F32:
+        payload = v.astype("<f4").tobytes()
+    elif code == F16:
+        payload = v.astype("<f2").tobytes()
+    else:
+        peak = float(np.max(np.abs(v))) if v.size else 0.0
+        scale = peak / 127.0 if peak > 0 else 1.0
+        q = np.clip(np.rint(v / scale), -127, 127).astype(np.int8)
+        payload = np.float32(scale).astype("<f4").tobytes() + q.tobytes()
+    data = bytes((code,)) + payload
+    if len(data) % 4 == 0:
+        raise ValueError(f"{codec}: encoded length {len(data)} clashes with the legacy float32 format")
+    return data
+
+
+def dim_of(b: bytes) -> int:
+    n = len(b)
+    if n % 4 == 0:
+        return n // 4
+    code = b[0]
+    if code == F32:
+        return (n - 1) // 4
+    if code == F16:
+        return (n - 1) // 2
+    if code == INT8:
+        return n - 5
+    raise ValueError(f"unknown embedding codec 0x{code:02x}")
+
+
+def decode_into(out: np.ndarray, b: bytes) -> np.ndarray:
+    """Раскодирует b прямо в out (float32-строка длины D) без промежуточных массивов float32."""
+    n = len(b)
+    if n % 4 == 0:
+        out[:] = np.frombuffer(b, dtype="<f4")
+        return out
+    code = b[0]
+    if code == F32:
+        out[:] = np.frombuffer(b, dtype="<f4", offset=1)
+    elif code == F16:
+        out[:] = np.frombuffer(b, dtype="<f2", offset=1)
+    elif code == INT8:
+        scale = np.frombuffer(b, dtype="<f4", count=1, offset=1)[0]
+        np.multiply(np.frombuffer(b, dtype=np.int8, offset=5), scale, out=out, casting="unsafe")
+    else:
+        raise ValueError(f"unknown embedding codec 0x{code:02x}")
+    return out
+
+
+def decode(b: Optional[bytes]) -> Optional[np.ndarray]:
+    if b is None:
+        return None
+    return decode_into(np.empty(dim_of(b), dtype=np.float32), b)
+
+
+def decode_matrix(blobs: Sequence[bytes], dim: Optional[int] = None, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Раскодирует пачку в одну матрицу float32 (N, D); строки можно отдавать дальше как представления."""
+    if out is None:
+        if dim is None:
+            dim = dim_of(blobs[0]) if len(blobs) else 0
+        out = np.empty((len(blobs), dim), dtype=np.float32)
+    for i, b in enumerate(blobs):
+        decode_into(out[i], b)
+    return out
+
@@ -0,0 +1,151 @@
+"""
+Сторож event loop: замечает, когда синхронный код (CLIP, PIL, numpy) держит цикл и задерживает остальные апдейты.
+
+Задача в цикле спит по interval и меряет, насколько позже проснулась (лаг планирования); окно последних
+замеров даёт перцентили для метрик. Параллельно поток-наблюдатель проверяет «пульс» цикла: если пульса нет
+дольше threshold_ms, он снимает стек потока цикла прямо во время блокировки (sys._current_frames) —
+когда цикл оживёт, в лог уходит длительность задержки, задача, которая его держала, и этот стек.
+
+Строгий режим для отладки и тестов: блокировка дольше strict_ms копится в violations, raise_if_blocked()
+бросает BlockingDetected; в тестах удобнее
+
+    async with watch_blocking(50):
+        await handler(...)
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, List, Optional
+
+
+class BlockingDetected(AssertionError):
+    """Цикл был заблокирован дольше разрешённого в строгом режиме."""
+
+
+class LoopWatchdog:
+    def __init__(self, interval: float = 0.05, threshold_ms: float = 200.0, window: int = 1200,
+                 strict_ms: Optional[float] = None, stack_limit: int = 25,
+                 log: Callable[[str], None] = print, on_lag: Optional[Callable[[float], None]] = None):
+        self.interval = interval
+        self.threshold_ms = threshold_ms
+        self.strict_ms = strict_ms
+        self.stack_limit = stack_limit
+        self.log = log
+        self.on_lag = on_lag
+        self.samples: Deque[float] = deque(maxlen=window)  # лаги в секундах
+        self.stalls = 0
+        self.violations: List[Dict[str, object]] = []
+        self._heartbeat = time.monotonic()
+        self._captured: Optional[Dict[str, object]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # ---- lifecycle ----
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = self._loop.create_task(self._probe(), name="loopwatch")
+        self._thread = threading.Thread(target=self._watch, name="loopwatch", daemon=True)
+        self._thread.start()
+        return self
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._thread:
+            self._thread.join(timeout=1.0)
+
+    # ---- loop side ----
+    async def _probe(self):
+        # отсчёт от start(): если цикл заблокировали сразу после запуска, эта задержка тоже попадёт в замер
+        t0 = self._heartbeat
+        while True:
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - t0)))
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(0.0, now - t0 - self.interval)
+            t0 = now
+            self.samples.append(lag)
+            if self.on_lag is not None:
+                self.on_lag(lag)
+            if lag * 1000 >= self.threshold_ms or (self.strict_ms is not None and lag * 1000 >= self.strict_ms):
+                self._report(lag)
+
+    def _report(self, lag: float):
+        captured, self._captured = self._captured, None
+        task = captured.get("task") if captured else None
+        stack = captured.get("stack") if captured else None
+        if lag * 1000 >= self.threshold_ms:
+            self.stalls += 1
+            self.log(f"[loop] event loop blocked for {lag * 1000:.0f}ms" + (f" by {task}" if task else ""))
+            if stack:
+                self.log("[loop] stack during the stall:\n" + stack)
+        if self.strict_ms is not None and lag * 1000 >= self.strict_ms:
+            self.violations.append({"lag_ms": lag * 1000, "task": task, "stack": stack})
+            if lag * 1000 < self.threshold_ms:
+                self.log(f"[loop][strict] event loop blocked for {lag * 1000:.0f}ms (limit {self.strict_ms:.0f}ms)"
+                         + (f" by {task}" if task else ""))
+
+    # ---- watcher thread ----
+    def _watch(self):
+        step = max(0.005, min(self.interval, self.threshold_ms / 1000.0) / 2)
+        reported_for = None
+        while not self._stop.wait(step):
+            beat = self._heartbeat
+            stalled = time.monotonic() - beat - self.interval
+            limit = min(self.threshold_ms, self.strict_ms if self.strict_ms is not None else self.threshold_ms) / 1000.0
+            if stalled < limit or reported_for == beat:
+                continue
+            reported_for = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            try:
+                task = asyncio.current_task(self._loop)
+                task_name = task.get_name() + " " + repr(task.get_coro()) if task else None
+            except Exception:
+                task_name = None
+            self._captured = {"task": task_name,
+                              "stack": "".join(traceback.format_stack(frame, limit=self.stack_limit))}
+
+    # ---- reporting ----
+    def percentiles(self, qs=(0.5, 0.9, 0.99)) -> Dict[str, float]:
+        data = sorted(self.samples)
+        if not data:
+            return {**{str(q): 0.0 for q in qs}, "max": 0.0}
+        out = {str(q): data[min(len(data) - 1, int(q * len(data)))] for q in qs}
+        out["max"] = data[-1]
+        return out
+
+    def raise_if_blocked(self):
+        if self.violations:
+            worst = max(self.violations, key=lambda v: v["lag_ms"])
+            raise BlockingDetected(f"event loop blocked for {worst['lag_ms']:.0f}ms (limit {self.strict_ms:.0f}ms)"
+                                   + (f" by {worst['task']}" if worst["task"] else "")
+                                   + (f"\n{worst['stack']}" if worst["stack"] else ""))
+
+
+@asynccontextmanager
+async def watch_blocking(max_ms: float, interval: float = 0.01):
+    """Для тестов: падает BlockingDetected, если внутри блока цикл стоял дольше max_ms."""
+    wd = LoopWatchdog(interval=interval, threshold_ms=max_ms, strict_ms=max_ms, log=lambda _: None).start()
+    try:
+        yield wd
+        await asyncio.sleep(interval * 2)  # дать пробе замерить последний отрезок
+    finally:
+        await wd.stop()
+    wd.raise_if_blocked()
@@ -0,0 +1,189 @@
+"""
+Локальное хранилище весов CLIP: загрузка с закреплённого пути, проверка sha256, без скачивания во время работы.
+
+Бот читает веса только из CLIP_MODEL_PATH (по умолчанию — туда же, куда их кладёт clip.load: ~/.cache/clip/<файл>).
+Файла нет или сумма не совпала — ModelStoreError с понятным текстом сразу при старте, сети бот не касается.
+Ожидаемая сумма: CLIP_MODEL_SHA256, иначе соседний файл <веса>.sha256, иначе (для исходного архива OpenAI)
+сумма, зашитая в URL модели в clip. Проверенный файл помечается <веса>.verified (размер, mtime, сумма) —
+следующие старты не перечитывают сотни мегабайт, пока файл не изменился.
+
+Два формата:
+  * исходный TorchScript-архив OpenAI (как его скачивает clip) — грузится через torch.jit.load;
+  * state_dict, подготовленный командой prepare, — грузится torch.load(mmap=True): тензоры не читаются в память
+    целиком до копирования в модель, пик памяти и холодный старт меньше.
+
+Подготовка образа (на машине с сетью):
+    python model_store.py fetch --name ViT-B/32 --dir /models             # скачать архив OpenAI + .sha256
+    python model_store.py prepare --src /models/ViT-B-32.pt --out /models/ViT-B-32.state.pt
+    python model_store.py verify --path /models/ViT-B-32.state.pt
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import zipfile
+from typing import Any, Optional, Tuple
+
+DEFAULT_ROOT = os.path.expanduser("~/.cache/clip")
+
+
+class ModelStoreError(RuntimeError):
+    """Веса недоступны или не прошли проверку — бот не должен стартовать."""
+
+
+def model_url(name: str) -> str:
+    import clip.clip
+    try:
+        return clip.clip._MODELS[name]
+    except KeyError:
+        raise ModelStoreError(f"unknown CLIP model {name!r}; available: {sorted(clip.clip._MODELS)}") from None
+
+
+def default_path(name: str) -> str:
+    """Путь, куда clip.load сам положил бы архив этой модели."""
+    return os.path.join(DEFAULT_ROOT, os.path.basename(model_url(name)))
+
+
+def pinned_sha256(name: str) -> str:
+    # в URL моделей OpenAI предпоследний сегмент — sha256 архива; clip._download проверяет по нему же
+    return model_url(name).split("/")[-2]
+
+
+def sha256_file(path: str, chunk: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def is_torchscript(path: str) -> bool:
+    """TorchScript-архив содержит каталог code/; state_dict от torch.save — нет."""
+    try:
+        with zipfile.ZipFile(path) as z:
+            return any("/code/" in n for n in z.namelist())
+    except zipfile.BadZipFile:
+        return False
+
+
+def expected_sha256(path: str, name: str, sha256: Optional[str] = None) -> str:
+    if sha256:
+        return sha256.strip().lower()
+    sidecar = path + ".sha256"
+    if os.path.exists(sidecar):
+        with open(sidecar, encoding="utf-8") as f:
+            return f.read().split()[0].lower()
+    if is_torchscript(path):
+        return pinned_sha256(name)
+    raise ModelStoreError(f"{path}: no checksum to verify against — set CLIP_MODEL_SHA256 or put it into {sidecar}")
+
+
+def require_file(path: str):
+    if not os.path.isfile(path):
+        raise ModelStoreError(f"CLIP weights not found at {path}; the bot does not download models at runtime — "
+                              f"prepare them with `python model_store.py fetch` and set CLIP_MODEL_PATH")
+
+
+def verify(path: str, sha256: str, use_stamp: bool = True) -> bool:
+    """Проверяет sha256 файла; True — сумма взята из отметки .verified без чтения файла."""
+    require_file(path)
+    st = os.stat(path)
+    stamp_path = path + ".verified"
+    if use_stamp:
+        try:
+            with open(stamp_path, encoding="utf-8") as f:
+                stamp = json.load(f)
+            if stamp == {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha256}:
+                return True
+        except (OSError, ValueError):
+            pass
+    actual = sha256_file(path)
+    if actual != sha256:
+        raise ModelStoreError(f"{path}: sha256 mismatch (expected {sha256}, got {actual}) — the file is corrupt or not the pinned model")
+    if use_stamp:
+        try:
+            with open(stamp_path, "w", encoding="utf-8") as f:
+                json.dump({"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha256}, f)
+        except OSError:
+            pass  # каталог с весами может быть только для чтения — тогда проверяем каждый старт
+    return False
+
+
+def load_state_dict(path: str, mmap: bool = True) -> Tuple[dict, str]:
+    import torch
+    if is_torchscript(path):
+        return torch.jit.load(path, map_location="cpu").eval().state_dict(), "torchscript"
+    try:
+        return torch.load(path, map_location="cpu", mmap=mmap, weights_only=True), "state_dict+mmap" if mmap else "state_dict"
+    except TypeError:  # старый torch без mmap/weights_only
+        return torch.load(path, map_location="cpu"), "state_dict"
+
+
+def load_clip(name: str, path: Optional[str] = None, sha256: Optional[str] = None, device: str = "cpu",
+              mmap: bool = True, log=print) -> Tuple[Any, Any]:
+    """(model, preprocess) как у clip.load(name, jit=False), но только из локального файла и после проверки суммы."""
+    from clip.clip import _transform
+    from clip.model import build_model
+
+    path = path or default_path(name)
+    t0 = time.perf_counter()
+    require_file(path)
+    cached = verify(path, expected_sha256(path, name, sha256))
+    state_dict, kind = load_state_dict(path, mmap=mmap)
+    model = build_model(state_dict).to(device)
+    if str(device) == "cpu":
+        model.float()
+    log(f"[model] {name} loaded from {path} ({kind}, sha256 {'stamp' if cached else 'verified'}) "
+        f"in {time.perf_counter() - t0:.1f}s")
+    return model, _transform(model.visual.input_resolution)
+
+
+# ---------------- CLI ----------------
+def _write_sidecar(path: str, digest: str):
+    with open(path + ".sha256", "w", encoding="utf-8") as f:
+        f.write(f"{digest}  {os.path.basename(path)}\n")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("fetch", help="скачать архив OpenAI (проверка суммы — в clip)")
+    p.add_argument("--name", default="ViT-B/32")
+    p.add_argument("--dir", default=DEFAULT_ROOT)
+    p = sub.add_parser("prepare", help="пересохранить веса как state_dict для загрузки через mmap")
+    p.add_argument("--src", required=True)
+    p.add_argument("--out", required=True)
+    p = sub.add_parser("verify", help="проверить sha256")
+    p.add_argument("--path", required=True)
+    p.add_argument("--name", default="ViT-B/32")
+    p.add_argument("--sha256")
+    args = ap.parse_args()
+
+    try:
+        if args.cmd == "fetch":
+            import clip.clip
+            path = clip.clip._download(model_url(args.name), args.dir)
+            _write_sidecar(path, pinned_sha256(args.name))
+            print(path)
+        elif args.cmd == "prepare":
+            import torch
+            state_dict, kind = load_state_dict(args.src, mmap=False)
+            tmp = args.out + ".tmp"
+            torch.save(state_dict, tmp)
+            os.replace(tmp, args.out)
+            digest = sha256_file(args.out)
+            _write_sidecar(args.out, digest)
+            print(f"{args.out} (from {kind}) sha256 {digest}")
+        else:
+            require_file(args.path)
+            verify(args.path, expected_sha256(args.path, args.name, args.sha256), use_stamp=False)
+            print(f"{args.path}: ok")
+    except ModelStoreError as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Кэш фото вещей на диске: файл на каждый file_unique_id, общий размер ограничен, вытеснение — давно не читанные.
+
+file_id у одного и того же фото меняется (и разный у разных ботов), file_unique_id — нет, поэтому ключ — он.
+Файлы лежат в root/<2 символа sha1 ключа>/<ключ>; запись — во временный файл рядом и os.replace, так что
+читатель никогда не видит недописанный файл. Чтение — mmap: декодер PIL читает прямо из page cache без копии.
+Порядок LRU держится в памяти и переживает рестарт через mtime (при попадании файл «трогается»).
+
+    cache = PhotoCache("/var/cache/bot/photos", max_bytes=512 << 20)
+    buf = cache.get(unique_id)         # mmap или None
+    cache.put(unique_id, data)
+"""
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class PhotoCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # ключ -> размер, от давних к свежим
+        self._bytes = 0
+        self._lock = threading.Lock()  # get/put зовутся и из потоков (asyncio.to_thread)
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, key: str) -> str:
+        shard = hashlib.sha1(key.encode("utf-8")).hexdigest()[:2]
+        return os.path.join(self.root, shard, key)
+
+    def _scan(self):
+        found = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith(".tmp"):
+                    try:
+                        os.unlink(entry.path)  # недописанный файл с прошлого запуска
+                    except OSError:
+                        pass
+                    continue
+                st = entry.stat()
+                found.append((st.st_mtime_ns, entry.name, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key: str) -> Optional[mmap.mmap]:
+        with self._lock:
+            known = key in self._entries
+            if known:
+                self._entries.move_to_end(key)
+        if not known:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # файл удалили снаружи или он пустой
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._bytes -= size
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # mtime — порядок LRU после рестарта; на каталоге только для чтения не обновится
+        except OSError:
+            pass
+        self.hits += 1
+        return buf
+
+    def put(self, key: str, data: bytes):
+        if not key or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old
+            self._entries[key] = len(data)
+            self._bytes += len(data)
+            self._evict()
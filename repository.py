@@ -0,0 +1,484 @@
+"""
+Доступ к БД: все запросы бота — именованные prepared statements, пул и его метрики — здесь.
+
+Каждый запрос из STATEMENTS готовится на соединении один раз и дальше исполняется без повторного разбора:
+это кэш prepared statements самого asyncpg, его размер на соединение (STATEMENT_CACHE_SIZE) вмещает все STATEMENTS.
+Размер пула, таймауты ожидания соединения и запросов (общий и по имени запроса) задаются при connect().
+
+    repo = await Repository.connect(dsn, min_size=1, max_size=5, timeouts={"search": 3})
+    rows = await repo.fetch("wardrobe_page", user_id, 10, 0)
+    page, total = await repo.read_many(("fetch", "wardrobe_page", user_id, 10, 0), ("fetchval", "wardrobe_count", user_id))
+    async with repo.transaction() as db:          # несколько запросов на одном соединении в транзакции
+        await db.execute("reembed_update", ...)
+"""
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+import metrics
+import tracing
+
+# emb строк, записанных до появления wardrobe.emb_model: ViT-B/32 со стандартным препроцессингом clip,
+# то есть первая версия EMB_MODEL бота. Миграция помечает ими такие строки (см. MIGRATIONS)
+LEGACY_EMB_MODEL = "clip-ViT-B/32/v1"
+
+# ---------------- Statements ----------------
+STATEMENTS: Dict[str, str] = {
+    # вещи
+    "item_card": """
+        SELECT w.file_id, w.name, w.color_ru, w.category_ru, w.created_at, w.description,
+               COALESCE(t.tag_ids, '{}') AS tag_ids, COALESCE(t.tags, '{}') AS tags
+        FROM wardrobe w
+        LEFT JOIN LATERAL (
+            SELECT array_agg(id ORDER BY id) AS tag_ids, array_agg(tag ORDER BY id) AS tags
+            FROM tags WHERE item_id = w.id
+        ) t ON true
+        WHERE w.id = $1 AND w.user_id = $2
+    """,
+    "item_exists": "SELECT 1 FROM wardrobe WHERE id=$1 AND user_id=$2",
+    "item_name": "SELECT name FROM wardrobe WHERE id=$1 AND user_id=$2",
+    "item_file_and_name": "SELECT file_id, name, category_en FROM wardrobe WHERE id=$1 AND user_id=$2",
+    "item_insert": """
+        INSERT INTO wardrobe (user_id, file_id, emb, emb_model, name, color_en, color_ru, category_en, category_ru, created_at, description,
+                              file_unique_id)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+        RETURNING id
+    """,
+    "items_insert_bulk": """
+        INSERT INTO wardrobe (user_id, file_id, emb, emb_model, name, color_en, color_ru, category_en, category_ru, created_at, description,
+                              file_unique_id)
+        SELECT $1, f, e, $10, n, ce, cr, ke, kr, $9, '', fu
+        FROM unnest($2::text[], $3::bytea[], $4::text[], $5::text[], $6::text[], $7::text[], $8::text[], $11::text[])
+             WITH ORDINALITY AS u(f, e, n, ce, cr, ke, kr, fu, ord)
+        ORDER BY ord
+        RETURNING id
+    """,
+    "item_set_description": "UPDATE wardrobe SET description=$1 WHERE id=$2 AND user_id=$3",
+    # file_unique_id старых строк, узнанный через getFile, — чтобы после рестарта не звать getFile снова
+    "items_set_unique_id": "UPDATE wardrobe SET file_unique_id=$2 WHERE file_id=$1 AND file_unique_id IS NULL",
+    # название при импорте = категория; если пользователь его уже менял — не трогаем
+    "item_set_category": """
+        UPDATE wardrobe SET category_en=$1, category_ru=$2, name=CASE WHEN name=category_ru THEN $2 ELSE name END
+        WHERE id=$3 AND user_id=$4
+    """,
+    "item_delete": "DELETE FROM wardrobe WHERE id=$1 AND user_id=$2",
+    "items_delete": "DELETE FROM wardrobe WHERE user_id=$1 AND id = ANY($2::int[]) RETURNING id, category_en",
+    # подтверждённые метки вещей с эмбеддингом текущей модели — для персональных подсказок (suggest.py)
+    "label_index_rows": """
+        SELECT id, emb, name, category_en, color_en FROM wardrobe
+        WHERE user_id=$1 AND emb IS NOT NULL AND emb_model=$2
+    """,
+    "capsule_items": """
+        SELECT id, file_id, file_unique_id, name, color_ru, category_en FROM wardrobe
+        WHERE user_id=$1 AND id = ANY($2::int[])
+    """,
+    # граф совместимости (compat.py): списки соседей вещи по группам категорий
+    "compat_state": "SELECT 1 FROM item_neighbors_state WHERE user_id=$1 AND emb_model=$2 AND k=$3",
+    "compat_mark_built": """
+        INSERT INTO item_neighbors_state (user_id, emb_model, k) VALUES ($1, $2, $3)
+        ON CONFLICT (user_id) DO UPDATE SET emb_model = $2, k = $3, built_at = now()
+    """,
+    "compat_invalidate": "DELETE FROM item_neighbors_state WHERE user_id = ANY($1::bigint[])",
+    "compat_clear": "DELETE FROM item_neighbors WHERE user_id=$1",
+    "compat_drop_items": "DELETE FROM item_neighbors WHERE user_id=$1 AND item_id = ANY($2::int[])",
+    "compat_upsert": """
+        INSERT INTO item_neighbors (item_id, grp, user_id, neighbors)
+        SELECT i, g, $1, n FROM unnest($2::int[], $3::text[], $4::bytea[]) AS u(i, g, n)
+        ON CONFLICT (item_id, grp) DO UPDATE SET neighbors = EXCLUDED.neighbors
+    """,
+    "compat_group_rows": "SELECT item_id, grp, neighbors FROM item_neighbors WHERE user_id=$1 AND grp = ANY($2::text[])",
+    "compat_lists": """
+        SELECT item_id, grp, neighbors FROM item_neighbors
+        WHERE user_id=$1 AND item_id = ANY($2::int[]) AND grp = ANY($3::text[])
+    """,
+    "wardrobe_page": "SELECT id, name, color_ru, category_ru FROM wardrobe WHERE user_id=$1 ORDER BY created_at DESC LIMIT $2 OFFSET $3",
+    "wardrobe_count": "SELECT COUNT(*) FROM wardrobe WHERE user_id=$1",
+    "wardrobe_page_group": """
+        SELECT id, name, color_ru, category_ru FROM wardrobe WHERE user_id=$1 AND category_en = ANY($2::text[])
+        ORDER BY created_at DESC LIMIT $3 OFFSET $4
+    """,
+    "wardrobe_count_group": "SELECT COUNT(*) FROM wardrobe WHERE user_id=$1 AND category_en = ANY($2::text[])",
+    # $2 — ILIKE-шаблоны (исходный запрос и нормализованные формы): один текст запроса при любом их числе
+    "search": """
+        SELECT DISTINCT w.id, w.name, w.color_ru, w.created_at
+        FROM wardrobe w
+        LEFT JOIN tags t ON t.item_id = w.id
+        WHERE w.user_id = $1 AND (w.name ILIKE ANY($2::text[]) OR w.color_ru ILIKE ANY($2::text[])
+                                  OR w.description ILIKE ANY($2::text[]) OR t.tag ILIKE ANY($2::text[]))
+        ORDER BY w.created_at DESC
+        LIMIT 200
+    """,
+    # всё, по чему ищет inline-режим (search_index.py): вещи пользователя с тегами
+    "search_index_rows": """
+        SELECT w.id, w.name, w.color_ru, w.description, w.file_id, w.created_at, COALESCE(t.tags, '{}') AS tags
+        FROM wardrobe w
+        LEFT JOIN LATERAL (SELECT array_agg(tag) AS tags FROM tags WHERE item_id = w.id) t ON true
+        WHERE w.user_id = $1
+    """,
+    # теги
+    # тег без учёта регистра один на вещь (uq_tags_item_lower): NULL — такой тег уже есть или вещь чужая
+    "tag_insert": """
+        INSERT INTO tags (item_id, user_id, tag)
+        SELECT id, user_id, $3 FROM wardrobe WHERE id=$1 AND user_id=$2
+        ON CONFLICT (item_id, (LOWER(tag))) DO NOTHING
+        RETURNING id
+    """,
+    "tag_delete": "DELETE FROM tags WHERE id=$1 AND user_id=$2 RETURNING item_id",
+    # пакетная правка выбранных вещей: один запрос на весь набор, чужие id отсекаются по wardrobe.user_id
+    "tags_insert_many": """
+        INSERT INTO tags (item_id, user_id, tag)
+        SELECT w.id, $1, $3 FROM wardrobe w
+        WHERE w.user_id=$1 AND w.id = ANY($2::int[])
+        ON CONFLICT (item_id, (LOWER(tag))) DO NOTHING
+        RETURNING item_id
+    """,
+    "tags_delete_many": "DELETE FROM tags WHERE user_id=$1 AND item_id = ANY($2::int[]) AND LOWER(tag) = LOWER($3) RETURNING item_id",
+    # словарь тегов пользователя и вещи с тегом — по индексу idx_tags_user_lower (user_id, LOWER(tag), item_id)
+    "tag_vocabulary": """
+        SELECT MIN(tag) AS tag, LOWER(tag) AS key, COUNT(*) AS items FROM tags
+        WHERE user_id=$1 GROUP BY LOWER(tag) ORDER BY items DESC, key
+    """,
+    "tag_items_first": """
+        SELECT w.id, w.name, w.color_ru FROM tags t JOIN wardrobe w ON w.id = t.item_id
+        WHERE t.user_id=$1 AND LOWER(t.tag)=$2 ORDER BY t.item_id DESC LIMIT $3
+    """,
+    "tag_items_after": """
+        SELECT w.id, w.name, w.color_ru FROM tags t JOIN wardrobe w ON w.id = t.item_id
+        WHERE t.user_id=$1 AND LOWER(t.tag)=$2 AND t.item_id < $3 ORDER BY t.item_id DESC LIMIT $4
+    """,
+    "tag_items_before": """
+        SELECT w.id, w.name, w.color_ru FROM tags t JOIN wardrobe w ON w.id = t.item_id
+        WHERE t.user_id=$1 AND LOWER(t.tag)=$2 AND t.item_id > $3 ORDER BY t.item_id ASC LIMIT $4
+    """,
+    "tags_of_items": """
+        SELECT MIN(tag) AS tag, COUNT(DISTINCT item_id) AS items FROM tags
+        WHERE user_id=$1 AND item_id = ANY($2::int[])
+        GROUP BY LOWER(tag) ORDER BY items DESC, LOWER(tag) LIMIT $3
+    """,
+    # капсулы
+    "capsule_insert": """
+        INSERT INTO capsules (user_id, name, item_ids, thumbnail_file_id, thumbnail_item_ids, created_at)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        RETURNING id
+    """,
+    # список капсул (новые сверху) страницами по ключу (created_at, id): $2, $3 — курсор, $4 — размер страницы + 1
+    "capsules_first": """
+        SELECT id, name, created_at FROM capsules WHERE user_id=$1
+        ORDER BY created_at DESC, id DESC LIMIT $2
+    """,
+    "capsules_after": """
+        SELECT id, name, created_at FROM capsules WHERE user_id=$1 AND (created_at, id) < ($2, $3)
+        ORDER BY created_at DESC, id DESC LIMIT $4
+    """,
+    "capsules_before": """
+        SELECT id, name, created_at FROM capsules WHERE user_id=$1 AND (created_at, id) > ($2, $3)
+        ORDER BY created_at ASC, id ASC LIMIT $4
+    """,
+    # капсула и её вещи одним запросом, в порядке item_ids; строка с item_id NULL — вещи уже нет (или капсула пустая)
+    "capsule_view": """
+        SELECT c.id, c.name, c.created_at, c.thumbnail_file_id, c.thumbnail_item_ids,
+               w.id AS item_id, w.name AS item_name, w.file_id, w.file_unique_id, w.category_ru
+        FROM capsules c
+        LEFT JOIN LATERAL unnest(c.item_ids) WITH ORDINALITY AS u(item_id, pos) ON true
+        LEFT JOIN wardrobe w ON w.id = u.item_id AND w.user_id = c.user_id
+        WHERE c.id = $1 AND c.user_id = $2
+        ORDER BY u.pos
+    """,
+    "capsule_set_thumbnail": "UPDATE capsules SET thumbnail_file_id=$1, thumbnail_item_ids=$2 WHERE id=$3 AND user_id=$4",
+    "capsule_delete": "DELETE FROM capsules WHERE id=$1 AND user_id=$2",
+    # фоновое перевычисление эмбеддингов
+    "reembed_progress": "SELECT last_id, done, failed, finished FROM reembed_progress WHERE emb_model=$1",
+    "reembed_next_batch": """
+        SELECT id, user_id, file_id, file_unique_id, name, category_en, color_en FROM wardrobe
+        WHERE id > $1 AND emb_model IS DISTINCT FROM $2 ORDER BY id LIMIT $3
+    """,
+    "reembed_update": """
+        UPDATE wardrobe w SET emb = u.e, emb_model = $1
+        FROM unnest($2::int[], $3::bytea[]) AS u(id, e) WHERE w.id = u.id
+    """,
+    "reembed_checkpoint": """
+        INSERT INTO reembed_progress (emb_model, last_id, done, failed) VALUES ($1, $2, $3, $4)
+        ON CONFLICT (emb_model) DO UPDATE SET last_id = $2, done = $3, failed = $4, finished = false, updated_at = now()
+    """,
+    # finished — на момент последней проверки устаревших строк не было; воркер всё равно проверяет снова
+    "reembed_finish": """
+        INSERT INTO reembed_progress (emb_model, last_id, done, failed, finished) VALUES ($1, 0, $2, $3, true)
+        ON CONFLICT (emb_model) DO UPDATE SET last_id = 0, done = $2, failed = $3, finished = true, updated_at = now()
+    """,
+}
+
+# ---------------- Schema ----------------
+MIGRATIONS: List[str] = [
+    """
+    CREATE TABLE IF NOT EXISTS wardrobe (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        file_id TEXT NOT NULL,
+        emb BYTEA,
+        name TEXT,
+        color_en TEXT,
+        color_ru TEXT,
+        category_en TEXT,
+        category_ru TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        description TEXT DEFAULT ''
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tags (
+        id SERIAL PRIMARY KEY,
+        item_id INTEGER NOT NULL REFERENCES wardrobe(id) ON DELETE CASCADE,
+        user_id BIGINT NOT NULL,
+        tag TEXT NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_tags_item ON tags(item_id);",
+    "CREATE INDEX IF NOT EXISTS idx_tags_tag_lower ON tags(LOWER(tag));",
+    # один тег без учёта регистра на вещь: перед созданием уникального индекса убираем дубли, набежавшие
+    # до него (проверка «есть ли тег» и вставка шли двумя запросами); дальше tag_insert — ON CONFLICT DO NOTHING
+    """
+    DO $$
+    BEGIN
+        IF to_regclass('uq_tags_item_lower') IS NULL THEN
+            DELETE FROM tags a USING tags b
+            WHERE a.item_id = b.item_id AND LOWER(a.tag) = LOWER(b.tag) AND a.id > b.id;
+        END IF;
+    END $$;
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_tags_item_lower ON tags(item_id, LOWER(tag));",
+    "CREATE INDEX IF NOT EXISTS idx_tags_user_lower ON tags(user_id, LOWER(tag), item_id);",
+    """
+    CREATE TABLE IF NOT EXISTS capsules (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        name TEXT NOT NULL,
+        item_ids INTEGER[] NOT NULL,
+        thumbnail_file_id TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        description TEXT DEFAULT ''
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_capsules_user ON capsules(user_id);",
+    # постраничный список капсул по (created_at, id)
+    "CREATE INDEX IF NOT EXISTS idx_capsules_user_created ON capsules(user_id, created_at DESC, id DESC);",
+    # для каких вещей отрисован коллаж в thumbnail_file_id (NULL — коллажа ещё нет)
+    "ALTER TABLE capsules ADD COLUMN IF NOT EXISTS thumbnail_item_ids INTEGER[];",
+    # какой моделью посчитан emb; строки до появления колонки посчитаны LEGACY_EMB_MODEL — без этой пометки
+    # подсказки, капсулы и граф совместимости (они берут только emb текущей модели) не видели бы их до reembed_worker
+    "ALTER TABLE wardrobe ADD COLUMN IF NOT EXISTS emb_model TEXT;",
+    f"UPDATE wardrobe SET emb_model = '{LEGACY_EMB_MODEL}' WHERE emb_model IS NULL AND emb IS NOT NULL;",
+    # постоянный id файла в Telegram — ключ дискового кэша фото (photo_cache.py); NULL у старых строк,
+    # для них он узнаётся через getFile при первом скачивании и записывается обратно (items_set_unique_id)
+    "ALTER TABLE wardrobe ADD COLUMN IF NOT EXISTS file_unique_id TEXT;",
+    # только строки без file_unique_id — индекс сжимается по мере дозаполнения
+    "CREATE INDEX IF NOT EXISTS idx_wardrobe_file_id_no_unique ON wardrobe(file_id) WHERE file_unique_id IS NULL;",
+    """
+    CREATE TABLE IF NOT EXISTS reembed_progress (
+        emb_model TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        done INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        finished BOOLEAN NOT NULL DEFAULT false,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+    );
+    """,
+    # граф совместимости: top-K соседей вещи в каждой чужой группе категорий, упакованы compat.encode
+    """
+    CREATE TABLE IF NOT EXISTS item_neighbors (
+        item_id INTEGER NOT NULL REFERENCES wardrobe(id) ON DELETE CASCADE,
+        grp TEXT NOT NULL,
+        user_id BIGINT NOT NULL,
+        neighbors BYTEA NOT NULL,
+        PRIMARY KEY (item_id, grp)
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_item_neighbors_user_grp ON item_neighbors(user_id, grp);",
+    # граф пользователя построен целиком для этой модели и K; строки нет — граф строится заново при первой капсуле
+    """
+    CREATE TABLE IF NOT EXISTS item_neighbors_state (
+        user_id BIGINT PRIMARY KEY,
+        emb_model TEXT NOT NULL,
+        k INTEGER NOT NULL,
+        built_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+    );
+    """,
+]
+
+# кэш prepared statements asyncpg на соединение: все STATEMENTS и запас под запросы в обход них (db.conn в бенчмарках)
+STATEMENT_CACHE_SIZE = len(STATEMENTS) + 32
+
+# ---------------- Metrics ----------------
+DB_QUERY_SECONDS = metrics.histogram("bot_db_query_seconds", "Время запроса к БД", ["statement"])
+DB_QUERY_ERRORS = metrics.counter("bot_db_query_errors_total", "Ошибки запросов к БД", ["statement"])
+DB_ACQUIRE_SECONDS = metrics.histogram("bot_db_pool_acquire_seconds", "Ожидание соединения из пула",
+                                       buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+DB_ACQUIRE_TIMEOUTS = metrics.counter("bot_db_pool_acquire_timeouts_total", "Не дождались соединения из пула")
+DB_POOL_SIZE = metrics.gauge("bot_db_pool_size", "Открытых соединений в пуле")
+DB_POOL_IN_USE = metrics.gauge("bot_db_pool_in_use", "Соединений выдано из пула")
+DB_POOL_MAX = metrics.gauge("bot_db_pool_max_size", "Максимум соединений пула")
+DB_POOL_WAITING = metrics.gauge("bot_db_pool_waiting", "Корутин ждут соединение")
+
+
+class Session:
+    """Запросы по имени на одном соединении (внутри repo.session()/repo.transaction())."""
+
+    def __init__(self, repo: "Repository", conn):
+        self.repo = repo
+        self.conn = conn  # «сырое» соединение — для COPY, курсоров и вложенных транзакций
+
+    async def _run(self, method: str, name: str, args: Sequence[Any]):
+        timeout = self.repo.timeouts.get(name, self.repo.command_timeout)
+        t0 = time.perf_counter()
+        try:
+            try:
+                return await getattr(self.conn, method)(STATEMENTS[name], *args, timeout=timeout)
+            except asyncpg.exceptions.OutdatedSchemaCacheError:
+                # схема поменялась после PREPARE: asyncpg уже сбросил кэш — повторяем один раз
+                # (в транзакции нельзя: она уже прервана; InvalidCachedStatementError asyncpg повторяет сам)
+                if self.conn.is_in_transaction():
+                    raise
+                return await getattr(self.conn, method)(STATEMENTS[name], *args, timeout=timeout)
+        except Exception:
+            DB_QUERY_ERRORS.labels(name).inc()
+            raise
+        finally:
+            sec = time.perf_counter() - t0
+            DB_QUERY_SECONDS.labels(name).observe(sec)
+            tracing.add_child("db", name, sec)
+
+    async def fetch(self, name: str, *args) -> List[asyncpg.Record]:
+        return await self._run("fetch", name, args)
+
+    async def fetchrow(self, name: str, *args) -> Optional[asyncpg.Record]:
+        return await self._run("fetchrow", name, args)
+
+    async def fetchval(self, name: str, *args) -> Any:
+        return await self._run("fetchval", name, args)
+
+    async def execute(self, name: str, *args) -> None:
+        await self._run("execute", name, args)
+
+
+class _Acquire:
+    def __init__(self, repo: "Repository", transaction: bool):
+        self.repo = repo
+        self.transaction = transaction
+        self.conn = None
+        self.tx = None
+
+    async def __aenter__(self) -> Session:
+        repo = self.repo
+        t0 = time.perf_counter()
+        repo.waiting += 1
+        try:
+            self.conn = await repo.pool.acquire(timeout=repo.acquire_timeout)
+        except asyncio.TimeoutError:
+            DB_ACQUIRE_TIMEOUTS.inc()
+            raise
+        finally:
+            repo.waiting -= 1
+            wait = time.perf_counter() - t0
+            DB_ACQUIRE_SECONDS.observe(wait)
+            tracing.add_child("pool", "acquire", wait)
+        if self.transaction:
+            self.tx = self.conn.transaction()
+            try:
+                await self.tx.start()
+            except BaseException:
+                await self.repo.pool.release(self.conn)
+                raise
+        return Session(repo, self.conn)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if self.tx is not None:
+                if exc_type is None:
+                    await self.tx.commit()
+                else:
+                    await self.tx.rollback()
+        finally:
+            await self.repo.pool.release(self.conn)
+
+
+class Repository:
+    def __init__(self, pool: asyncpg.pool.Pool, command_timeout: Optional[float] = None,
+                 acquire_timeout: Optional[float] = None, timeouts: Optional[Dict[str, float]] = None):
+        self.pool = pool
+        self.command_timeout = command_timeout
+        self.acquire_timeout = acquire_timeout
+        self.timeouts = dict(timeouts or {})
+        unknown = sorted(set(self.timeouts) - set(STATEMENTS))
+        if unknown:
+            # опечатка или запрос, которого больше нет, — не повод не стартовать
+            print(f"[db] ignoring timeouts for unknown statements: {unknown}")
+            for name in unknown:
+                del self.timeouts[name]
+        self.waiting = 0
+        DB_POOL_SIZE.set_function(pool.get_size)
+        DB_POOL_IN_USE.set_function(lambda: pool.get_size() - pool.get_idle_size())
+        DB_POOL_MAX.set_function(pool.get_max_size)
+        DB_POOL_WAITING.set_function(lambda: self.waiting)
+
+    @classmethod
+    async def connect(cls, dsn: str, *, min_size: int = 1, max_size: int = 5, command_timeout: Optional[float] = None,
+                      acquire_timeout: Optional[float] = None, timeouts: Optional[Dict[str, float]] = None,
+                      attempts: int = 5, delay: float = 2.0) -> "Repository":
+        last_exc = None
+        for i in range(attempts):
+            try:
+                pool = await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size,
+                                                 command_timeout=command_timeout, statement_cache_size=STATEMENT_CACHE_SIZE)
+                return cls(pool, command_timeout=command_timeout, acquire_timeout=acquire_timeout, timeouts=timeouts)
+            except Exception as e:
+                last_exc = e
+                print(f"[db] connect attempt {i+1}/{attempts} failed: {e}")
+                await asyncio.sleep(delay)
+        print(f"Не удалось подключиться к базе данных: {last_exc}")
+        raise last_exc
+
+    def session(self) -> _Acquire:
+        return _Acquire(self, transaction=False)
+
+    def transaction(self) -> _Acquire:
+        return _Acquire(self, transaction=True)
+
+    async def fetch(self, name: str, *args) -> List[asyncpg.Record]:
+        async with self.session() as db:
+            return await db.fetch(name, *args)
+
+    async def fetchrow(self, name: str, *args) -> Optional[asyncpg.Record]:
+        async with self.session() as db:
+            return await db.fetchrow(name, *args)
+
+    async def fetchval(self, name: str, *args) -> Any:
+        async with self.session() as db:
+            return await db.fetchval(name, *args)
+
+    async def execute(self, name: str, *args) -> None:
+        async with self.session() as db:
+            await db.execute(name, *args)
+
+    async def read_many(self, *reads: Tuple[Any, ...]) -> List[Any]:
+        """Несколько чтений подряд на одном соединении: ("fetch"|"fetchrow"|"fetchval", имя, *аргументы)."""
+        async with self.session() as db:
+            return [await getattr(db, method)(name, *args) for method, name, *args in reads]
+
+    async def migrate(self):
+        async with self.session() as db:
+            for ddl in MIGRATIONS:
+                await db.conn.execute(ddl)
+
+    async def close(self):
+        await self.pool.close()
+
+
+def parse_timeouts(spec: str) -> Dict[str, float]:
+    """'search=3,capsule_items=1.5' -> {'search': 3.0, 'capsule_items': 1.5}."""
+    out: Dict[str, float] = {}
+    for part in (spec or "").split(","):
+        if part.strip():
+            name, _, value = part.partition("=")
+            out[name.strip()] = float(value)
+    return out
@@ -0,0 +1,126 @@
+"""
+Поиск по гардеробу пользователя в памяти — для inline-режима, где запрос приходит на каждое нажатие клавиши.
+
+Документ — вещь: название, цвет, теги и описание одной строкой (нижний регистр, ё -> е). Индексы:
+  * триграммы -> множество вещей: слово запроса длиной от 3 символов ищется как подстрока (как ILIKE '%слово%'):
+    кандидаты — пересечение множеств его триграмм, затем проверка подстрокой;
+  * отсортированный список слов документов: короткое (1–2 символа) слово запроса — префикс слова (bisect).
+Слова запроса объединяются по И; прилагательное ищется и по основе («красная» находит «красный»).
+Результат — id вещей от новых к старым, как у поиска в БД.
+
+    index = TextIndex()
+    index.add(item_id, created_at, name, color_ru, description, *tags)
+    ids = index.search("красн плат")
+"""
+import bisect
+import re
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+_WORD = re.compile(r"\w+")
+_ADJ_ENDINGS = ("ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой")
+
+
+def fold(text: Optional[str]) -> str:
+    return (text or "").lower().replace("ё", "е")
+
+
+def trigrams(word: str) -> Set[str]:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def stem(word: str) -> str:
+    """Основа прилагательного без окончания — только если после отрезания остаётся хотя бы 3 символа."""
+    for ending in _ADJ_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+class TextIndex:
+    def __init__(self):
+        self._text: Dict[int, str] = {}
+        self._order: Dict[int, Any] = {}  # id -> ключ сортировки (created_at)
+        self._grams: Dict[str, Set[int]] = {}
+        self._words: List[Tuple[str, int]] = []  # (слово, id), сортируется при первом поиске по префиксу
+        self._words_sorted = True
+        self._ranked: Optional[List[int]] = None  # все id от новых к старым
+        self._pos: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._text)
+
+    def add(self, item_id: int, order_key: Any, *fields: Optional[str]):
+        """Новая вещь или замена текста уже добавленной (старые слова перестают находить её)."""
+        old = self._text.get(item_id)
+        if old is not None:
+            self._discard(item_id, old)
+        text = " ".join(fold(f) for f in fields if f)
+        self._text[item_id] = text
+        self._order[item_id] = order_key
+        for word in set(_WORD.findall(text)):
+            for g in trigrams(word):
+                self._grams.setdefault(g, set()).add(item_id)
+            self._words.append((word, item_id))
+        self._words_sorted = False
+        self._ranked = None
+
+    def _discard(self, item_id: int, text: str):
+        for word in set(_WORD.findall(text)):
+            for g in trigrams(word):
+                found = self._grams.get(g)
+                if found is not None:
+                    found.discard(item_id)
+                    if not found:
+                        del self._grams[g]
+        self._words = [w for w in self._words if w[1] != item_id]
+
+    def _substring(self, word: str) -> Set[int]:
+        sets = []
+        for g in trigrams(word):
+            found = self._grams.get(g)
+            if not found:
+                return set()
+            sets.append(found)
+        sets.sort(key=len)
+        candidates = set(sets[0]).intersection(*sets[1:])
+        return {i for i in candidates if word in self._text[i]}
+
+    def _prefix(self, word: str) -> Set[int]:
+        if not self._words_sorted:
+            self._words.sort()
+            self._words_sorted = True
+        out = set()
+        i = bisect.bisect_left(self._words, (word, -1))
+        while i < len(self._words) and self._words[i][0].startswith(word):
+            out.add(self._words[i][1])
+            i += 1
+        return out
+
+    def _match(self, word: str) -> Set[int]:
+        if len(word) < 3:
+            return self._prefix(word)
+        return self._substring(stem(word))
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[int]:
+        if self._ranked is None:
+            self._ranked = sorted(self._text, key=lambda i: (self._order[i] is not None, self._order[i], i), reverse=True)
+            self._pos = {item_id: n for n, item_id in enumerate(self._ranked)}
+        words = _WORD.findall(fold(query))
+        if not words:
+            return self._ranked[:limit] if limit is not None else list(self._ranked)
+        found: Optional[Set[int]] = None
+        for word in sorted(words, key=len, reverse=True):  # длинные слова отсекают больше
+            matched = self._match(word)
+            found = matched if found is None else found & matched
+            if not found:
+                return []
+        ranked = sorted(found, key=self._pos.__getitem__)
+        return ranked[:limit] if limit is not None else ranked
+
+
+def build(rows: Iterable[Any], fields: Tuple[str, ...] = ("name", "color_ru", "description"),
+          tags_field: str = "tags", order_field: str = "created_at") -> TextIndex:
+    index = TextIndex()
+    for r in rows:
+        index.add(r["id"], r[order_field], *(r[f] for f in fields), *(r[tags_field] or ()))
+    return index
@@ -0,0 +1,166 @@
+"""
+Персональные подсказки меток по ближайшим вещам пользователя.
+
+Индекс пользователя — его вещи с эмбеддингами текущей модели и подтверждёнными метками (то, что он сохранил,
+в том числе после исправления названия или цвета, и исправления из «Нет — я введу сам(а)»). Векторы лежат одной
+float32-матрицей (N, D) с запасом по ёмкости, удаление — перестановкой последней строки на место удалённой;
+поиск соседей — одно умножение матрицы на вектор и argpartition. Та же матрица отвечает на семантический поиск
+по гардеробу: nearest() с эмбеддингом текста запроса вместо эмбеддинга фото.
+
+    index.add(item_id, vec, name="Худи", category_en="hoodie", color_en="gray")
+    votes, best = index.vote(vec, "color_en")                  # {"gray": 0.8, "black": 0.2}, 0.93
+    ranked = blend(zero_shot_probs, votes, best, min_sim=0.8, strong_sim=0.92)
+
+Сосед с косинусом >= strong_sim полностью заменяет zero-shot ответ; соседи ближе min_sim смешиваются с ним
+с весом, линейно растущим от min_sim к strong_sim.
+"""
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+FIELDS = ("name", "category_en", "color_en")
+
+
+class LabelIndex:
+    def __init__(self, dim: Optional[int] = None, capacity: int = 64):
+        # размерность можно не знать заранее — тогда она берётся из первой записи
+        self.dim = dim
+        self._capacity = capacity
+        self._vecs = np.zeros((capacity, dim), dtype=np.float32) if dim else None
+        self._keys: List[Hashable] = []
+        self._labels: List[Dict[str, str]] = []
+        self._rows: Dict[Hashable, int] = {}
+        self.version = 0  # растёт при каждом изменении — для кэшей производных данных
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._rows
+
+    def add(self, key: Hashable, vec: np.ndarray, **labels: Optional[str]):
+        """Новая запись или замена существующей с тем же ключом (id вещи; для исправлений без вещи — любой ключ)."""
+        v = np.asarray(vec, dtype=np.float32).reshape(-1)
+        if self._vecs is None:
+            self.dim = v.shape[0]
+            self._vecs = np.zeros((self._capacity, self.dim), dtype=np.float32)
+        if v.shape[0] != self.dim:
+            raise ValueError(f"expected dim {self.dim}, got {v.shape[0]}")
+        norm = float(np.linalg.norm(v))
+        if norm == 0:
+            return
+        clean = {f: labels[f] for f in FIELDS if labels.get(f)}
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._keys)
+            if row == len(self._vecs):
+                grown = np.zeros((2 * len(self._vecs), self.dim), dtype=np.float32)
+                grown[:row] = self._vecs
+                self._vecs = grown
+            self._keys.append(key)
+            self._labels.append(clean)
+            self._rows[key] = row
+        else:
+            self._labels[row] = clean
+        self._vecs[row] = v / norm
+        self.version += 1
+
+    def update(self, key: Hashable, **labels: Optional[str]):
+        row = self._rows.get(key)
+        if row is not None:
+            self.version += 1
+            for f, value in labels.items():
+                if f in FIELDS:
+                    if value:
+                        self._labels[row][f] = value
+                    else:
+                        self._labels[row].pop(f, None)
+
+    def remove(self, key: Hashable):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        last = len(self._keys) - 1
+        if row != last:
+            self._vecs[row] = self._vecs[last]
+            self._keys[row] = self._keys[last]
+            self._labels[row] = self._labels[last]
+            self._rows[self._keys[row]] = row
+        self._keys.pop()
+        self._labels.pop()
+        self.version += 1
+
+    def neighbours(self, vec: np.ndarray, k: int = 5) -> List[Tuple[float, int]]:
+        """(косинус, строка) k ближайших, по убыванию."""
+        n = len(self._keys)
+        if n == 0:
+            return []
+        q = np.asarray(vec, dtype=np.float32).reshape(-1)
+        q = q / (float(np.linalg.norm(q)) or 1.0)
+        sims = self._vecs[:n] @ q
+        k = min(k, n)
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return [(float(sims[i]), int(i)) for i in top]
+
+    def nearest(self, vec: np.ndarray, k: int = 10, min_sim: float = -1.0,
+                where: Optional[Callable[[Hashable], bool]] = None) -> List[Tuple[float, Hashable, Dict[str, str]]]:
+        """(косинус, ключ, метки) до k записей не дальше min_sim, по убыванию; where — какие ключи подходят."""
+        n = len(self._keys)
+        if n == 0:
+            return []
+        q = np.asarray(vec, dtype=np.float32).reshape(-1)
+        q = q / (float(np.linalg.norm(q)) or 1.0)
+        sims = self._vecs[:n] @ q
+        out = []
+        for i in np.argsort(-sims):
+            if sims[i] < min_sim or len(out) == k:
+                break
+            key = self._keys[i]
+            if where is None or where(key):
+                out.append((float(sims[i]), key, dict(self._labels[i])))
+        return out
+
+    def items(self, where: Optional[Callable[[Hashable], bool]] = None) -> Tuple[List[Hashable], List[Dict[str, str]]]:
+        """Ключи и их метки (сами словари индекса — только для чтения)."""
+        rows = [i for i, key in enumerate(self._keys) if where is None or where(key)]
+        return [self._keys[i] for i in rows], [self._labels[i] for i in rows]
+
+    def vectors(self, keys: List[Hashable]) -> np.ndarray:
+        """Копия нормированных векторов ключей, строки в порядке keys."""
+        return self._vecs[[self._rows[k] for k in keys]] if keys else np.zeros((0, self.dim or 0), dtype=np.float32)
+
+    def similarity(self, vec: np.ndarray, keys: List[Hashable]) -> np.ndarray:
+        """Косинусы vec с записями keys, в порядке keys (без копирования матрицы)."""
+        n = len(self._keys)
+        q = np.asarray(vec, dtype=np.float32).reshape(-1)
+        q = q / (float(np.linalg.norm(q)) or 1.0)
+        return (self._vecs[:n] @ q)[[self._rows[k] for k in keys]] if keys else np.zeros(0, dtype=np.float32)
+
+    def vote(self, vec: np.ndarray, field: str, k: int = 5, min_sim: float = 0.8) -> Tuple[Dict[str, float], float]:
+        """Доли меток поля среди соседей ближе min_sim (вес — косинус) и косинус ближайшего из них."""
+        weights: Dict[str, float] = {}
+        best = 0.0
+        for sim, row in self.neighbours(vec, k):
+            label = self._labels[row].get(field)
+            if sim < min_sim or not label:
+                continue
+            weights[label] = weights.get(label, 0.0) + sim
+            best = max(best, sim)
+        total = sum(weights.values())
+        return ({label: w / total for label, w in weights.items()} if total else {}), best
+
+
+def blend(zero_shot: Dict[str, float], votes: Dict[str, float], best_sim: float,
+          min_sim: float = 0.8, strong_sim: float = 0.92) -> List[Tuple[str, float]]:
+    """Метки с итоговыми вероятностями по убыванию: zero-shot, пересчитанный голосами соседей."""
+    if not votes or best_sim < min_sim:
+        alpha = 0.0
+    elif best_sim >= strong_sim:
+        alpha = 1.0
+    else:
+        alpha = (best_sim - min_sim) / (strong_sim - min_sim)
+    mixed = {label: (1 - alpha) * p for label, p in zero_shot.items()}
+    for label, share in votes.items():
+        mixed[label] = mixed.get(label, 0.0) + alpha * share
+    return sorted(mixed.items(), key=lambda kv: kv[1], reverse=True)
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionQueue, Overloaded
+
+
+def gated(log, name, gate):
+    async def job():
+        log.append(f"start {name}")
+        await gate.wait()
+        log.append(f"end {name}")
+    return job
+
+
+def test_runs_up_to_workers_then_queues_in_order():
+    async def scenario():
+        log, gate = [], asyncio.Event()
+        queue = AdmissionQueue(workers=2, max_backlog=5)
+        positions = [queue.submit(gated(log, i, gate)) for i in range(4)]
+        await asyncio.sleep(0)
+        assert positions == [0, 0, 1, 2]
+        assert (queue.running, queue.waiting) == (2, 2)
+        assert log == ["start 0", "start 1"]
+        gate.set()
+        await queue.drain()
+        assert (queue.running, queue.waiting) == (0, 0)
+        return log
+    log = asyncio.run(scenario())
+    assert [entry for entry in log if entry.startswith("start")] == ["start 0", "start 1", "start 2", "start 3"]
+
+
+def test_full_backlog_raises_overloaded():
+    async def scenario():
+        gate = asyncio.Event()
+        queue = AdmissionQueue(workers=1, max_backlog=1)
+        queue.submit(gated([], "a", gate))
+        assert queue.submit(gated([], "b", gate)) == 1
+        with pytest.raises(Overloaded):
+            queue.submit(gated([], "c", gate))
+        with pytest.raises(Overloaded):
+            queue.submit(gated([], "d", gate))
+        assert (queue.rejected, queue.waiting) == (2, 1)
+        gate.set()
+        await queue.drain()
+        assert queue.submit(gated([], "e", gate)) == 0
+        await queue.drain()
+    asyncio.run(scenario())
+
+
+def test_zero_backlog_only_admits_free_workers():
+    async def scenario():
+        gate = asyncio.Event()
+        queue = AdmissionQueue(workers=0, max_backlog=-3)
+        assert (queue.workers, queue.max_backlog) == (1, 0)
+        queue.submit(gated([], "a", gate))
+        with pytest.raises(Overloaded):
+            queue.submit(gated([], "b", gate))
+        gate.set()
+        await queue.drain()
+    asyncio.run(scenario())
+
+
+def test_failing_job_does_not_stop_queue(capsys):
+    async def boom():
+        raise ValueError("boom")
+
+    async def scenario():
+        done = []
+
+        async def ok():
+            done.append(1)
+        queue = AdmissionQueue(workers=1, max_backlog=2)
+        queue.submit(boom)
+        queue.submit(ok)
+        await queue.drain()
+        assert done == [1] and queue.running == 0
+    asyncio.run(scenario())
+    assert "ValueError: boom" in capsys.readouterr().err
+
+
+def test_on_wait_reports_queue_time():
+    async def scenario():
+        waits, gate = [], asyncio.Event()
+        queue = AdmissionQueue(workers=1, max_backlog=1, on_wait=waits.append)
+        queue.submit(gated([], "a", gate))
+        queue.submit(gated([], "b", gate))
+        await asyncio.sleep(0.02)
+        gate.set()
+        await queue.drain()
+        return waits
+    waits = asyncio.run(scenario())
+    assert len(waits) == 2
+    assert waits[0] < waits[1] and waits[1] >= 0.015
+
+
+def test_drain_waits_for_jobs_started_during_drain():
+    async def scenario():
+        queue = AdmissionQueue(workers=1, max_backlog=4)
+        done = []
+
+        async def job(i):
+            await asyncio.sleep(0.001)
+            done.append(i)
+        for i in range(4):
+            queue.submit(lambda i=i: job(i))
+        await queue.drain()
+        return done
+    assert asyncio.run(scenario()) == [0, 1, 2, 3]
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from callbacks import MAX_CALLBACK_DATA, CallbackDataError, CallbackRouter, TokenField, TokenStore
+
+
+def make_router(**kwargs) -> CallbackRouter:
+    router = CallbackRouter(**kwargs)
+
+    @router.route("view_item", fields=(int,))
+    async def view_item(cb, item_id):
+        return ("view", item_id)
+
+    @router.route("wardrobe_list", "wardrobe_grid", fields=(str, int))
+    async def wardrobe_list(cb, group, page):
+        return ("list", group, page)
+
+    @router.route("offer_add", fields=(TokenField,))
+    async def offer_add(cb, file_id):
+        return ("offer", file_id)
+
+    @router.route("menu")
+    async def menu(cb):
+        return ("menu",)
+    return router
+
+
+def test_pack_unpack_roundtrip():
+    router = make_router()
+    assert router.pack("view_item", 42) == "view_item:42"
+    fn, args = router.unpack("view_item:42")
+    assert asyncio.run(fn(None, *args)) == ("view", 42)
+    assert router.unpack(router.pack("wardrobe_grid", "tops", 3))[1] == ("tops", 3)
+    assert router.unpack("menu")[1] == ()
+
+
+def test_missing_tail_fields_are_none():
+    router = make_router()
+    assert router.pack("wardrobe_list", "all", None) == "wardrobe_list:all"
+    assert router.unpack("wardrobe_list:all")[1] == ("all", None)
+    assert router.unpack("wardrobe_list")[1] == (None, None)
+
+
+def test_unknown_action_and_bad_fields():
+    router = make_router()
+    assert router.unpack("nope:1") == (None, ())
+    with pytest.raises(CallbackDataError):
+        router.unpack("view_item:x")
+    with pytest.raises(CallbackDataError):
+        router.unpack("menu:1")
+    with pytest.raises(ValueError):
+        router.pack("view_item", 1, 2)
+    with pytest.raises(ValueError):
+        router.pack("wardrobe_list", "a:b", 0)
+
+
+def test_duplicate_and_bad_actions_rejected():
+    router = make_router()
+    with pytest.raises(ValueError):
+        router.route("menu")(lambda cb: None)
+    with pytest.raises(ValueError):
+        router.route("a:b")(lambda cb: None)
+    assert "menu" in router and len(router) == 5
+
+
+def test_long_values_go_through_tokens():
+    router = make_router()
+    file_id = "AgACAgIAAxkBAAI" + "x" * 80  # настоящие file_id длиннее 64 байт
+    data = router.pack("offer_add", file_id)
+    assert len(data.encode()) <= MAX_CALLBACK_DATA
+    assert router.pack("offer_add", file_id) == data  # одно значение — один токен
+    assert router.unpack(data)[1] == (file_id,)
+
+
+def test_64_byte_limit():
+    router = make_router()
+    group = "g" * (MAX_CALLBACK_DATA - len("wardrobe_list::1"))
+    assert len(router.pack("wardrobe_list", group, 1)) == MAX_CALLBACK_DATA
+    with pytest.raises(ValueError, match="64 bytes"):
+        router.pack("wardrobe_list", group + "g", 1)
+    with pytest.raises(ValueError):
+        router.pack("wardrobe_list", "ж" * 30, 1)  # предел — в байтах UTF-8, а не в символах
+
+
+def test_evicted_token_expires():
+    router = make_router(tokens=TokenStore(max_size=2))
+    old = router.pack("offer_add", "file-1")
+    recent = router.pack("offer_add", "file-2")
+    router.unpack(old)  # обращение освежает токен — вытесняется самый давний
+    router.pack("offer_add", "file-3")
+    assert router.unpack(old)[1] == ("file-1",)
+    with pytest.raises(CallbackDataError, match="expired"):
+        router.unpack(recent)
+    assert len(router.tokens) == 2
+    # вытесненное значение при повторной упаковке получает новый токен
+    assert router.unpack(router.pack("offer_add", "file-2"))[1] == ("file-2",)
+
+
+def test_token_store_reuses_tokens():
+    store = TokenStore(nbytes=4)
+    token = store.put("value")
+    assert store.put("value") == token
+    assert store.get(token) == "value"
+    assert store.get("missing") is None
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import colors
+
+LABELS = list(colors.PALETTE)
+
+
+def solid(rgb, size=(64, 64)):
+    return Image.new("RGB", size, rgb)
+
+
+def test_lab_of_white_and_black():
+    white, black = colors.srgb_to_lab(np.array([[255, 255, 255], [0, 0, 0]]))
+    assert white[0] == pytest.approx(100, abs=0.5)
+    assert abs(white[1]) < 1 and abs(white[2]) < 1
+    assert black[0] == pytest.approx(0, abs=0.5)
+
+
+def test_solid_image_is_one_colour():
+    assert colors.dominant_colors(solid((200, 25, 30)), LABELS) == [("red", pytest.approx(1.0))]
+
+
+def test_dark_navy_maps_to_blue():
+    assert colors.top_color(solid((25, 35, 80)), LABELS)[0] == "blue"
+
+
+def test_item_wins_over_uniform_background():
+    img = solid((245, 245, 245), (120, 160))
+    img.paste((40, 80, 180), (30, 40, 90, 120))  # синяя вещь в центре занимает меньше половины кадра
+    found = colors.dominant_colors(img, LABELS)
+    assert found[0][0] == "blue"
+    assert sum(share for _, share in found) == pytest.approx(1.0)
+
+
+def test_min_share_drops_small_clusters():
+    img = solid((40, 140, 60), (100, 100))
+    img.paste((245, 215, 40), (48, 48, 52, 52))
+    assert [label for label, _ in colors.dominant_colors(img, LABELS, min_share=0.05)] == ["green"]
+
+
+def test_labels_subset_only():
+    # метки, которых нет в списке, не выдаются — берётся ближайшая из разрешённых
+    assert colors.top_color(solid((120, 20, 35)), ["red", "white"])[0] == "red"
+
+
+def test_kmeans_k_larger_than_points():
+    x = np.array([[0, 0, 0], [50, 0, 0]], dtype=np.float32)
+    centers, labels = colors.weighted_kmeans(x, np.ones(2, dtype=np.float32), k=5)
+    assert len(centers) == 2
+    assert sorted(labels.tolist()) == [0, 1]
+
+
+def test_kmeans_identical_points_stop_early():
+    x = np.full((10, 3), 7.0, dtype=np.float32)
+    centers, labels = colors.weighted_kmeans(x, np.ones(10, dtype=np.float32), k=4)
+    assert len(centers) == 1
+    assert np.allclose(centers[0], 7.0)
+    assert (labels == 0).all()
+
+
+def test_kmeans_respects_weights():
+    x = np.array([[0, 0, 0]] * 5 + [[100, 0, 0]] * 5, dtype=np.float32)
+    w = np.array([1.0] * 5 + [0.0] * 5, dtype=np.float32)
+    centers, _ = colors.weighted_kmeans(x, w, k=1)
+    assert np.allclose(centers[0], 0.0)
+
+
+def test_accepts_arrays_and_grayscale():
+    arr = np.zeros((20, 30, 3), dtype=np.uint8)
+    assert colors.top_color(arr, LABELS)[0] == "black"
+    assert colors.top_color(Image.new("L", (20, 20), 255), LABELS)[0] == "white"
+
+
+def test_large_image_is_downsampled():
+    assert max(colors.sample_pixels(solid((0, 0, 0), (1000, 400))).shape[:2]) == colors.SAMPLE_SIDE
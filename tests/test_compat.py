@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+import compat
+
+
+def arr(*xs, dtype=np.float32):
+    return np.array(xs, dtype=dtype)
+
+
+def test_encode_decode_roundtrip():
+    ids, sims = arr(7, 3, 9, dtype=np.int32), arr(0.9, 0.5, -0.25)
+    blob = compat.encode(ids, sims)
+    assert len(blob) == 18
+    got_ids, got_sims = compat.decode(blob)
+    assert got_ids.dtype == np.int32 and got_sims.dtype == np.float32
+    np.testing.assert_array_equal(got_ids, ids)
+    np.testing.assert_allclose(got_sims, sims, atol=1e-3)
+    got_ids[0] = 1  # decode отдаёт свою копию, а не вид на bytes
+
+
+@pytest.mark.parametrize("blob", [None, b""])
+def test_decode_empty(blob):
+    ids, sims = compat.decode(blob)
+    assert len(ids) == 0 and len(sims) == 0
+
+
+def test_top_k_orders_and_clips():
+    sims, ids = arr(0.1, 0.9, 0.5, 0.7), arr(1, 2, 3, 4, dtype=np.int32)
+    got_ids, got_sims = compat.top_k(sims, ids, 2)
+    assert got_ids.tolist() == [2, 4]
+    np.testing.assert_allclose(got_sims, [0.9, 0.7])
+    assert compat.top_k(sims, ids, 10)[0].tolist() == [2, 4, 3, 1]
+
+
+@pytest.mark.parametrize("k", [0, -1])
+def test_top_k_nothing_to_return(k):
+    assert len(compat.top_k(arr(0.5), arr(1, dtype=np.int32), k)[0]) == 0
+    assert len(compat.top_k(arr(), arr(dtype=np.int32), 3)[0]) == 0
+
+
+def test_top_k_ties_are_stable():
+    assert compat.top_k(arr(0.5, 0.5, 0.5), arr(3, 1, 2, dtype=np.int32), 3)[0].tolist() == [3, 1, 2]
+
+
+def test_neighbours_of_skips_own_group_and_excluded():
+    ids = arr(1, 2, 3, 4, dtype=np.int32)
+    groups = np.array(["top", "top", "bottom", "shoes"])
+    sims = arr(1.0, 0.8, 0.6, 0.4)
+    out = compat.neighbours_of(sims, ids, groups, "top", k=5, exclude=4)
+    assert list(out) == ["bottom"]
+    assert out["bottom"][0].tolist() == [3]
+
+
+def test_build_matches_brute_force():
+    rng = np.random.default_rng(0)
+    mat = rng.normal(size=(9, 4)).astype(np.float32)
+    mat /= np.linalg.norm(mat, axis=1, keepdims=True)
+    ids = np.arange(100, 109, dtype=np.int32)
+    groups = np.array(["top", "bottom", "shoes"] * 3)
+    rows = list(compat.build(mat, ids, groups, k=2, block=4))
+    assert len(rows) == 9 * 2
+    for item_id, grp, nb_ids, nb_sims in rows:
+        i = int(item_id) - 100
+        assert grp != groups[i]
+        want = compat.neighbours_of(mat @ mat[i], ids, groups, str(groups[i]), k=2)[grp]
+        np.testing.assert_array_equal(nb_ids, want[0])
+        np.testing.assert_allclose(nb_sims, want[1], atol=1e-5)
+
+
+def test_build_single_group_yields_nothing():
+    mat = np.eye(3, dtype=np.float32)
+    assert list(compat.build(mat, arr(1, 2, 3, dtype=np.int32), np.array(["top"] * 3), k=2)) == []
+
+
+def test_insert_into_place_and_truncates():
+    ids, sims = arr(1, 2, 3, dtype=np.int32), arr(0.9, 0.6, 0.3)
+    got_ids, got_sims = compat.insert(ids, sims, 4, 0.7, k=3)
+    assert got_ids.tolist() == [1, 4, 2]
+    np.testing.assert_allclose(got_sims, [0.9, 0.7, 0.6])
+    assert compat.insert(ids, sims, 5, 0.3, k=3) is None
+    assert compat.insert(ids, sims, 5, 0.1, k=3) is None
+
+
+def test_insert_into_short_or_empty_list():
+    assert compat.insert(*compat.EMPTY, 8, -0.5, k=3)[0].tolist() == [8]
+    assert compat.insert(arr(1, dtype=np.int32), arr(0.9), 2, 0.95, k=3)[0].tolist() == [2, 1]
+    assert compat.insert(*compat.EMPTY, 8, 0.5, k=0) is None
+
+
+def test_duplicate_insert_moves_existing_id():
+    ids, sims = arr(1, 2, 3, dtype=np.int32), arr(0.9, 0.6, 0.3)
+    moved_ids, moved_sims = compat.insert(ids, sims, 3, 0.95, k=3)
+    assert moved_ids.tolist() == [3, 1, 2]
+    down_ids, down_sims = compat.insert(ids, sims, 1, 0.1, k=3)
+    assert down_ids.tolist() == [2, 3, 1]
+    np.testing.assert_allclose(down_sims, [0.6, 0.3, 0.1])
+    same_ids, _ = compat.insert(ids, sims, 2, 0.6, k=3)
+    assert same_ids.tolist() == [1, 2, 3]
+
+
+def test_contains_any():
+    ids = arr(1, 2, 3, dtype=np.int32)
+    assert compat.contains_any(ids, {3, 10})
+    assert not compat.contains_any(ids, [4])
+    assert not compat.contains_any(ids, [])
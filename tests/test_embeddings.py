@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+import embeddings
+
+
+@pytest.fixture
+def vec():
+    return np.random.default_rng(1).normal(size=512).astype(np.float32)
+
+
+@pytest.mark.parametrize("codec, size, atol", [("f32", 2049, 0), ("f16", 1025, 1e-2), ("int8", 517, 3e-2)])
+def test_roundtrip(vec, codec, size, atol):
+    blob = embeddings.encode(vec, codec)
+    assert len(blob) == size and len(blob) % 4
+    assert blob[0] == embeddings.CODECS[codec]
+    assert embeddings.dim_of(blob) == 512
+    np.testing.assert_allclose(embeddings.decode(blob), vec, atol=atol)
+
+
+def test_legacy_headerless_float32(vec):
+    legacy = vec.tobytes()
+    assert embeddings.dim_of(legacy) == 512
+    np.testing.assert_array_equal(embeddings.decode(legacy), vec)
+
+
+def test_matrix_mixes_legacy_and_headers(vec):
+    blobs = [vec.tobytes(), embeddings.encode(vec, "f16"), embeddings.encode(vec, "int8"), embeddings.encode(vec, "f32")]
+    mat = embeddings.decode_matrix(blobs)
+    assert mat.shape == (4, 512) and mat.dtype == np.float32
+    for row in mat:
+        np.testing.assert_allclose(row, vec, atol=3e-2)
+
+
+def test_decode_matrix_into_existing_buffer(vec):
+    out = np.zeros((2, 512), dtype=np.float32)
+    assert embeddings.decode_matrix([vec.tobytes(), embeddings.encode(vec)], out=out) is out
+    np.testing.assert_allclose(out[1], vec, atol=1e-2)
+
+
+def test_empty_inputs():
+    assert embeddings.decode(None) is None
+    assert embeddings.decode_matrix([]).shape == (0, 0)
+    zero = embeddings.encode(np.zeros(8, dtype=np.float32), "int8")
+    np.testing.assert_array_equal(embeddings.decode(zero), np.zeros(8))
+
+
+def test_length_clash_with_legacy_format_rejected():
+    # 1 + 4*D и 1 + 2*D всегда нечётны, а 5 + D у int8 кратно 4 при D ≡ 3 (mod 4)
+    with pytest.raises(ValueError, match="legacy"):
+        embeddings.encode(np.ones(3, dtype=np.float32), "int8")
+
+
+def test_unknown_codec_byte():
+    with pytest.raises(ValueError, match="codec 0x07"):
+        embeddings.decode(bytes((7,)) + b"\x00" * 4)
+    with pytest.raises(KeyError):
+        embeddings.encode(np.ones(4), "bf16")
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import pytest
+
+from loopwatch import BlockingDetected, LoopWatchdog, watch_blocking
+
+
+def test_watch_blocking_fails_on_blocked_loop():
+    async def scenario():
+        async with watch_blocking(50):
+            await asyncio.sleep(0.02)
+            time.sleep(0.2)  # синхронный вызов держит цикл
+    with pytest.raises(BlockingDetected) as err:
+        asyncio.run(scenario())
+    assert "limit 50ms" in str(err.value)
+    assert "time.sleep(0.2)" in str(err.value)  # стек снят во время блокировки
+
+
+def test_watch_blocking_passes_clean_run():
+    async def scenario():
+        async with watch_blocking(100) as wd:
+            for _ in range(5):
+                await asyncio.sleep(0.01)
+            await asyncio.to_thread(time.sleep, 0.2)  # работа вне цикла его не блокирует
+        return wd
+    wd = asyncio.run(scenario())
+    assert wd.violations == []
+    assert wd.samples
+
+
+def test_watchdog_counts_stalls_and_percentiles():
+    logs = []
+
+    async def scenario():
+        wd = LoopWatchdog(interval=0.01, threshold_ms=50, log=logs.append).start()
+        await asyncio.sleep(0.03)
+        time.sleep(0.12)
+        await asyncio.sleep(0.03)
+        await wd.stop()
+        return wd
+    wd = asyncio.run(scenario())
+    assert wd.stalls == 1 and wd.violations == []
+    assert wd.percentiles()["max"] >= 0.1
+    assert any("blocked for" in line for line in logs)
+    wd.raise_if_blocked()  # без strict_ms нарушений не бывает
+
+
+def test_percentiles_empty():
+    assert LoopWatchdog().percentiles() == {"0.5": 0.0, "0.9": 0.0, "0.99": 0.0, "max": 0.0}
@@ -0,0 +1,78 @@
+import os
+
+from photo_cache import PhotoCache
+
+
+def read(cache, key):
+    buf = cache.get(key)
+    if buf is None:
+        return None
+    with buf:
+        return bytes(buf)
+
+
+def test_put_get_and_miss(tmp_path):
+    cache = PhotoCache(str(tmp_path), max_bytes=1000)
+    assert cache.get("nope") is None
+    cache.put("a", b"jpeg-a")
+    assert read(cache, "a") == b"jpeg-a"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache) == 1 and cache.total_bytes == 6
+
+
+def test_evicts_least_recently_read_within_budget(tmp_path):
+    cache = PhotoCache(str(tmp_path), max_bytes=250)
+    for key in "abc":
+        cache.put(key, key.encode() * 80)
+    read(cache, "a")  # «a» читали последней — вытесняется «b»
+    cache.put("d", b"d" * 80)
+    assert cache.total_bytes == 240 <= cache.max_bytes
+    assert read(cache, "b") is None
+    assert [read(cache, k) is not None for k in "acd"] == [True, True, True]
+    assert not os.path.exists(cache._path("b"))
+
+
+def test_too_large_and_empty_key_not_stored(tmp_path):
+    cache = PhotoCache(str(tmp_path), max_bytes=10)
+    cache.put("big", b"x" * 11)
+    cache.put("", b"x")
+    assert len(cache) == 0 and cache.total_bytes == 0
+
+
+def test_replace_same_key_keeps_byte_count(tmp_path):
+    cache = PhotoCache(str(tmp_path), max_bytes=100)
+    cache.put("a", b"x" * 40)
+    cache.put("a", b"y" * 10)
+    assert cache.total_bytes == 10 and read(cache, "a") == b"y" * 10
+
+
+def test_restart_restores_lru_order_and_drops_temp_files(tmp_path):
+    cache = PhotoCache(str(tmp_path), max_bytes=1000)
+    for i, key in enumerate("abc"):
+        cache.put(key, b"z" * 100)
+        os.utime(cache._path(key), ns=(i * 10**9, i * 10**9))
+    stray = os.path.join(os.path.dirname(cache._path("a")), ".tmpdead")
+    open(stray, "wb").close()
+    os.utime(cache._path("a"), ns=(5 * 10**9, 5 * 10**9))  # «a» читали позже всех
+    reopened = PhotoCache(str(tmp_path), max_bytes=250)  # бюджет меньше — при старте вытесняется самая давняя
+    assert len(reopened) == 2 and reopened.total_bytes == 200
+    assert read(reopened, "b") is None and read(reopened, "a") is not None
+    assert not os.path.exists(stray)
+
+
+def test_file_removed_outside_is_a_miss(tmp_path):
+    cache = PhotoCache(str(tmp_path), max_bytes=100)
+    cache.put("a", b"x" * 10)
+    os.unlink(cache._path("a"))
+    assert cache.get("a") is None
+    assert len(cache) == 0 and cache.total_bytes == 0
+
+
+def test_hit_survives_utime_failure(tmp_path, monkeypatch):
+    cache = PhotoCache(str(tmp_path), max_bytes=100)
+    cache.put("a", b"x" * 10)
+
+    def readonly(*a, **k):
+        raise PermissionError("read-only file system")
+    monkeypatch.setattr(os, "utime", readonly)
+    assert read(cache, "a") == b"x" * 10
@@ -0,0 +1,89 @@
+"""Тесты с needs_pg идут на живом Postgres: TEST_DATABASE_URL=postgres://... (каждый — во временной схеме)."""
+import asyncio
+import contextlib
+import os
+import uuid
+
+import asyncpg
+import numpy as np
+import pytest
+
+import embeddings
+import repository
+
+DSN = os.getenv("TEST_DATABASE_URL")
+needs_pg = pytest.mark.skipif(not DSN, reason="TEST_DATABASE_URL не задан")
+
+
+@contextlib.asynccontextmanager
+async def scratch_repo(**kwargs):
+    schema = f"wb_test_{uuid.uuid4().hex[:8]}"
+    admin = await asyncpg.connect(DSN)
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    pool = await asyncpg.create_pool(DSN, min_size=1, max_size=kwargs.pop("max_size", 2),
+                                     statement_cache_size=repository.STATEMENT_CACHE_SIZE,
+                                     server_settings={"search_path": schema})
+    try:
+        yield repository.Repository(pool, **kwargs)
+    finally:
+        await pool.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+@needs_pg
+def test_legacy_rows_are_tagged_with_the_legacy_model():
+    wardrobe_ddl = next(ddl for ddl in repository.MIGRATIONS if "CREATE TABLE IF NOT EXISTS wardrobe" in ddl)
+    vec = np.linspace(-1, 1, 512).astype(np.float32)
+
+    async def scenario():
+        async with scratch_repo() as repo:
+            # база до появления emb_model: эмбеддинг — голый float32 без заголовка
+            async with repo.session() as db:
+                await db.conn.execute(wardrobe_ddl)
+                await db.conn.execute(
+                    "INSERT INTO wardrobe (user_id, file_id, emb, name, category_en, color_en) VALUES "
+                    "(1, 'f1', $1, 'Худи', 'hoodie', 'gray'), (1, 'f2', NULL, 'Кеды', 'sneakers', 'white')",
+                    vec.tobytes())
+            await repo.migrate()
+            await repo.migrate()  # миграции идут на каждом старте
+            rows = await repo.fetch("label_index_rows", 1, repository.LEGACY_EMB_MODEL)
+            assert [r["name"] for r in rows] == ["Худи"]
+            np.testing.assert_allclose(embeddings.decode_matrix([rows[0]["emb"]])[0], vec)
+            # без эмбеддинга строка остаётся NULL — её посчитает reembed_worker
+            stale = await repo.fetch("reembed_next_batch", 0, repository.LEGACY_EMB_MODEL, 10)
+            assert [r["file_id"] for r in stale] == ["f2"]
+    asyncio.run(scenario())
+
+
+@needs_pg
+def test_statements_survive_pool_release_and_schema_change():
+    async def scenario():
+        async with scratch_repo(max_size=1) as repo:
+            await repo.migrate()
+            # одно соединение в пуле: каждый вызов — новая выдача того же соединения
+            for _ in range(3):
+                await repo.execute("item_insert", 1, "f", None, None, "Худи", "gray", "серый", "hoodie", "худи",
+                                   None, "", None)
+                assert await repo.fetchval("wardrobe_count", 1) >= 1
+            assert await repo.fetch("label_index_rows", 1, "m") == []
+            # тип колонки результата поменялся — закэшированный план недействителен, запрос готовится заново
+            async with repo.session() as db:
+                await db.conn.execute("ALTER TABLE wardrobe ALTER COLUMN name TYPE VARCHAR(200)")
+            assert await repo.fetch("label_index_rows", 1, "m") == []
+            assert await repo.fetchval("wardrobe_count", 1) == 3
+    asyncio.run(scenario())
+
+
+@needs_pg
+def test_unknown_timeouts_are_ignored(capsys):
+    async def scenario():
+        async with scratch_repo(timeouts={"search": 3, "capsule_candidates": 1.5}) as repo:
+            assert repo.timeouts == {"search": 3}
+    asyncio.run(scenario())
+    assert "capsule_candidates" in capsys.readouterr().out
+
+
+def test_parse_timeouts():
+    assert repository.parse_timeouts("search=3, capsule_items=1.5,") == {"search": 3.0, "capsule_items": 1.5}
+    assert repository.parse_timeouts("") == {}
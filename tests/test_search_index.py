@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import search_index
+from search_index import TextIndex, fold, stem, trigrams
+
+T0 = datetime(2024, 1, 1)
+
+
+def sample() -> TextIndex:
+    index = TextIndex()
+    index.add(1, T0, "Платье", "Красный", "летнее, в горошек")
+    index.add(2, T0 + timedelta(days=1), "Джинсы", "Синий", None, "офис")
+    index.add(3, T0 + timedelta(days=2), "Футболка", "Красная", "хлопок", "лето")
+    index.add(4, None, "Ёлочная брошь", None, None)
+    return index
+
+
+def test_helpers():
+    assert fold("ЁЖИК") == "ежик"
+    assert fold(None) == ""
+    assert trigrams("ab") == set()
+    assert trigrams("плат") == {"пла", "лат"}
+    assert stem("красная") == "красн"
+    assert stem("синий") == "син"
+    assert stem("мой") == "мой"  # основа короче 3 символов — не режем
+
+
+def test_empty_index():
+    index = TextIndex()
+    assert len(index) == 0
+    assert index.search("") == []
+    assert index.search("платье") == []
+    assert index.search("к") == []
+
+
+def test_empty_query_returns_all_newest_first():
+    index = sample()
+    assert index.search("") == [3, 2, 1, 4]
+    assert index.search("  ,. ", limit=2) == [3, 2]
+
+
+def test_substring_and_stem():
+    index = sample()
+    assert index.search("плат") == [1]
+    assert index.search("красная") == [3, 1]
+    assert index.search("КРАСНЫЙ") == [3, 1]
+    assert index.search("горош") == [1]
+    assert index.search("елоч") == [4]
+
+
+def test_short_words_are_prefixes():
+    index = sample()
+    assert index.search("д") == [2]
+    assert index.search("ло") == []  # «хлопок» содержит «ло», но не начинается с него
+    assert index.search("ле") == [3, 1]
+
+
+def test_words_are_anded():
+    index = sample()
+    assert index.search("красн хлоп") == [3]
+    assert index.search("красн офис") == []
+    assert index.search("красн", limit=1) == [3]
+
+
+def test_missing_trigram_finds_nothing():
+    assert sample().search("шуба") == []
+
+
+def test_duplicate_add_replaces_text():
+    index = sample()
+    index.add(1, T0, "Юбка", "Зелёный")
+    assert len(index) == 4
+    assert index.search("плат") == []
+    assert index.search("п") == []
+    assert index.search("юбк") == [1]
+    assert index.search("з") == [1]
+    assert index.search("") == [3, 2, 1, 4]
+
+
+def test_add_after_search_resorts():
+    index = sample()
+    assert index.search("д") == [2]
+    index.add(5, T0 + timedelta(days=3), "Джемпер")
+    assert index.search("д") == [5, 2]
+    assert index.search("")[0] == 5
+
+
+def test_build_from_rows():
+    rows = [
+        {"id": 7, "created_at": T0, "name": "Кеды", "color_ru": "Белый", "description": None, "tags": ["спорт"]},
+        {"id": 8, "created_at": T0 + timedelta(hours=1), "name": "Кепка", "color_ru": None, "description": "", "tags": None},
+    ]
+    index = search_index.build(rows)
+    assert index.search("ке") == [8, 7]
+    assert index.search("спорт") == [7]
+
+
+@pytest.mark.parametrize("query", ["красн плат", "плат красн"])
+def test_word_order_does_not_matter(query):
+    assert sample().search(query) == [1]
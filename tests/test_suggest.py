@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from suggest import LabelIndex, blend
+
+
+def unit(*xs):
+    return np.array(xs, dtype=np.float32)
+
+
+def test_empty_index():
+    index = LabelIndex()
+    assert len(index) == 0
+    assert index.neighbours(unit(1, 0)) == []
+    assert index.nearest(unit(1, 0)) == []
+    assert index.vote(unit(1, 0), "color_en") == ({}, 0.0)
+    assert index.items() == ([], [])
+    assert index.vectors([]).shape == (0, 0)
+
+
+def test_dim_from_first_record_and_mismatch():
+    index = LabelIndex()
+    index.add(1, unit(3, 4), color_en="red")
+    assert index.dim == 2
+    with pytest.raises(ValueError):
+        index.add(2, unit(1, 0, 0))
+
+
+def test_zero_vector_ignored():
+    index = LabelIndex(dim=2)
+    index.add(1, unit(0, 0), color_en="red")
+    assert 1 not in index and index.version == 0
+
+
+def test_duplicate_add_replaces_labels_and_vector():
+    index = LabelIndex(dim=2)
+    index.add(1, unit(1, 0), color_en="red", name="")
+    index.add(1, unit(0, 1), color_en="blue")
+    assert len(index) == 1
+    assert index.items() == ([1], [{"color_en": "blue"}])
+    assert index.neighbours(unit(0, 1), k=1)[0][0] == pytest.approx(1.0)
+
+
+def test_capacity_grows():
+    index = LabelIndex(dim=2, capacity=2)
+    for i in range(5):
+        index.add(i, unit(1, i))
+    assert len(index) == 5
+    assert index.nearest(unit(1, 4), k=1)[0][1] == 4
+
+
+def test_remove_moves_last_row():
+    index = LabelIndex(dim=2)
+    index.add("a", unit(1, 0), color_en="red")
+    index.add("b", unit(0, 1), color_en="blue")
+    index.add("c", unit(-1, 0), color_en="black")
+    index.remove("a")
+    index.remove("missing")
+    assert "a" not in index and len(index) == 2
+    assert index.nearest(unit(-1, 0), k=1)[0][1:] == ("c", {"color_en": "black"})
+    np.testing.assert_allclose(index.vectors(["c", "b"]), [[-1, 0], [0, 1]])
+
+
+def test_update_sets_and_clears_fields():
+    index = LabelIndex(dim=2)
+    index.add(1, unit(1, 0), name="Худи", color_en="gray")
+    version = index.version
+    index.update(1, color_en="black", name=None, other="x")
+    index.update(2, color_en="red")
+    assert index.items()[1] == [{"color_en": "black"}]
+    assert index.version == version + 1
+
+
+def test_neighbours_k_larger_than_n():
+    index = LabelIndex(dim=2)
+    index.add(1, unit(1, 0))
+    index.add(2, unit(1, 1))
+    found = index.neighbours(unit(1, 0), k=10)
+    assert [row for _, row in found] == [0, 1]
+    assert found[0][0] > found[1][0]
+
+
+def test_nearest_where_and_min_sim():
+    index = LabelIndex(dim=2)
+    index.add(1, unit(1, 0))
+    index.add("fb", unit(1, 0.01))
+    index.add(3, unit(0, 1))
+    found = index.nearest(unit(1, 0), min_sim=0.5, where=lambda key: isinstance(key, int))
+    assert [key for _, key, _ in found] == [1]
+
+
+def test_similarity_in_key_order():
+    index = LabelIndex(dim=2)
+    index.add(1, unit(1, 0))
+    index.add(2, unit(0, 1))
+    np.testing.assert_allclose(index.similarity(unit(0, 2), [2, 1]), [1, 0], atol=1e-6)
+    assert index.similarity(unit(0, 1), []).shape == (0,)
+
+
+def test_vote_weights_by_cosine_and_skips_far_or_unlabelled():
+    index = LabelIndex(dim=2)
+    index.add(1, unit(1, 0), color_en="gray")
+    index.add(2, unit(1, 0.1), color_en="black")
+    index.add(3, unit(1, 0.05))
+    index.add(4, unit(0, 1), color_en="red")
+    votes, best = index.vote(unit(1, 0), "color_en", k=4, min_sim=0.8)
+    assert set(votes) == {"gray", "black"}
+    assert sum(votes.values()) == pytest.approx(1.0)
+    assert votes["gray"] > votes["black"]
+    assert best == pytest.approx(1.0)
+
+
+def test_blend_alpha():
+    zero_shot = {"red": 0.6, "blue": 0.4}
+    votes = {"blue": 1.0}
+    assert blend(zero_shot, votes, 0.5) == [("red", 0.6), ("blue", 0.4)]
+    assert blend(zero_shot, {}, 0.99) == [("red", 0.6), ("blue", 0.4)]
+    assert blend(zero_shot, votes, 0.92) == [("blue", 1.0), ("red", 0.0)]
+    half = dict(blend(zero_shot, votes, 0.86))
+    assert half["red"] == pytest.approx(0.3)
+    assert half["blue"] == pytest.approx(0.7)
+
+
+def test_blend_adds_labels_missing_from_zero_shot():
+    ranked = blend({"red": 1.0}, {"burgundy": 1.0}, 0.95)
+    assert ranked[0] == ("burgundy", 1.0)
@@ -0,0 +1,145 @@
+import asyncio
+from datetime import datetime
+
+from aiogram.types import CallbackQuery, Chat, InlineQuery, Message, Update, User
+
+from userlanes import UserLanes
+
+
+def user(uid):
+    return User(id=uid, is_bot=False, first_name="u")
+
+
+def message(uid, text="hi", message_id=1):
+    msg = Message(message_id=message_id, date=datetime(2024, 1, 1), chat=Chat(id=uid, type="private"),
+                  from_user=user(uid), text=text)
+    return Update(update_id=message_id, message=msg)
+
+
+def callback(uid, data, message_id=10, cq_id="1"):
+    msg = Message(message_id=message_id, date=datetime(2024, 1, 1), chat=Chat(id=uid, type="private"), text="menu")
+    return Update(update_id=100 + int(cq_id), callback_query=CallbackQuery(
+        id=cq_id, from_user=user(uid), chat_instance="c", message=msg, data=data))
+
+
+class FakeBot:
+    def __init__(self):
+        self.answered = []
+
+    async def answer_callback_query(self, callback_query_id, text=None):
+        self.answered.append((callback_query_id, text))
+
+
+def recorder(log, gates=None):
+    async def handler(event, data):
+        name = event.event_type
+        log.append(("start", event.update_id))
+        if gates is not None:
+            await gates[event.update_id].wait()
+        log.append(("end", event.update_id))
+        return name
+    return handler
+
+
+def test_same_user_is_serialized():
+    async def scenario():
+        log, lanes = [], UserLanes()
+        gates = {1: asyncio.Event(), 2: asyncio.Event()}
+        handler = recorder(log, gates)
+        first = asyncio.create_task(lanes(handler, message(7, message_id=1), {}))
+        second = asyncio.create_task(lanes(handler, message(7, message_id=2), {}))
+        await asyncio.sleep(0)
+        assert log == [("start", 1)] and len(lanes) == 1
+        gates[2].set()
+        await asyncio.sleep(0)
+        assert log == [("start", 1)]
+        gates[1].set()
+        assert await asyncio.gather(first, second) == ["message", "message"]
+        assert log == [("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+        assert len(lanes) == 0
+    asyncio.run(scenario())
+
+
+def test_different_users_run_in_parallel():
+    async def scenario():
+        log, waits = [], []
+        lanes = UserLanes(on_wait=waits.append)
+        gates = {1: asyncio.Event(), 2: asyncio.Event()}
+        handler = recorder(log, gates)
+        tasks = [asyncio.create_task(lanes(handler, message(uid, message_id=uid), {})) for uid in (1, 2)]
+        await asyncio.sleep(0)
+        assert log == [("start", 1), ("start", 2)] and len(lanes) == 2
+        for gate in gates.values():
+            gate.set()
+        await asyncio.gather(*tasks)
+        assert len(waits) == 2 and len(lanes) == 0
+    asyncio.run(scenario())
+
+
+def test_repeated_callback_key_is_coalesced():
+    async def scenario():
+        log, coalesced, bot = [], [], FakeBot()
+        lanes = UserLanes(busy_text="Подождите…", on_coalesced=lambda: coalesced.append(1))
+        gates = {101: asyncio.Event(), 103: asyncio.Event(), 104: asyncio.Event()}
+        handler = recorder(log, gates)
+        data = {"bot": bot}
+        first = asyncio.create_task(lanes(handler, callback(5, "open:1", cq_id="1"), data))
+        await asyncio.sleep(0)
+        assert await lanes(handler, callback(5, "open:1", cq_id="2"), data) is None
+        other_button = asyncio.create_task(lanes(handler, callback(5, "open:2", cq_id="3"), data))
+        other_message = asyncio.create_task(lanes(handler, callback(5, "open:1", message_id=11, cq_id="4"), data))
+        await asyncio.sleep(0)
+        assert bot.answered == [("2", "Подождите…")] and coalesced == [1]
+        for gate in gates.values():
+            gate.set()
+        await asyncio.gather(first, other_button, other_message)
+        assert [u for kind, u in log if kind == "start"] == [101, 103, 104]
+        # первое нажатие отработало — то же нажатие снова запускает обработчик
+        gates[105] = asyncio.Event()
+        gates[105].set()
+        assert await lanes(handler, callback(5, "open:1", cq_id="5"), data) == "callback_query"
+        assert len(lanes) == 0
+    asyncio.run(scenario())
+
+
+def test_coalesced_answer_errors_are_swallowed():
+    class BrokenBot:
+        async def answer_callback_query(self, *a, **k):
+            raise RuntimeError("query is too old")
+
+    async def scenario():
+        lanes, gate = UserLanes(), asyncio.Event()
+        first = asyncio.create_task(lanes(recorder([], {101: gate}), callback(5, "x", cq_id="1"), {"bot": BrokenBot()}))
+        await asyncio.sleep(0)
+        assert await lanes(recorder([]), callback(5, "x", cq_id="2"), {"bot": BrokenBot()}) is None
+        gate.set()
+        await first
+    asyncio.run(scenario())
+
+
+def test_handler_error_releases_lane():
+    async def boom(event, data):
+        raise ValueError("boom")
+
+    async def scenario():
+        lanes = UserLanes()
+        try:
+            await lanes(boom, callback(5, "x"), {"bot": FakeBot()})
+        except ValueError:
+            pass
+        assert len(lanes) == 0
+        assert await lanes(recorder([]), callback(5, "x"), {"bot": FakeBot()}) == "callback_query"
+    asyncio.run(scenario())
+
+
+def test_inline_queries_pass_through():
+    async def scenario():
+        lanes, log, gate = UserLanes(), [], asyncio.Event()
+        held = asyncio.create_task(lanes(recorder(log, {1: gate}), message(5, message_id=1), {}))
+        await asyncio.sleep(0)
+        inline = Update(update_id=2, inline_query=InlineQuery(id="q", from_user=user(5), query="пла", offset=""))
+        assert await lanes(recorder(log), inline, {}) == "inline_query"
+        assert log == [("start", 1), ("start", 2), ("end", 2)]
+        gate.set()
+        await held
+    asyncio.run(scenario())
@@ -0,0 +1,150 @@
+"""
+Трассировка апдейтов: span на каждый апдейт и дочерние отрезки (БД, CLIP, Bot API), из которых он состоит.
+
+Span живёт в contextvar, поэтому всё, что выполняется в задаче обработчика, попадает в текущий span через
+add_child()/child(): время запросов — из repository.Session._run, Bot API — из middleware сессии бота, CLIP — из af.py.
+Апдейт дольше порога печатается с разбивкой по видам:
+
+    [slow] update 1234 callback:view_item user=42 812.4ms — db 3×120.1ms, clip 1×501.7ms, api 2×150.3ms, прочее 40.3ms
+
+Профилирование: с вероятностью profile_rate апдейт выполняется под cProfile; если он оказался медленным,
+в лог пишутся топ-функции, а при заданном profile_dir — сохраняется .prof. Профиль одновременно один;
+в асинхронном коде в него попадает и то, что успело выполниться в других задачах за время апдейта.
+"""
+import cProfile
+import io
+import os
+import pstats
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("update_id", "event", "name", "user_id", "t0", "elapsed", "children")
+
+    def __init__(self, update_id: int, event: str, user_id: Optional[int] = None):
+        self.update_id = update_id
+        self.event = event
+        self.name = ""
+        self.user_id = user_id
+        self.t0 = time.perf_counter()
+        self.elapsed = 0.0
+        self.children: List[Tuple[str, str, float]] = []
+
+    def add(self, kind: str, name: str, seconds: float):
+        self.children.append((kind, name, seconds))
+
+    def breakdown(self) -> Dict[str, Tuple[int, float]]:
+        """kind -> (число вызовов, суммарное время)."""
+        out: Dict[str, Tuple[int, float]] = {}
+        for kind, _, sec in self.children:
+            n, total = out.get(kind, (0, 0.0))
+            out[kind] = (n + 1, total + sec)
+        return out
+
+    def format(self) -> str:
+        parts = [f"{kind} {n}×{total * 1000:.1f}ms" for kind, (n, total) in sorted(self.breakdown().items())]
+        # дочерние отрезки могут идти параллельно (gather), поэтому «прочее» не уходит ниже нуля
+        other = max(0.0, self.elapsed - sum(sec for _, _, sec in self.children))
+        parts.append(f"прочее {other * 1000:.1f}ms")
+        label = f"{self.event}:{self.name}" if self.name else self.event
+        return f"update {self.update_id} {label} user={self.user_id} {self.elapsed * 1000:.1f}ms — " + ", ".join(parts)
+
+    def slowest(self, limit: int = 5) -> List[Tuple[str, str, float]]:
+        return sorted(self.children, key=lambda c: c[2], reverse=True)[:limit]
+
+
+def add_child(kind: str, name: str, seconds: float):
+    span = current_span.get()
+    if span is not None:
+        span.add(kind, name, seconds)
+
+
+def set_name(name: str):
+    """Имя обработчика, который в итоге обработал апдейт (внешний middleware его ещё не знает)."""
+    span = current_span.get()
+    if span is not None:
+        span.name = name
+
+
+@contextmanager
+def child(kind: str, name: str, observe: Optional[Callable[[float], None]] = None):
+    """Меряет блок: добавляет отрезок в текущий span и, если задано, отдаёт время в метрику."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        sec = time.perf_counter() - t0
+        add_child(kind, name, sec)
+        if observe is not None:
+            observe(sec)
+
+
+def _describe(update: Update) -> Tuple[str, Optional[int]]:
+    event_type = update.event_type
+    event = update.event
+    user = getattr(event, "from_user", None)
+    return event_type, (user.id if user else None)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: открывает span, по завершении логирует медленные апдейты."""
+
+    def __init__(self, slow_ms: float = 1000.0, profile_rate: float = 0.0, profile_dir: Optional[str] = None,
+                 profile_top: int = 25, log: Callable[[str], None] = print,
+                 on_finish: Optional[Callable[[Span], None]] = None):
+        self.slow_ms = slow_ms
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.profile_top = profile_top
+        self.log = log
+        self.on_finish = on_finish
+        self._profiling = False
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        kind, user_id = _describe(event)
+        span = Span(event.update_id, kind, user_id)
+        token = current_span.set(span)
+        profiler = None
+        if self.profile_rate and not self._profiling and random.random() < self.profile_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self._profiling = True
+            except ValueError:  # уже работает другой профилировщик
+                profiler = None
+        try:
+            return await handler(event, data)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+            span.elapsed = time.perf_counter() - span.t0
+            current_span.reset(token)
+            if self.on_finish is not None:
+                self.on_finish(span)
+            if span.elapsed * 1000 >= self.slow_ms:
+                self._report(span, profiler)
+
+    def _report(self, span: Span, profiler: Optional[cProfile.Profile]):
+        self.log("[slow] " + span.format())
+        for kind, name, sec in span.slowest():
+            self.log(f"[slow]    {kind:<5} {sec * 1000:8.1f}ms  {name}")
+        if profiler is None:
+            return
+        buf = io.StringIO()
+        pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(self.profile_top)
+        self.log(f"[slow] cProfile update {span.update_id}:\n{buf.getvalue()}")
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            name = f"{span.name or span.event}-{span.update_id}-{int(span.elapsed * 1000)}ms.prof"
+            profiler.dump_stats(os.path.join(self.profile_dir, name))
@@ -0,0 +1,84 @@
+"""
+Апдейты одного пользователя — по очереди: внешний middleware на dp.update держит для каждого пользователя
+«полосу» (asyncio.Lock, ожидающие проходят в порядке прихода), обработчики разных пользователей идут параллельно.
+Так два быстрых нажатия не гоняются за pending_capsule / last_menu_message одного пользователя.
+
+Повторное нажатие той же кнопки в том же сообщении, пока первое ещё ждёт очереди или выполняется, не запускает
+обработчик второй раз: на callback сразу отвечают (чтобы у кнопки пропали «часики»), апдейт отбрасывается.
+
+    dp.update.outer_middleware(UserLanes(on_wait=WAIT.observe, on_coalesced=COALESCED.inc))
+
+Полоса существует, пока в ней есть апдейты, — число полос равно числу пользователей с апдейтами в работе.
+Inline-запросы только читают данные и приходят на каждое нажатие клавиши — их полосы не задерживают.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+CallbackKey = Tuple[Optional[str], Optional[int]]
+
+
+class _Lane:
+    __slots__ = ("lock", "updates", "callbacks")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.updates = 0  # ждут и выполняются
+        self.callbacks: Set[CallbackKey] = set()  # (data, message_id) нажатий, которые ждут или выполняются
+
+
+class UserLanes(BaseMiddleware):
+    def __init__(self, kinds: Tuple[str, ...] = ("message", "callback_query"),
+                 busy_text: Optional[str] = None,
+                 on_wait: Optional[Callable[[float], None]] = None,
+                 on_coalesced: Optional[Callable[[], None]] = None):
+        self.kinds = kinds
+        self.busy_text = busy_text
+        self.on_wait = on_wait
+        self.on_coalesced = on_coalesced
+        self._lanes: Dict[int, _Lane] = {}
+
+    def __len__(self) -> int:
+        return len(self._lanes)
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        if event.event_type not in self.kinds:
+            return await handler(event, data)
+        user = getattr(event.event, "from_user", None)
+        if user is None:
+            return await handler(event, data)
+        lane = self._lanes.get(user.id)
+        if lane is None:
+            lane = self._lanes[user.id] = _Lane()
+
+        key: Optional[CallbackKey] = None
+        if event.event_type == "callback_query":
+            cq = event.callback_query
+            key = (cq.data, cq.message.message_id if cq.message else None)
+            if key in lane.callbacks:
+                if self.on_coalesced is not None:
+                    self.on_coalesced()
+                try:
+                    await data["bot"].answer_callback_query(cq.id, text=self.busy_text)
+                except Exception:
+                    pass
+                return None
+            lane.callbacks.add(key)
+
+        lane.updates += 1
+        t0 = time.perf_counter()
+        try:
+            async with lane.lock:
+                if self.on_wait is not None:
+                    self.on_wait(time.perf_counter() - t0)
+                return await handler(event, data)
+        finally:
+            lane.updates -= 1
+            if key is not None:
+                lane.callbacks.discard(key)
+            if lane.updates == 0 and self._lanes.get(user.id) is lane:
+                del self._lanes[user.id]
@@ -0,0 +1,212 @@
+"""
+Экспорт и импорт гардероба пользователя (вещи, теги, капсулы) — для бэкапа и переноса между базами.
+
+Формат каталога <out>/<user_id>/:
+    manifest.json     — версия формата, user_id, счётчики, размерность эмбеддингов
+    wardrobe.jsonl    — по строке на вещь (вместе с тегами); emb_row — номер строки в embeddings.npy или null
+    capsules.jsonl    — по строке на капсулу
+    embeddings.npy    — все эмбеддинги пользователя одним массивом float32 (N, dim), независимо от формата хранения в БД
+
+Экспорт читает строки серверным курсором в одном снимке (REPEATABLE READ) и пишет их по мере поступления,
+не держа гардероб в памяти. Импорт грузит через COPY пачками и выполняется одной транзакцией;
+id вещей выделяются заново из последовательности, ссылки тегов и капсул переводятся на новые id.
+
+    DATABASE_URL=... python wardrobe_transfer.py export --user 123 --out backups/
+    DATABASE_URL=... python wardrobe_transfer.py import --src backups/123 [--as-user 456]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+import numpy as np
+
+import embeddings
+import repository
+
+FORMAT_VERSION = 1
+CURSOR_PREFETCH = 500
+IMPORT_CHUNK = 1000
+
+WARDROBE_EXPORT_SQL = """
+    SELECT w.id, w.file_id, w.emb, w.emb_model, w.name, w.color_en, w.color_ru, w.category_en, w.category_ru,
+           w.created_at, w.description, COALESCE(t.tags, '{}') AS tags
+    FROM wardrobe w
+    LEFT JOIN LATERAL (SELECT array_agg(tag ORDER BY id) AS tags FROM tags WHERE item_id = w.id) t ON true
+    WHERE w.user_id = $1
+    ORDER BY w.id
+"""
+
+CAPSULES_EXPORT_SQL = """
+    SELECT id, name, item_ids, thumbnail_file_id, thumbnail_item_ids, created_at, description
+    FROM capsules WHERE user_id = $1 ORDER BY id
+"""
+
+WARDROBE_COLUMNS = ["id", "user_id", "file_id", "emb", "emb_model", "name", "color_en", "color_ru",
+                    "category_en", "category_ru", "created_at", "description"]
+
+
+def _iso(dt: Optional[datetime]) -> Optional[str]:
+    return dt.isoformat() if dt else None
+
+
+def _parse_dt(s: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(s) if s else None
+
+
+def _write_npy(raw_path: str, out_path: str, rows: int, dim: int):
+    """Дописывает заголовок .npy перед уже записанными подряд float32-строками (без загрузки в память)."""
+    with open(out_path, "wb") as out, open(raw_path, "rb") as raw:
+        np.lib.format.write_array_header_1_0(out, {"descr": "<f4", "fortran_order": False, "shape": (rows, dim)})
+        shutil.copyfileobj(raw, out, 1 << 20)
+
+
+async def export_user(conn: asyncpg.Connection, user_id: int, out_dir: str) -> Dict[str, Any]:
+    target = os.path.join(out_dir, str(user_id))
+    os.makedirs(target, exist_ok=True)
+    items = tags = capsules = emb_rows = 0
+    dim = 0
+    fd, raw_path = tempfile.mkstemp(prefix="emb-", suffix=".f32", dir=target)
+    try:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            with os.fdopen(fd, "wb") as raw, open(os.path.join(target, "wardrobe.jsonl"), "w", encoding="utf-8") as wf:
+                async for r in conn.cursor(WARDROBE_EXPORT_SQL, user_id, prefetch=CURSOR_PREFETCH):
+                    vec = embeddings.decode(r["emb"])
+                    emb_row = None
+                    if vec is not None:
+                        if dim and vec.shape[0] != dim:
+                            raise RuntimeError(f"item {r['id']}: embedding dim {vec.shape[0]} != {dim}")
+                        dim = vec.shape[0]
+                        raw.write(vec.astype("<f4", copy=False).tobytes())
+                        emb_row = emb_rows
+                        emb_rows += 1
+                    wf.write(json.dumps({
+                        "id": r["id"], "file_id": r["file_id"], "name": r["name"],
+                        "color_en": r["color_en"], "color_ru": r["color_ru"],
+                        "category_en": r["category_en"], "category_ru": r["category_ru"],
+                        "created_at": _iso(r["created_at"]), "description": r["description"],
+                        "tags": list(r["tags"]), "emb_row": emb_row, "emb_model": r["emb_model"] if vec is not None else None
+                    }, ensure_ascii=False) + "\n")
+                    items += 1
+                    tags += len(r["tags"])
+            with open(os.path.join(target, "capsules.jsonl"), "w", encoding="utf-8") as cf:
+                async for r in conn.cursor(CAPSULES_EXPORT_SQL, user_id, prefetch=CURSOR_PREFETCH):
+                    cf.write(json.dumps({
+                        "id": r["id"], "name": r["name"], "item_ids": list(r["item_ids"] or []),
+                        "thumbnail_file_id": r["thumbnail_file_id"],
+                        "thumbnail_item_ids": list(r["thumbnail_item_ids"]) if r["thumbnail_item_ids"] is not None else None,
+                        "created_at": _iso(r["created_at"]), "description": r["description"]
+                    }, ensure_ascii=False) + "\n")
+                    capsules += 1
+        _write_npy(raw_path, os.path.join(target, "embeddings.npy"), emb_rows, dim)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+    manifest = {"format": FORMAT_VERSION, "user_id": user_id, "exported_at": _iso(datetime.now().astimezone()),
+                "items": items, "tags": tags, "capsules": capsules, "embeddings": emb_rows, "dim": dim}
+    with open(os.path.join(target, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def _read_jsonl_chunks(path: str, size: int):
+    chunk: List[Dict[str, Any]] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                chunk.append(json.loads(line))
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+async def import_user(conn: asyncpg.Connection, src: str, as_user: Optional[int] = None,
+                      codec: str = "f16") -> Dict[str, Any]:
+    with open(os.path.join(src, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT_VERSION:
+        raise RuntimeError(f"unsupported export format: {manifest.get('format')}")
+    user_id = as_user if as_user is not None else manifest["user_id"]
+    embs = np.load(os.path.join(src, "embeddings.npy"), mmap_mode="r") if manifest.get("embeddings") else None
+
+    id_map: Dict[int, int] = {}
+    items = tags = capsules = 0
+    async with conn.transaction():
+        for chunk in _read_jsonl_chunks(os.path.join(src, "wardrobe.jsonl"), IMPORT_CHUNK):
+            new_ids = await conn.fetch(
+                "SELECT nextval(pg_get_serial_sequence('wardrobe', 'id')) AS id FROM generate_series(1, $1)", len(chunk))
+            records, tag_records = [], []
+            for row, new in zip(chunk, new_ids):
+                new_id = new["id"]
+                id_map[row["id"]] = new_id
+                emb = embeddings.encode(embs[row["emb_row"]], codec) if (embs is not None and row.get("emb_row") is not None) else None
+                records.append((new_id, user_id, row["file_id"], emb, (row.get("emb_model") or repository.LEGACY_EMB_MODEL) if emb is not None else None, row["name"], row["color_en"], row["color_ru"],
+                                row["category_en"], row["category_ru"], _parse_dt(row["created_at"]), row["description"] or ""))
+                seen = set()  # тег без учёта регистра один на вещь (uq_tags_item_lower), а старые выгрузки бывают с дублями
+                for t in row.get("tags") or []:
+                    if t.lower() not in seen:
+                        seen.add(t.lower())
+                        tag_records.append((new_id, user_id, t))
+            await conn.copy_records_to_table("wardrobe", records=records, columns=WARDROBE_COLUMNS)
+            if tag_records:
+                await conn.copy_records_to_table("tags", records=tag_records, columns=["item_id", "user_id", "tag"])
+            items += len(records)
+            tags += len(tag_records)
+
+        cap_path = os.path.join(src, "capsules.jsonl")
+        if os.path.exists(cap_path):
+            for chunk in _read_jsonl_chunks(cap_path, IMPORT_CHUNK):
+                records = []
+                for c in chunk:
+                    thumb_ids = c.get("thumbnail_item_ids")
+                    records.append((user_id, c["name"], [id_map[i] for i in c["item_ids"] if i in id_map],
+                                    c.get("thumbnail_file_id"),
+                                    [id_map[i] for i in thumb_ids if i in id_map] if thumb_ids is not None else None,
+                                    _parse_dt(c["created_at"]), c.get("description") or ""))
+                await conn.copy_records_to_table(
+                    "capsules", records=records,
+                    columns=["user_id", "name", "item_ids", "thumbnail_file_id", "thumbnail_item_ids", "created_at", "description"])
+                capsules += len(records)
+        # граф совместимости пользователя (compat.py) не знает новых вещей — бот соберёт его заново
+        if await conn.fetchval("SELECT to_regclass('item_neighbors_state')"):
+            await conn.execute("DELETE FROM item_neighbors_state WHERE user_id=$1", user_id)
+    return {"user_id": user_id, "items": items, "tags": tags, "capsules": capsules}
+
+
+async def main():
+    ap = argparse.ArgumentParser(description="Экспорт/импорт гардероба пользователя")
+    ap.add_argument("--dsn", default=os.getenv("DATABASE_URL"), help="Postgres DSN (по умолчанию $DATABASE_URL)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export")
+    ex.add_argument("--user", type=int, action="append", required=True, help="user_id (можно несколько раз)")
+    ex.add_argument("--out", required=True)
+    im = sub.add_parser("import")
+    im.add_argument("--src", required=True, help="каталог <out>/<user_id> из экспорта")
+    im.add_argument("--as-user", type=int, default=None, help="импортировать под другим user_id")
+    im.add_argument("--codec", choices=sorted(embeddings.CODECS), default=os.getenv("EMB_CODEC", "f16"),
+                    help="формат хранения эмбеддингов (по умолчанию $EMB_CODEC или f16)")
+    args = ap.parse_args()
+    if not args.dsn:
+        raise SystemExit("Установите DATABASE_URL или передайте --dsn")
+
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        if args.cmd == "export":
+            for uid in args.user:
+                print(json.dumps(await export_user(conn, uid, args.out), ensure_ascii=False))
+        else:
+            print(json.dumps(await import_user(conn, args.src, args.as_user, args.codec), ensure_ascii=False))
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())